@@ -0,0 +1,46 @@
+import os
+from   wheelodex.cache import InspectionCache
+
+SHA1 = 'a' * 64
+SHA2 = 'b' * 64
+SHA3 = 'c' * 64
+
+def about(filename, padding=''):
+    return {"filename": filename, "padding": padding}
+
+def test_get_put(tmp_path):
+    cache = InspectionCache(str(tmp_path))
+    assert cache.get(SHA1, 'foo-1.0-py3-none-any.whl') is None
+    cache.put(SHA1, about('foo-1.0-py3-none-any.whl'))
+    assert cache.get(SHA1, 'foo-1.0-py3-none-any.whl') \
+        == about('foo-1.0-py3-none-any.whl')
+    assert (cache.hits, cache.misses) == (1, 1)
+    # Entries persist across instances:
+    cache2 = InspectionCache(str(tmp_path))
+    assert cache2.get(SHA1, 'foo-1.0-py3-none-any.whl') \
+        == about('foo-1.0-py3-none-any.whl')
+
+def test_get_filename_mismatch(tmp_path):
+    cache = InspectionCache(str(tmp_path))
+    cache.put(SHA1, about('foo-1.0-py3-none-any.whl'))
+    assert cache.get(SHA1, 'bar-1.0-py3-none-any.whl') is None
+
+def test_no_digest(tmp_path):
+    cache = InspectionCache(str(tmp_path))
+    cache.put(None, about('foo-1.0-py3-none-any.whl'))
+    assert cache.get(None, 'foo-1.0-py3-none-any.whl') is None
+
+def test_lru_eviction(tmp_path):
+    cache = InspectionCache(str(tmp_path))
+    cache.put(SHA1, about('foo-1.0-py3-none-any.whl', 'x' * 100))
+    entry_size = cache.total_size
+    cache = InspectionCache(str(tmp_path), max_size=entry_size * 2)
+    cache.put(SHA2, about('foo-2.0-py3-none-any.whl', 'x' * 100))
+    # Using SHA1 makes SHA2 the least recently used entry:
+    assert cache.get(SHA1, 'foo-1.0-py3-none-any.whl') is not None
+    cache.put(SHA3, about('foo-3.0-py3-none-any.whl', 'x' * 100))
+    assert cache.total_size <= entry_size * 2
+    assert not os.path.exists(cache.path_for(SHA2))
+    assert cache.get(SHA2, 'foo-2.0-py3-none-any.whl') is None
+    assert cache.get(SHA1, 'foo-1.0-py3-none-any.whl') is not None
+    assert cache.get(SHA3, 'foo-3.0-py3-none-any.whl') is not None
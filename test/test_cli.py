@@ -85,3 +85,10 @@ summary = New Summary
     assert groups[5].name == 'wipe.me'
     assert groups[5].summary == ''
     assert groups[5].description == ''
+
+def test_process_queue_pipeline_workers():
+    r = CliRunner().invoke(
+        main, ['process-queue', '--pipeline', '--workers', '2'],
+    )
+    assert r.exit_code != 0
+    assert '--pipeline and --workers are incompatible' in r.output
@@ -1,13 +1,20 @@
+from   copy             import deepcopy
+from   datetime         import datetime, timedelta, timezone
 import pytest
 from   wheelodex.app    import create_app
-from   wheelodex.models import Project, Version, Wheel, db
+from   wheelodex.models import EntryPointGroup, NameCache, Project, QueueState,\
+                                Version, Wheel, db
 from   wheelodex.dbutil import (
-    add_project, add_version, add_wheel,
+    add_project, add_version, add_wheel, add_wheel_from_json,
+    add_wheels_from_json,
+    claim_wheels,
     get_project, get_version,
-    iterqueue,
+    iter_stale_wheels, iterqueue, iterwheels,
     purge_old_versions,
     remove_project, remove_version, remove_wheel,
+    tombstones_since,
 )
+from   wheelodex.util   import wheel_sort_key
 
 @pytest.fixture(scope='session')
 def tmpdb_inited():
@@ -272,6 +279,8 @@ def test_latest_version():
     assert p.latest_version == v2
     add_version(p, '1.5')
     assert p.latest_version == v2
+    v3 = add_version(p, '10.0')
+    assert p.latest_version == v3
 
 def test_remove_version():
     assert Project.query.all() == []
@@ -288,6 +297,27 @@ def test_remove_version():
     assert p.latest_version == v1
     assert Wheel.query.all() == [whl1]
 
+def test_remove_with_stale_objects():
+    # Objects in the session whose rows have been deleted behind the ORM's
+    # back (e.g., by a bulk insert that was rolled back) must not break
+    # removals.
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    v2 = add_version(p, '2.0')
+    stale = add_version('Quux', '1.0')
+    db.session.flush()
+    db.session.execute(
+        Version.__table__.delete().where(Version.id == stale.id)
+    )
+    db.session.expire_all()
+    remove_version('FooBar', '2.0')
+    remove_wheel(whl1.filename)
+    remove_project('FooBar')
+    assert v2 not in db.session
+    assert whl1 not in db.session
+    assert Version.query.all() == []
+
 def test_purge_old_versions_one_version():
     v1 = add_version('foobar', '1.0')
     purge_old_versions()
@@ -396,6 +426,20 @@ def test_purge_old_versions_latest_has_data_plus_data_plus_mid():
     purge_old_versions()
     assert sort_versions(Version.query.all()) == [v2]
 
+@pytest.mark.parametrize('batch_size', [1, 2, 1000])
+def test_purge_old_versions_batches(batch_size):
+    v1 = add_version('foobar', '1.0')
+    add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    add_version('foobar', '1.5')
+    v2 = add_version('foobar', '2.0')
+    add_version('glarch', '0.1')
+    v3 = add_version('glarch', '1.0')
+    v4 = add_version('quux', '1.5')
+    add_version('quux', '1.0')
+    v5 = add_version('solo', '3.0')
+    purge_old_versions(batch_size=batch_size)
+    assert sort_versions(Version.query.all()) == [v1, v2, v3, v4, v5]
+
 def test_preferred_wheel_two_data():
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
@@ -437,88 +481,412 @@ def test_preferred_wheel_higher_data():
     assert p.best_wheel == whl2
 
 def test_iterqueue_skip_data():
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
     whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
-    assert iterqueue() == [whl1]
+    assert list(iterqueue()) == [whl1]
     whl1.set_data(FOOBAR_1_DATA)
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
 
 def test_iterqueue_skip_error():
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
     whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
-    assert iterqueue() == [whl1]
+    assert list(iterqueue()) == [whl1]
     whl1.add_error('Testing')
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
 
 def test_iterqueue_skip_non_latest():
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
     whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
-    assert iterqueue() == [whl1]
+    assert list(iterqueue()) == [whl1]
     v2 = add_version(p, '2.0')
     whl2 = add_wheel(version=v2, **FOOBAR_2_WHEEL)
-    assert iterqueue() == [whl2]
+    assert list(iterqueue()) == [whl2]
 
 def test_iterqueue_ignore_empty_latest():
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
     whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
-    assert iterqueue() == [whl1]
+    assert list(iterqueue()) == [whl1]
     add_version(p, '2.0')
-    assert iterqueue() == [whl1]
+    assert list(iterqueue()) == [whl1]
 
 def test_iterqueue_skip_large():
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
     whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
     whl1b = add_wheel(version=v1, **FOOBAR_1_WHEEL2)
     if whl1.size < whl1b.size:
-        assert iterqueue(max_wheel_size=whl1.size) == [whl1]
+        assert list(iterqueue(max_wheel_size=whl1.size)) == [whl1]
     else:
-        assert iterqueue(max_wheel_size=whl1b.size) == [whl1b]
+        assert list(iterqueue(max_wheel_size=whl1b.size)) == [whl1b]
 
 def test_iterqueue_multiwheel_version():
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
     whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
     whl1b = add_wheel(version=v1, **FOOBAR_1_WHEEL2)
-    assert sort_wheels(iterqueue()) == [whl1b, whl1]
+    assert sort_wheels(list(iterqueue())) == [whl1b, whl1]
 
 def test_iterqueue_multiwheel_version_some_data():
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
     whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
     whl1.set_data(FOOBAR_1_DATA)
     whl1b = add_wheel(version=v1, **FOOBAR_1_WHEEL2)
-    assert iterqueue() == [whl1b]
+    assert list(iterqueue()) == [whl1b]
 
 def test_iterqueue_multiwheel_version_some_error():
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
     whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
     whl1.add_error('Testing')
     whl1b = add_wheel(version=v1, **FOOBAR_1_WHEEL2)
-    assert iterqueue() == [whl1b]
+    assert list(iterqueue()) == [whl1b]
 
 def test_iterqueue_multiwheel_version_some_data_other_error():
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
     p = add_project('FooBar')
     v1 = add_version(p, '1.0')
     whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
     whl1.set_data(FOOBAR_1_DATA)
     whl1b = add_wheel(version=v1, **FOOBAR_1_WHEEL2)
     whl1b.add_error('Testing')
-    assert iterqueue() == []
+    assert list(iterqueue()) == []
+
+def test_iterqueue_batches():
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    whl1b = add_wheel(version=v1, **FOOBAR_1_WHEEL2)
+    q = add_project('quux')
+    v3 = add_version(q, '1.5')
+    whl3 = add_wheel(version=v3, **QUUX_1_5_WHEEL)
+    queue = iterqueue(batch_size=1)
+    assert next(queue) == whl1
+    # Changes made after the iterator has started are reflected in the
+    # batches that are fetched afterwards:
+    whl1b.set_data(FOOBAR_1_DATA)
+    v2 = add_version(p, '2.0')
+    whl2 = add_wheel(version=v2, **FOOBAR_2_WHEEL)
+    assert list(queue) == [whl3, whl2]
+
+def test_claim_wheels():
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    whl1b = add_wheel(version=v1, **FOOBAR_1_WHEEL2)
+    q = add_project('quux')
+    v3 = add_version(q, '1.5')
+    whl3 = add_wheel(version=v3, **QUUX_1_5_WHEEL)
+    claimed = claim_wheels('worker1', limit=2, lease_seconds=60)
+    assert claimed == [whl1, whl1b]
+    assert whl1.lease_owner == 'worker1'
+    assert whl1.lease_expires is not None
+    assert claim_wheels('worker2', limit=2, lease_seconds=60) == [whl3]
+    assert claim_wheels('worker3', limit=2, lease_seconds=60) == []
+
+def test_claim_wheels_expired():
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    assert claim_wheels('worker1', limit=10, lease_seconds=60) == [whl1]
+    whl1.lease_expires = datetime.now(timezone.utc) - timedelta(seconds=1)
+    assert claim_wheels('worker2', limit=10, lease_seconds=60) == [whl1]
+    assert whl1.lease_owner == 'worker2'
+
+def test_claim_wheels_skip_processed():
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    whl1b = add_wheel(version=v1, **FOOBAR_1_WHEEL2)
+    assert claim_wheels('worker1', limit=10, lease_seconds=60) == [whl1, whl1b]
+    whl1.set_data(FOOBAR_1_DATA)
+    whl1b.add_error('Testing')
+    assert whl1.lease_owner is None
+    assert whl1b.lease_expires is None
+    assert claim_wheels('worker2', limit=10, lease_seconds=60) == []
+
+def test_queue_states():
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    assert whl1.state == QueueState.PENDING
+    assert claim_wheels('worker1', limit=10, lease_seconds=60) == [whl1]
+    assert whl1.state == QueueState.IN_PROGRESS
+    whl1.set_data(FOOBAR_1_DATA)
+    assert whl1.state == QueueState.DONE
+    whl1b = add_wheel(version=v1, **FOOBAR_1_WHEEL2)
+    whl1b.add_error('Testing')
+    assert whl1b.state == QueueState.FAILED
+
+def test_iterqueue_remove_latest_version():
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    v2 = add_version(p, '2.0')
+    whl2 = add_wheel(version=v2, **FOOBAR_2_WHEEL)
+    assert whl1.state == QueueState.SUPERSEDED
+    assert list(iterqueue()) == [whl2]
+    remove_version('FooBar', '2.0')
+    assert whl1.state == QueueState.PENDING
+    assert list(iterqueue()) == [whl1]
+
+def test_iterqueue_remove_latest_wheel():
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    v2 = add_version(p, '2.0')
+    add_wheel(version=v2, **FOOBAR_2_WHEEL)
+    remove_wheel(FOOBAR_2_WHEEL["filename"])
+    assert list(iterqueue()) == [whl1]
+
+def test_set_data_replace():
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    whl1.set_data({
+        "project": "FooBar",
+        "version": "1.0",
+        "valid": True,
+        "dist_info": {
+            "record": [{"path": "foobar.py"}],
+            "entry_points": {"console_scripts": {"foobar": {}}},
+        },
+        "derived": {
+            "dependencies": ["quux"],
+            "keywords": ["foo"],
+            "modules": ["foobar"],
+        },
+    })
+    db.session.flush()
+    data_id = whl1.data.id
+    whl1.set_data({
+        "project": "FooBar",
+        "version": "1.0",
+        "valid": True,
+        "dist_info": {
+            "record": [{"path": "foobar.py"}, {"path": "barfoo.py"}],
+        },
+        "derived": {
+            "dependencies": [],
+            "keywords": [],
+            "modules": ["foobar", "barfoo"],
+        },
+    })
+    db.session.flush()
+    db.session.expire_all()
+    assert whl1.data.id == data_id
+    assert sorted(f.path for f in whl1.data.files) \
+        == ['barfoo.py', 'foobar.py']
+    assert sorted(m.name for m in whl1.data.modules) == ['barfoo', 'foobar']
+    assert whl1.data.entry_points == []
+    assert whl1.data.dependencies == []
+    assert whl1.data.keywords == []
+
+def test_set_data_related_rows():
+    """
+    Assert that the rows written in bulk by `set_data()` match those that
+    would be created for the data through the ORM, both when storing data for
+    the first time and when replacing it in place
+    """
+    p = add_project('FooBar')
+    glarch = add_project('Glarch')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    whl1.set_data({
+        "project": "FooBar",
+        "version": "1.0",
+        "valid": True,
+        "dist_info": {
+            "metadata": {"summary": "Foo all the bars"},
+            "record": [
+                {
+                    "path": "foobar/__init__.py",
+                    "digests": {"sha256": "x"},
+                    "size": 42,
+                },
+                {"path": "foobar/cli.py", "digests": {"sha256": "y"}, "size": 9},
+                # Duplicate RECORD entries are only stored once:
+                {"path": "foobar/cli.py", "digests": {"sha256": "y"}, "size": 9},
+                {
+                    "path": "FooBar-1.0.dist-info/RECORD",
+                    "digests": {},
+                    "size": None,
+                },
+            ],
+            "entry_points": {
+                "console_scripts": {
+                    "foobar": {
+                        "module": "foobar.cli",
+                        "attr": "main",
+                        "extras": [],
+                    },
+                    "fbar": {
+                        "module": "foobar.cli",
+                        "attr": "main",
+                        "extras": [],
+                    },
+                },
+                "foobar.plugins": {
+                    "default": {
+                        "module": "foobar",
+                        "attr": None,
+                        "extras": [],
+                    },
+                },
+            },
+        },
+        "derived": {
+            "dependencies": ["glarch", "quux"],
+            "keywords": ["foo", "bar", "foo"],
+            "modules": ["foobar", "foobar.cli"],
+        },
+    })
+    db.session.flush()
+    data_id = whl1.data.id
+    db.session.expire_all()
+    assert whl1.data.valid
+    assert p.summary == 'Foo all the bars'
+    assert sorted(f.path for f in whl1.data.files) == [
+        'FooBar-1.0.dist-info/RECORD',
+        'foobar/__init__.py',
+        'foobar/cli.py',
+    ]
+    assert sorted((e.group.name, e.name) for e in whl1.data.entry_points) \
+        == [
+            ('console_scripts', 'fbar'),
+            ('console_scripts', 'foobar'),
+            ('foobar.plugins', 'default'),
+        ]
+    assert sorted(d.name for d in whl1.data.dependencies) == ['glarch', 'quux']
+    assert glarch in whl1.data.dependencies
+    assert sorted(k.name for k in whl1.data.keywords) == ['bar', 'foo', 'foo']
+    assert sorted(m.name for m in whl1.data.modules) \
+        == ['foobar', 'foobar.cli']
+    assert EntryPointGroup.query.filter(
+        EntryPointGroup.name == 'console_scripts'
+    ).count() == 1
+    whl1.set_data({
+        "project": "FooBar",
+        "version": "1.0",
+        "valid": False,
+        "dist_info": {
+            "record": [{"path": "foobar/__init__.py"}],
+            "entry_points": {
+                "console_scripts": {
+                    "foobar": {
+                        "module": "foobar",
+                        "attr": "main",
+                        "extras": [],
+                    },
+                },
+            },
+        },
+        "derived": {
+            "dependencies": ["quux"],
+            "keywords": ["baz"],
+            "modules": ["foobar"],
+        },
+    })
+    db.session.flush()
+    db.session.expire_all()
+    assert whl1.data.id == data_id
+    assert not whl1.data.valid
+    assert p.summary is None
+    assert [f.path for f in whl1.data.files] == ['foobar/__init__.py']
+    assert [(e.group.name, e.name) for e in whl1.data.entry_points] \
+        == [('console_scripts', 'foobar')]
+    assert [d.name for d in whl1.data.dependencies] == ['quux']
+    assert [k.name for k in whl1.data.keywords] == ['baz']
+    assert [m.name for m in whl1.data.modules] == ['foobar']
+    assert glarch.rdepends == []
+    assert Project.query.count() == 3
+
+def test_iter_stale_wheels():
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    whl1 = add_wheel(version=v1, **FOOBAR_1_WHEEL)
+    whl1.set_data(FOOBAR_1_DATA)
+    v2 = add_version(p, '2.0')
+    whl2 = add_wheel(version=v2, **FOOBAR_2_WHEEL)
+    whl2.set_data(FOOBAR_2_DATA)
+    q = add_project('quux')
+    v3 = add_version(q, '1.5')
+    whl3 = add_wheel(version=v3, **QUUX_1_5_WHEEL)
+    assert list(iter_stale_wheels()) == []
+    whl1.data.wheel_inspect_version = '0.0.1'
+    whl2.data.wheel_inspect_version = '0.0.1'
+    assert list(iter_stale_wheels(batch_size=1)) == [whl2, whl1]
+    whl2.add_error('Testing')
+    assert list(iter_stale_wheels()) == [whl1]
+    whl3.set_data(FOOBAR_1_DATA)
+    whl3.data.wheel_inspect_version = '0.0.1'
+    assert list(iter_stale_wheels()) == [whl3, whl1]
+
+def test_name_cache():
+    cache = NameCache.for_model(Project)
+    hits, misses = cache.hits, cache.misses
+    p = add_project('Foo.Bar')
+    assert add_project('foo-bar') is p
+    assert (cache.hits - hits, cache.misses - misses) == (1, 1)
+    ids = cache.get_ids(['foo_bar', 'Quux', 'QUUX', 'glarch'])
+    assert ids["foo_bar"] == p.id
+    assert ids["Quux"] == ids["QUUX"]
+    assert Project.query.get(ids["QUUX"]).display_name in ('Quux', 'QUUX')
+    assert Project.query.get(ids["glarch"]).name == 'glarch'
+    assert (cache.hits - hits, cache.misses - misses) == (2, 3)
+    assert Project.query.count() == 3
+    # Reloading an expired object from the database is not a hit:
+    db.session.expire_all()
+    assert add_project('foo-bar') is p
+    assert (cache.hits - hits, cache.misses - misses) == (2, 4)
+    assert add_project('foo-bar') is p
+    assert (cache.hits - hits, cache.misses - misses) == (3, 4)
+
+def test_name_cache_rollback():
+    cache = NameCache.for_model(EntryPointGroup)
+    db.session.begin_nested()
+    group = EntryPointGroup.from_name('test.name_cache')
+    assert cache.ids == {'test.name_cache': group.id}
+    db.session.rollback()
+    assert cache.ids == {}
+    q = EntryPointGroup.query.filter(EntryPointGroup.name == 'test.name_cache')
+    assert q.all() == []
+    group = EntryPointGroup.from_name('test.name_cache')
+    assert q.all() == [group]
+
+@pytest.mark.parametrize('order', [
+    [0, 1, 2, 3, 4, 5],
+    [5, 4, 3, 2, 1, 0],
+    [2, 5, 0, 3, 1, 4],
+])
+def test_add_wheel_ordering(order):
+    filenames = [
+        'FooBar-1.0-py2.py3-none-any.whl',
+        'FooBar-1.0-cp37-cp37m-manylinux1_x86_64.whl',
+        'FooBar-1.0-cp37-cp37m-manylinux1_i686.whl',
+        'FooBar-1.0-cp37-cp37m-win_amd64.whl',
+        'FooBar-1.0-cp36-cp36m-manylinux1_x86_64.whl',
+        'FooBar-1.0-nonsense.whl',
+    ]
+    p = add_project('FooBar')
+    v1 = add_version(p, '1.0')
+    for i in order:
+        add_wheel(version=v1, **dict(FOOBAR_1_WHEEL, filename=filenames[i]))
+    assert [w.filename for w in sorted(v1.wheels, key=lambda w: w.ordering)] \
+        == sorted(filenames, key=wheel_sort_key)
+    assert sorted(w.ordering for w in v1.wheels) == list(range(6))
 
 def test_versions_wheels_grid():
     p = add_project('FooBar')
@@ -533,11 +901,178 @@ def test_versions_wheels_grid():
         ('1.0', [(whl1, True), (whl1b, False)]),
     ]
 
+REGISTERED = datetime(2018, 10, 31, 12, 0, 0, tzinfo=timezone.utc)
+
+def wheel_json(wheel, project, version, data=None):
+    about = {
+        "pypi": dict(wheel, project=project, version=version),
+        "wheelodex": {"registered": REGISTERED.isoformat()},
+    }
+    if data is not None:
+        about["data"] = data
+        about["wheelodex"].update({
+            "processed": "2018-10-31T12:34:56+00:00",
+            "wheel_inspect_version": "1.0.0",
+        })
+    return about
+
+BULK_ABOUTS = [
+    wheel_json(FOOBAR_1_WHEEL, 'FooBar', '1.0', dict(
+        FOOBAR_1_DATA,
+        dist_info={
+            "metadata": {"summary": "Version one"},
+            "entry_points": {"console_scripts": {"foo": {}}},
+            "record": [{"path": "foo.py"}, {"path": "foo.py"}],
+        },
+        derived={
+            "dependencies": ["quux", "Glarch"],
+            "keywords": ["foo"],
+            "modules": ["foo"],
+        },
+    )),
+    wheel_json(FOOBAR_2_WHEEL, 'FooBar', '2.0'),
+    wheel_json(FOOBAR_1_WHEEL2, 'FooBar', '1.0'),
+    wheel_json(QUUX_1_5_WHEEL, 'quux', '1.5', dict(
+        FOOBAR_1_DATA,
+        project='quux',
+        version='1.5',
+        dist_info={"metadata": {"summary": "Quux"}},
+    )),
+    wheel_json(FOOBAR_1_WHEEL, 'FooBar', '1.0'),
+]
+
+def snapshot_wheels():
+    return [
+        (
+            w.as_json(),
+            w.ordering,
+            w.state,
+            w.project.summary,
+            w.data and sorted(p.name for p in w.data.dependencies),
+            w.data and sorted(
+                (ep.group.name, ep.name) for ep in w.data.entry_points
+            ),
+            w.data and sorted(f.path for f in w.data.files),
+            w.data and sorted(m.name for m in w.data.modules),
+            w.data and sorted(k.name for k in w.data.keywords),
+        ) for w in Wheel.query.order_by(Wheel.filename)
+    ]
+
+@pytest.mark.parametrize('preregister', [False, True])
+def test_add_wheels_from_json(preregister):
+    if preregister:
+        add_wheel(
+            add_version('FooBar', '1.0'),
+            registered=REGISTERED,
+            **FOOBAR_1_WHEEL2
+        )
+    for about in deepcopy(BULK_ABOUTS):
+        add_wheel_from_json(about)
+    # Reload everything from the database so that both snapshots see the same
+    # column values:
+    db.session.expire_all()
+    expected = snapshot_wheels()
+    db.session.rollback()
+    if preregister:
+        add_wheel(
+            add_version('FooBar', '1.0'),
+            registered=REGISTERED,
+            **FOOBAR_1_WHEEL2
+        )
+    assert add_wheels_from_json(deepcopy(BULK_ABOUTS)) == (3 if preregister
+                                                           else 4)
+    assert snapshot_wheels() == expected
+    assert [w.state for w in Wheel.query.order_by(Wheel.filename)] == [
+        QueueState.SUPERSEDED, QueueState.DONE, QueueState.PENDING,
+        QueueState.DONE,
+    ]
+
+@pytest.mark.parametrize('bulk', [False, True])
+def test_add_wheels_from_json_registered(bulk):
+    dated = wheel_json(FOOBAR_1_WHEEL, 'FooBar', '1.0')
+    undated = wheel_json(FOOBAR_2_WHEEL, 'FooBar', '2.0')
+    del undated["wheelodex"]
+    start = datetime.now(timezone.utc)
+    if bulk:
+        add_wheels_from_json([dated, undated])
+    else:
+        add_wheel_from_json(dated)
+        add_wheel_from_json(undated)
+    db.session.flush()
+    assert list(iterwheels(since=start)) == [
+        Wheel.query.filter_by(filename=FOOBAR_2_WHEEL["filename"]).one()
+    ]
+    whl = Wheel.query.filter_by(filename=FOOBAR_1_WHEEL["filename"]).one()
+    # SQLite doesn't store time zones:
+    assert whl.registered.replace(tzinfo=timezone.utc) == REGISTERED
+
+@pytest.mark.parametrize('batch_size', [1, 2, 1000])
+def test_iterwheels(batch_size):
+    whl1 = add_wheel(add_version('FooBar', '1.0'), **FOOBAR_1_WHEEL)
+    whl1.set_data(FOOBAR_1_DATA)
+    whl1b = add_wheel(add_version('FooBar', '1.0'), **FOOBAR_1_WHEEL2)
+    whl1b.add_error('Oops')
+    whl2 = add_wheel(add_version('FooBar', '2.0'), **FOOBAR_2_WHEEL)
+    whl2.set_data(FOOBAR_2_DATA)
+    quux = add_wheel(add_version('quux', '1.5'), **QUUX_1_5_WHEEL)
+    db.session.flush()
+    assert list(iterwheels(batch_size=batch_size)) == [whl1, whl1b, whl2, quux]
+    assert list(iterwheels(data_only=True, batch_size=batch_size)) \
+        == [whl1, whl2]
+
+def test_iterwheels_since():
+    whl1 = add_wheel(add_version('FooBar', '1.0'), **FOOBAR_1_WHEEL)
+    whl1b = add_wheel(add_version('FooBar', '1.0'), **FOOBAR_1_WHEEL2)
+    whl2 = add_wheel(add_version('FooBar', '2.0'), **FOOBAR_2_WHEEL)
+    db.session.flush()
+    cutoff = datetime.now(timezone.utc)
+    whl1.set_data(FOOBAR_1_DATA)
+    whl1b.add_error('Oops')
+    quux = add_wheel(add_version('quux', '1.5'), **QUUX_1_5_WHEEL)
+    db.session.flush()
+    assert list(iterwheels(since=cutoff)) == [whl1, whl1b, quux]
+    assert list(iterwheels(data_only=True, since=cutoff)) == [whl1]
+    assert list(iterwheels()) == [whl1, whl1b, whl2, quux]
+
+def test_tombstones():
+    add_wheel(add_version('FooBar', '1.0'), **FOOBAR_1_WHEEL)
+    add_wheel(add_version('FooBar', '1.0'), **FOOBAR_1_WHEEL2)
+    add_wheel(add_version('FooBar', '2.0'), **FOOBAR_2_WHEEL)
+    add_wheel(add_version('quux', '1.5'), **QUUX_1_5_WHEEL)
+    db.session.flush()
+    cutoff = datetime.now(timezone.utc)
+    remove_wheel(FOOBAR_2_WHEEL["filename"])
+    remove_version('FooBar', '1.0')
+    remove_project('quux')
+    assert Wheel.query.all() == []
+    assert [t.filename for t in tombstones_since(cutoff)] == [
+        FOOBAR_2_WHEEL["filename"],
+        FOOBAR_1_WHEEL["filename"],
+        FOOBAR_1_WHEEL2["filename"],
+        QUUX_1_5_WHEEL["filename"],
+    ]
+    assert tombstones_since(datetime.now(timezone.utc)).all() == []
+
+def test_add_wheel_from_json_newer_data():
+    old = wheel_json(FOOBAR_1_WHEEL, 'FooBar', '1.0', FOOBAR_1_DATA)
+    new = wheel_json(FOOBAR_1_WHEEL, 'FooBar', '1.0', dict(
+        FOOBAR_1_DATA,
+        derived=dict(FOOBAR_1_DATA["derived"], keywords=["new"]),
+    ))
+    new["wheelodex"]["processed"] = "2018-11-11T11:11:11+00:00"
+    add_wheel_from_json(deepcopy(new))
+    add_wheel_from_json(deepcopy(old))
+    whl, = Wheel.query.all()
+    assert [k.name for k in whl.data.keywords] == ["new"]
+    old["wheelodex"]["processed"] = "2018-12-12T12:12:12+00:00"
+    add_wheel_from_json(deepcopy(old))
+    assert whl.data.keywords == []
+    assert whl.data.raw_data == FOOBAR_1_DATA
+
 ### TODO: TO TEST:
 # Adding WheelData with dependencies, entry points, etc.
 # `wheel.data = None` deletes the WheelData entry
 # Deleting a Wheel deletes its WheelData
 # Deleting a WheelData deletes its dependencies and entry points
 # Deleting a WheelData doesn't affect its Wheel
-# Version.ordering?
 # Project.preferred_wheel and Project.best_wheel when the highest version has multiple wheels with data
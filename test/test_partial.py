@@ -0,0 +1,147 @@
+import base64
+import hashlib
+from   http.server        import BaseHTTPRequestHandler, HTTPServer
+import os
+import re
+from   threading          import Thread
+from   zipfile            import ZIP_DEFLATED, ZipFile
+import pytest
+from   wheel_inspect      import inspect_wheel
+from   wheelodex.partial  import fetch_wheel_metadata
+from   wheelodex.process  import process_wheel_partial
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """ Serves files from ``server.root`` with support for single ranges """
+
+    def do_GET(self):
+        try:
+            with open(os.path.join(self.server.root, self.path[1:]), 'rb') as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        m = re.fullmatch(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if m:
+            start, end = int(m.group(1)), int(m.group(2)) + 1
+            body = data[start:end]
+            self.send_response(206)
+            self.send_header(
+                'Content-Range',
+                'bytes {}-{}/{}'.format(start, start+len(body)-1, len(data)),
+            )
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.bytes_served += len(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def range_server(tmp_path):
+    server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.root = str(tmp_path)
+    server.bytes_served = 0
+    t = Thread(target=server.serve_forever)
+    t.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        t.join()
+        server.server_close()
+
+def record_line(path, data):
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest())\
+                   .decode('us-ascii').rstrip('=')
+    return '{},sha256={},{}\n'.format(path, digest, len(data))
+
+def make_wheel(path, bulk_size):
+    """
+    Create a wheel for "foo 1.0" at ``path`` containing an incompressible
+    file of ``bulk_size`` bytes followed by the dist-info files
+    """
+    files = [
+        ('foo/__init__.py', b'print("Hello")\n'),
+        ('foo/data.bin', os.urandom(bulk_size)),
+        ('foo-1.0.dist-info/METADATA', b'Metadata-Version: 2.1\n'
+                                       b'Name: foo\n'
+                                       b'Version: 1.0\n'
+                                       b'Summary: A test wheel\n'
+                                       b'Requires-Dist: bar (>=1.0)\n'
+                                       b'Requires-Dist: baz\n'),
+        ('foo-1.0.dist-info/WHEEL', b'Wheel-Version: 1.0\n'
+                                    b'Generator: test_partial\n'
+                                    b'Root-Is-Purelib: true\n'
+                                    b'Tag: py3-none-any\n'),
+        ('foo-1.0.dist-info/entry_points.txt', b'[console_scripts]\n'
+                                               b'foo = foo:main\n'),
+    ]
+    record = ''.join(record_line(p, d) for p, d in files) \
+        + 'foo-1.0.dist-info/RECORD,,\n'
+    with ZipFile(path, 'w', ZIP_DEFLATED) as zf:
+        for p, d in files:
+            zf.writestr(p, d)
+        zf.writestr('foo-1.0.dist-info/RECORD', record)
+
+def file_digests(path):
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    return {
+        "md5": hashlib.md5(data).hexdigest(),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+@pytest.mark.parametrize('bulk_size', [0, 1 << 20])
+def test_process_wheel_partial(range_server, tmp_path, bulk_size):
+    filename = 'foo-1.0-py3-none-any.whl'
+    make_wheel(str(tmp_path / filename), bulk_size)
+    size = os.path.getsize(str(tmp_path / filename))
+    digests = file_digests(str(tmp_path / filename))
+    workdir = tmp_path / 'work'
+    workdir.mkdir()
+    about = process_wheel_partial(
+        filename = filename,
+        url      = 'http://127.0.0.1:{}/{}'.format(
+            range_server.server_port, filename,
+        ),
+        size     = size,
+        md5      = digests["md5"],
+        sha256   = digests["sha256"],
+        tmpdir   = str(workdir),
+    )
+    assert about == inspect_wheel(str(tmp_path / filename))
+    assert about["valid"]
+    assert about["derived"]["dependencies"] == ["bar", "baz"]
+    assert list(workdir.iterdir()) == []
+    assert range_server.bytes_served < (1 << 16) + 4096
+
+def test_fetch_wheel_metadata_no_range_support(tmp_path):
+    class NoRangeHandler(RangeHandler):
+        def do_GET(self):
+            del self.headers['Range']
+            super().do_GET()
+
+    filename = 'foo-1.0-py3-none-any.whl'
+    make_wheel(str(tmp_path / filename), 1024)
+    server = HTTPServer(('127.0.0.1', 0), NoRangeHandler)
+    server.root = str(tmp_path)
+    server.bytes_served = 0
+    t = Thread(target=server.serve_forever)
+    t.start()
+    try:
+        with pytest.raises(ValueError):
+            fetch_wheel_metadata(
+                'http://127.0.0.1:{}/{}'.format(server.server_port, filename),
+                os.path.getsize(str(tmp_path / filename)),
+                str(tmp_path / 'sparse.whl'),
+                'foo-1.0.dist-info/',
+            )
+    finally:
+        server.shutdown()
+        t.join()
+        server.server_close()
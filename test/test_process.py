@@ -0,0 +1,533 @@
+import asyncio
+import base64
+from   concurrent.futures import ThreadPoolExecutor
+import hashlib
+from   http.server       import BaseHTTPRequestHandler, HTTPServer
+import logging
+import os
+from   threading         import Thread, get_ident
+import time
+from   zipfile           import ZipFile
+import pytest
+from   sqlalchemy        import event
+from   sqlalchemy.orm    import Session
+from   wheel_inspect     import inspect_wheel
+from   wheelodex.app     import create_app
+from   wheelodex.cache   import InspectionCache
+from   wheelodex.dbutil  import add_project, add_version, add_wheel
+from   wheelodex.models  import QueueState, Wheel, WheelData, db
+from   wheelodex.process import ByteBudget, DownloadVerifier, \
+                                inspect_prehashed_wheel, pipeline_queue, \
+                                process_queue, process_queued_wheel, \
+                                process_wheel
+
+@pytest.fixture(scope='module')
+def tmpdb_inited(tmp_path_factory):
+    # The worker threads used by `process_queue()` each open their own
+    # database connections, so the database has to be in a file rather than
+    # in memory in order for them to all see the same data.  This fixture is
+    # module-scoped so that the session bound to this database is discarded
+    # (when the application context is popped) before other modules' tests
+    # run.
+    dbpath = tmp_path_factory.mktemp('db') / 'wheelodex.db'
+    with create_app(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + str(dbpath),
+    ).app_context():
+        # Make every transaction take SQLite's write lock when it begins so
+        # that concurrent writers wait for each other instead of failing with
+        # "database is locked"; see
+        # <https://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl>:
+        engine = db.get_engine()
+        @event.listens_for(engine, 'connect')
+        def do_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+        @event.listens_for(engine, 'begin')
+        def do_begin(conn):
+            conn.execute('BEGIN IMMEDIATE')
+        # Don't reuse a session bound to another test module's database:
+        db.session.remove()
+        db.create_all()
+        yield
+
+@pytest.fixture(autouse=True)
+def tmpdb(tmpdb_inited):
+    try:
+        yield
+    finally:
+        db.session.rollback()
+        # `process_queue()` commits as it goes, so clear out anything
+        # committed:
+        for tbl in reversed(db.metadata.sorted_tables):
+            db.session.execute(tbl.delete())
+        db.session.commit()
+
+def queue_wheels(*projects):
+    for name in projects:
+        v = add_version(add_project(name), '1.0')
+        filename = '{}-1.0-py3-none-any.whl'.format(name)
+        add_wheel(
+            version  = v,
+            filename = filename,
+            url      = 'http://example.com/' + filename,
+            size     = 65535,
+            md5      = '1234567890abcdef1234567890abcdef',
+            sha256   = '1234567890abcdef1234567890abcdef1234567890abcdef1234567890abcdef',
+            uploaded = '2018-09-26T15:12:54',
+        )
+    db.session.commit()
+
+def inspection(filename, valid=True):
+    project = filename.partition('-')[0]
+    return {
+        "filename": filename,
+        "project": project,
+        "version": "1.0",
+        # A `None` here can't be stored, so the error isn't raised until the
+        # wheel's data is flushed:
+        "valid": valid,
+        "dist_info": {
+            "metadata": {"summary": 'The ' + project + ' project'},
+            "record": [{"path": project + '.py'}],
+        },
+        "derived": {
+            "dependencies": [],
+            "keywords": [],
+            "modules": [project],
+        },
+    }
+
+def fake_process_wheel(filename, url, size, md5, sha256, tmpdir):
+    return inspection(filename, valid=None if 'bad' in filename else True)
+
+def wheel_states():
+    db.session.expire_all()
+    return {
+        whl.filename.partition('-')[0]: (
+            whl.state,
+            whl.data is not None,
+            len(whl.errors),
+        )
+        for whl in Wheel.query
+    }
+
+@pytest.mark.parametrize('commit_batch', [1, 2, 10])
+def test_process_queue_failed_store(monkeypatch, commit_batch):
+    monkeypatch.setattr(
+        'wheelodex.process.process_wheel', fake_process_wheel,
+    )
+    queue_wheels('foo', 'bad', 'bar', 'baz')
+    process_queue(commit_batch=commit_batch)
+    # Make sure nothing was left uncommitted:
+    db.session.rollback()
+    assert wheel_states() == {
+        "foo": (QueueState.DONE, True, 0),
+        "bad": (QueueState.FAILED, False, 1),
+        "bar": (QueueState.DONE, True, 0),
+        "baz": (QueueState.DONE, True, 0),
+    }
+    assert 'IntegrityError' in Wheel.query.filter(
+        Wheel.filename == 'bad-1.0-py3-none-any.whl'
+    ).one().errors[0].errmsg
+    assert WheelData.query.count() == 3
+
+@pytest.mark.parametrize('lease_batch', [None, 1, 2])
+def test_process_queue_workers(caplog, monkeypatch, lease_batch):
+    caplog.set_level(logging.INFO, logger='wheelodex')
+    threads = set()
+    def process_wheel(filename, url, size, md5, sha256, tmpdir):
+        threads.add(get_ident())
+        if filename.startswith('broken-'):
+            raise ValueError('Size mismatch: PyPI reports 65535, got 42')
+        return fake_process_wheel(filename, url, size, md5, sha256, tmpdir)
+    monkeypatch.setattr('wheelodex.process.process_wheel', process_wheel)
+    queue_wheels('foo', 'bad', 'bar', 'broken', 'baz')
+    process_queue(workers=3, lease_batch=lease_batch)
+    # All of the wheels were processed by the workers:
+    assert threads and get_ident() not in threads
+    assert wheel_states() == {
+        "foo": (QueueState.DONE, True, 0),
+        "bad": (QueueState.FAILED, False, 1),
+        "bar": (QueueState.DONE, True, 0),
+        "broken": (QueueState.FAILED, False, 1),
+        "baz": (QueueState.DONE, True, 0),
+    }
+    broken, = Wheel.query.filter(
+        Wheel.filename == 'broken-1.0-py3-none-any.whl'
+    ).one().errors
+    assert 'Size mismatch' in broken.errmsg
+    assert sorted(
+        whl.project.summary for whl in Wheel.query if whl.data is not None
+    ) == ['The bar project', 'The baz project', 'The foo project']
+    # The name cache statistics of the workers' sessions are logged once:
+    assert caplog.text.count('Project name cache:') == 1
+
+@pytest.mark.parametrize('commit_batch,commits', [(1, 5), (2, 3), (10, 1)])
+def test_process_queue_workers_commit_batch(monkeypatch, commit_batch,
+                                            commits):
+    main = get_ident()
+    worker_commits = []
+    real_commit = Session.commit
+    def commit(self):
+        if get_ident() != main:
+            worker_commits.append(self)
+        real_commit(self)
+    monkeypatch.setattr(
+        'wheelodex.process.process_wheel', fake_process_wheel,
+    )
+    queue_wheels('foo', 'bad', 'bar', 'baz', 'quux')
+    monkeypatch.setattr(Session, 'commit', commit)
+    process_queue(workers=3, commit_batch=commit_batch)
+    assert len(worker_commits) == commits
+    assert wheel_states() == {
+        "foo": (QueueState.DONE, True, 0),
+        "bad": (QueueState.FAILED, False, 1),
+        "bar": (QueueState.DONE, True, 0),
+        "baz": (QueueState.DONE, True, 0),
+        "quux": (QueueState.DONE, True, 0),
+    }
+
+@pytest.mark.parametrize('commit_batch', [1, 2, 10])
+def test_pipeline_queue(monkeypatch, commit_batch):
+    held = []
+    def download_wheel(filename, url, fpath, size, md5, sha256):
+        # Count the wheels on disk at once, including this one:
+        held.append(len(os.listdir(os.path.dirname(fpath))) + 1)
+        with open(fpath, 'wb') as fp:
+            fp.write(b'\0')
+        # Give the other downloaders a chance to run:
+        time.sleep(0.05)
+        return {"md5": md5, "sha256": sha256}
+    def inspect_prehashed_wheel(path, digests):
+        filename = os.path.basename(path)
+        if filename.startswith('broken-'):
+            raise ValueError('Not a wheel')
+        return fake_process_wheel(filename, None, None, None, None, None)
+    monkeypatch.setattr('wheelodex.process.download_wheel', download_wheel)
+    monkeypatch.setattr(
+        'wheelodex.process.inspect_prehashed_wheel', inspect_prehashed_wheel,
+    )
+    # Inspect in threads so that the stubs above are used:
+    monkeypatch.setattr(
+        'wheelodex.process.ProcessPoolExecutor', ThreadPoolExecutor,
+    )
+    queue_wheels('foo', 'bad', 'bar', 'broken', 'baz', 'quux')
+    pipeline_queue(
+        downloads       = 3,
+        inspectors      = 2,
+        max_buffer_size = 65535 * 2,
+        commit_batch    = commit_batch,
+    )
+    # Make sure nothing was left uncommitted:
+    db.session.rollback()
+    assert len(held) == 6
+    assert max(held) <= 2
+    assert wheel_states() == {
+        "foo": (QueueState.DONE, True, 0),
+        "bad": (QueueState.FAILED, False, 1),
+        "bar": (QueueState.DONE, True, 0),
+        "broken": (QueueState.FAILED, False, 1),
+        "baz": (QueueState.DONE, True, 0),
+        "quux": (QueueState.DONE, True, 0),
+    }
+    assert WheelData.query.count() == 4
+
+class RecordingCache:
+    """ A stand-in for `InspectionCache` that records the threads using it """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.threads = set()
+
+    def get(self, sha256, filename):
+        self.threads.add(get_ident())
+        return self.entries.get(filename)
+
+    def put(self, sha256, about):
+        self.threads.add(get_ident())
+        self.entries[about["filename"]] = about
+
+
+def test_pipeline_queue_off_loop(monkeypatch):
+    main = get_ident()
+    db_threads = set()
+    real_commit = Session.commit
+    def commit(self):
+        db_threads.add(get_ident())
+        real_commit(self)
+    def download_wheel(filename, url, fpath, size, md5, sha256):
+        with open(fpath, 'wb') as fp:
+            fp.write(b'\0')
+        return {"md5": md5, "sha256": sha256}
+    def inspect_prehashed_wheel(path, digests):
+        filename = os.path.basename(path)
+        return fake_process_wheel(filename, None, None, None, None, None)
+    monkeypatch.setattr('wheelodex.process.download_wheel', download_wheel)
+    monkeypatch.setattr(
+        'wheelodex.process.inspect_prehashed_wheel', inspect_prehashed_wheel,
+    )
+    monkeypatch.setattr(
+        'wheelodex.process.ProcessPoolExecutor', ThreadPoolExecutor,
+    )
+    queue_wheels('foo', 'bar')
+    cache = RecordingCache({
+        'foo-1.0-py3-none-any.whl': inspection('foo-1.0-py3-none-any.whl'),
+    })
+    monkeypatch.setattr(Session, 'commit', commit)
+    pipeline_queue(downloads=2, inspectors=1, cache=cache)
+    monkeypatch.undo()
+    # Neither the cache nor the database was used on the event loop's
+    # thread, and all database writes happened on a single thread:
+    assert cache.threads and main not in cache.threads
+    assert len(db_threads) == 1 and main not in db_threads
+    assert 'bar-1.0-py3-none-any.whl' in cache.entries
+    assert wheel_states() == {
+        "foo": (QueueState.DONE, True, 0),
+        "bar": (QueueState.DONE, True, 0),
+    }
+
+def test_partial_analysis_not_cached(monkeypatch, tmp_path):
+    calls = []
+    def process_wheel(filename, url, size, md5, sha256, tmpdir):
+        calls.append('full')
+        return inspection(filename)
+    def process_wheel_partial(filename, url, size, md5, sha256, tmpdir):
+        calls.append('partial')
+        about = inspection(filename)
+        about["dist_info"]["record"] = []
+        return about
+    monkeypatch.setattr('wheelodex.process.process_wheel', process_wheel)
+    monkeypatch.setattr(
+        'wheelodex.process.process_wheel_partial', process_wheel_partial,
+    )
+    queue_wheels('foo')
+    whl = Wheel.query.one()
+    cache = InspectionCache(str(tmp_path / 'cache'))
+    process_queued_wheel(
+        whl, str(tmp_path), max_full_size=1024, commit=False, cache=cache,
+    )
+    assert calls == ['partial']
+    assert cache.get(whl.sha256, whl.filename) is None
+    # A later full analysis doesn't get the partial one from the cache:
+    process_queued_wheel(whl, str(tmp_path), commit=False, cache=cache)
+    assert calls == ['partial', 'full']
+    assert whl.data.raw_data["dist_info"]["record"] == [{"path": 'foo.py'}]
+    # ... but a full analysis from the cache can be used in place of a
+    # partial one:
+    process_queued_wheel(
+        whl, str(tmp_path), max_full_size=1024, commit=False, cache=cache,
+    )
+    assert calls == ['partial', 'full']
+
+def test_pipeline_partial_analysis_not_cached(monkeypatch, tmp_path):
+    def process_wheel_partial(filename, url, size, md5, sha256, tmpdir):
+        return inspection(filename)
+    monkeypatch.setattr(
+        'wheelodex.process.process_wheel_partial', process_wheel_partial,
+    )
+    queue_wheels('foo')
+    cache = InspectionCache(str(tmp_path / 'cache'))
+    pipeline_queue(max_wheel_size=1024, partial=True, cache=cache)
+    assert wheel_states() == {"foo": (QueueState.DONE, True, 0)}
+    assert cache.entries == {}
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+def test_byte_budget():
+    async def check():
+        budget = ByteBudget(10)
+        await budget.acquire(6)
+        waiter = asyncio.ensure_future(budget.acquire(6))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        # Smaller reservations that fit can still be made:
+        await budget.acquire(4)
+        assert budget.used == 10
+        await budget.release(6)
+        await asyncio.sleep(0.01)
+        assert waiter.done()
+        assert budget.used == 10
+    run_async(check())
+
+def test_byte_budget_oversized():
+    async def check():
+        budget = ByteBudget(10)
+        # A reservation larger than the limit is granted when nothing else
+        # is reserved ...
+        await budget.acquire(20)
+        waiter = asyncio.ensure_future(budget.acquire(1))
+        await asyncio.sleep(0.01)
+        # ... but then nothing else is until it's released:
+        assert not waiter.done()
+        await budget.release(20)
+        await asyncio.sleep(0.01)
+        assert waiter.done()
+        assert budget.used == 1
+    run_async(check())
+
+def test_byte_budget_unlimited():
+    async def check():
+        budget = ByteBudget(None)
+        for _ in range(3):
+            await asyncio.wait_for(budget.acquire(1 << 40), 1)
+        assert budget.used == 3 << 40
+    run_async(check())
+
+def make_wheel(path):
+    """ Create a minimal wheel for "foo 1.0" at ``path`` """
+    files = [
+        ('foo.py', b'print("Hello")\n'),
+        ('foo-1.0.dist-info/METADATA', b'Metadata-Version: 2.1\n'
+                                       b'Name: foo\n'
+                                       b'Version: 1.0\n'),
+        ('foo-1.0.dist-info/WHEEL', b'Wheel-Version: 1.0\n'
+                                    b'Generator: test_process\n'
+                                    b'Root-Is-Purelib: true\n'
+                                    b'Tag: py3-none-any\n'),
+    ]
+    record = ''
+    for p, d in files:
+        digest = base64.urlsafe_b64encode(hashlib.sha256(d).digest())\
+                       .decode('us-ascii').rstrip('=')
+        record += '{},sha256={},{}\n'.format(p, digest, len(d))
+    record += 'foo-1.0.dist-info/RECORD,,\n'
+    with ZipFile(path, 'w') as zf:
+        for p, d in files:
+            zf.writestr(p, d)
+        zf.writestr('foo-1.0.dist-info/RECORD', record)
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    return {
+        "md5": hashlib.md5(data).hexdigest(),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+DATA = b'0123456789'
+DATA_DIGESTS = {
+    "md5": hashlib.md5(DATA).hexdigest(),
+    "sha256": hashlib.sha256(DATA).hexdigest(),
+}
+
+def verify(chunks, size=len(DATA), digests=DATA_DIGESTS, headers=None):
+    verifier = DownloadVerifier('foo-1.0-py3-none-any.whl', size, digests)
+    verifier.on_start(FakeResponse(headers or {}))
+    for c in chunks:
+        verifier.on_chunk(c)
+    verifier.on_finish()
+    return verifier.hexdigests()
+
+def test_download_verifier():
+    assert verify([DATA[:4], DATA[4:]]) == DATA_DIGESTS
+    assert verify([DATA], digests={"md5": None, "sha256": None}) \
+        == DATA_DIGESTS
+
+def test_download_verifier_too_long():
+    verifier = DownloadVerifier(
+        'foo-1.0-py3-none-any.whl', len(DATA), DATA_DIGESTS,
+    )
+    verifier.on_start(FakeResponse({}))
+    verifier.on_chunk(DATA)
+    # The download is aborted on the first chunk past the expected size,
+    # without waiting for the end of the stream:
+    with pytest.raises(ValueError, match='^Size mismatch'):
+        verifier.on_chunk(b'extra')
+
+def test_download_verifier_too_short():
+    with pytest.raises(ValueError, match='^Size mismatch'):
+        verify([DATA[:-1]])
+
+def test_download_verifier_content_length():
+    with pytest.raises(ValueError, match='Content-Length 11$'):
+        verify([], headers={"Content-Length": '11'})
+    # Content-Length is ignored for encoded responses:
+    assert verify(
+        [DATA],
+        headers={"Content-Length": '11', "Content-Encoding": 'gzip'},
+    ) == DATA_DIGESTS
+
+def test_download_verifier_bad_sha256():
+    digests = dict(DATA_DIGESTS, sha256='0' * 64)
+    with pytest.raises(ValueError, match='^sha256 hash mismatch'):
+        verify([DATA], digests=digests)
+
+def test_inspect_prehashed_wheel(tmp_path):
+    path = str(tmp_path / 'foo-1.0-py3-none-any.whl')
+    digests = make_wheel(path)
+    # Apart from the digests, the output is exactly that of `inspect_wheel()`:
+    assert inspect_prehashed_wheel(path, digests) == inspect_wheel(path)
+    fake = {"md5": 'a' * 32, "sha256": 'b' * 64}
+    about = inspect_prehashed_wheel(path, fake)
+    assert about["file"]["digests"] == fake
+    assert about["valid"]
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """ Serves the files in ``server.root`` """
+
+    def do_GET(self):
+        path = os.path.join(self.server.root, self.path[1:])
+        with open(path, 'rb') as fp:
+            body = fp.read()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def file_server(tmp_path):
+    server = HTTPServer(('127.0.0.1', 0), FileHandler)
+    server.root = str(tmp_path)
+    t = Thread(target=server.serve_forever)
+    t.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        t.join()
+        server.server_close()
+
+@pytest.mark.parametrize('corrupt,error', [
+    ({}, None),
+    ({"sha256": '0' * 64}, '^sha256 hash mismatch'),
+    ({"size": -1}, '^Size mismatch'),
+])
+def test_process_wheel_verification(tmp_path, file_server, corrupt, error):
+    filename = 'foo-1.0-py3-none-any.whl'
+    digests = make_wheel(str(tmp_path / filename))
+    workdir = tmp_path / 'work'
+    workdir.mkdir()
+    kwargs = dict(
+        filename = filename,
+        url      = 'http://127.0.0.1:{}/{}'.format(
+            file_server.server_port, filename,
+        ),
+        size     = os.path.getsize(str(tmp_path / filename)),
+        md5      = digests["md5"],
+        sha256   = digests["sha256"],
+        tmpdir   = str(workdir),
+    )
+    if "size" in corrupt:
+        kwargs["size"] += corrupt["size"]
+    if "sha256" in corrupt:
+        kwargs["sha256"] = corrupt["sha256"]
+    if error is None:
+        about = process_wheel(**kwargs)
+        assert about == inspect_wheel(str(tmp_path / filename))
+    else:
+        with pytest.raises(ValueError, match=error):
+            process_wheel(**kwargs)
+    assert list(workdir.iterdir()) == []
@@ -0,0 +1,87 @@
+from   concurrent.futures import ThreadPoolExecutor
+import threading
+import pytest
+import requests
+from   wheelodex.pypi_api  import PyPIAPI, SimpleIndexParser
+from   wheelodex.util      import USER_AGENT
+
+SIMPLE_INDEX = '''\
+<!DOCTYPE html>
+<html>
+  <head>
+    <title>Simple index</title>
+  </head>
+  <body>
+    <a href="/simple/0/">0</a>
+    <a href="/simple/foo-bar/">Foo_Bar</a>
+    <a href="/simple/and/">&amp;</a>
+    <a href="/simple/caf%C3%A9/">café</a>
+    <a href="/simple/zzz/">zzz</a>
+  </body>
+</html>
+'''
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, len(SIMPLE_INDEX)])
+def test_simple_index_parser(chunk_size):
+    parser = SimpleIndexParser()
+    names = []
+    for i in range(0, len(SIMPLE_INDEX), chunk_size):
+        parser.feed(SIMPLE_INDEX[i:i+chunk_size])
+        names.extend(parser.drain())
+    parser.close()
+    names.extend(parser.drain())
+    assert names == ['0', 'Foo_Bar', '&', 'café', 'zzz']
+    assert parser.drain() == []
+
+class FakeResponse:
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+        self.closed = False
+
+    def iter_content(self, chunk_size, decode_unicode):
+        yield from self.chunks
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+
+def test_list_packages_retry_midstream(monkeypatch):
+    responses = [
+        FakeResponse(
+            [SIMPLE_INDEX[:150]],
+            requests.exceptions.ChunkedEncodingError('Connection broken'),
+        ),
+        FakeResponse([], requests.ConnectionError('Connection reset')),
+        FakeResponse([SIMPLE_INDEX[:200], SIMPLE_INDEX[200:]]),
+    ]
+    fetched = []
+    def simple_index(self):
+        fetched.append(responses[len(fetched)])
+        return fetched[-1]
+    sleeps = []
+    monkeypatch.setattr(PyPIAPI, 'simple_index', simple_index)
+    monkeypatch.setattr('wheelodex.pypi_api.time.sleep', sleeps.append)
+    names = PyPIAPI().list_packages()
+    assert [next(names), next(names)] == ['0', 'Foo_Bar']
+    assert list(names) == ['&', 'café', 'zzz']
+    assert fetched == responses
+    assert all(r.closed for r in responses)
+    assert sleeps == [2, 4]
+
+def test_session_per_thread():
+    api = PyPIAPI()
+    workers = 4
+    # Make sure each call runs in a different thread:
+    barrier = threading.Barrier(workers)
+    def get_session(_):
+        barrier.wait()
+        return api.s
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        sessions = list(pool.map(get_session, range(workers)))
+    sessions.append(api.s)
+    assert len({id(s) for s in sessions}) == workers + 1
+    assert api.s is sessions[-1]
+    assert all(s.headers["User-Agent"] == USER_AGENT for s in sessions)
@@ -0,0 +1,314 @@
+from   datetime           import datetime, timedelta, timezone
+import threading
+import time
+import pytest
+from   wheelodex.app      import create_app
+from   wheelodex.dbutil   import add_orphan_wheel, add_project, \
+                                  add_version, get_scan_checkpoint, \
+                                  get_serial, start_scan_checkpoint
+from   wheelodex.models   import NameCache, OrphanWheel, Project, Version, \
+                                  Wheel, db
+from   wheelodex.pypi_api import PyPIAPI
+from   wheelodex.scan     import parse_action, prefetch, \
+                                  process_orphan_wheels, scan_changelog, \
+                                  scan_pypi
+
+@pytest.fixture(scope='session')
+def tmpdb_inited():
+    with create_app().app_context():
+        # See <https://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#foreign-key-support>:
+        db.session.execute("PRAGMA foreign_keys=ON")
+        db.create_all()
+        yield
+
+@pytest.fixture(autouse=True)
+def tmpdb(tmpdb_inited):
+    try:
+        yield
+    finally:
+        db.session.rollback()
+        # `scan_pypi()` commits as it goes, so clear out anything committed:
+        for tbl in reversed(db.metadata.sorted_tables):
+            db.session.execute(tbl.delete())
+        db.session.commit()
+
+def asset(filename):
+    return {
+        "filename": filename,
+        "url": 'http://example.com/' + filename,
+        "size": 65535,
+        "digests": {
+            "md5": '1234567890ABCDEF1234567890ABCDEF',
+            "sha256": '1234567890abcdef1234567890abcdef1234567890abcdef1234567890abcdef',
+        },
+        "upload_time": '2018-09-26T15:12:54',
+    }
+
+PROJECT_DATA = {
+    "foobar": {
+        "releases": {
+            "1.0": [
+                asset('FooBar-1.0-py2-none-any.whl'),
+                asset('FooBar-1.0-py3-none-any.whl'),
+                asset('FooBar-1.0.tar.gz'),
+            ],
+        },
+    },
+    "quux": {"releases": {"1.5": []}},
+}
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_process_orphan_wheels(monkeypatch, workers):
+    fetched = []
+    def project_data(self, project):
+        fetched.append(project)
+        return PROJECT_DATA.get(project)
+    monkeypatch.setattr(PyPIAPI, 'project_data', project_data)
+    v1 = add_version('FooBar', '1.0')
+    now = datetime.now(timezone.utc).timestamp()
+    add_orphan_wheel(v1, 'FooBar-1.0-py2-none-any.whl', now)
+    add_orphan_wheel(v1, 'FooBar-1.0-py3-none-any.whl', now)
+    v2 = add_version('quux', '1.5')
+    add_orphan_wheel(v2, 'quux-1.5-py3-none-any.whl', now)
+    old = (datetime.now(timezone.utc) - timedelta(days=3)).timestamp()
+    add_orphan_wheel(v2, 'quux-1.5-py2-none-any.whl', old)
+    add_orphan_wheel(add_version('glarch', '0.1'), 'glarch-0.1-py3-none-any.whl', now)
+    process_orphan_wheels(max_age=2*24*60*60, workers=workers)
+    assert sorted(fetched) == ['foobar', 'glarch', 'quux']
+    assert sorted(w.filename for w in Wheel.query) == [
+        'FooBar-1.0-py2-none-any.whl',
+        'FooBar-1.0-py3-none-any.whl',
+    ]
+    assert all(w.md5 == '1234567890abcdef1234567890abcdef' for w in Wheel.query)
+    assert sorted(o.filename for o in OrphanWheel.query) == [
+        'glarch-0.1-py3-none-any.whl',
+        'quux-1.5-py3-none-any.whl',
+    ]
+
+@pytest.mark.parametrize('workers', [1, 2, 5])
+def test_prefetch(workers):
+    lock = threading.Lock()
+    started = []
+    def func(x):
+        with lock:
+            started.append(x)
+        # Make later items finish first:
+        time.sleep(0.01 * (x % 3))
+        return x * x
+    results = []
+    for x, y in prefetch(func, range(20), workers):
+        # No item more than 2*workers ahead of the consumer has been started:
+        assert len(started) <= x + 1 + 2 * workers
+        results.append((x, y))
+    assert results == [(x, x * x) for x in range(20)]
+    assert sorted(started) == list(range(20))
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_scan_pypi(monkeypatch, workers):
+    data = {
+        "FooBar": {
+            "releases": {
+                "0.9": [asset('FooBar-0.9-py3-none-any.whl')],
+                "1.0": [
+                    asset('FooBar-1.0-py2-none-any.whl'),
+                    asset('FooBar-1.0-py3-none-any.whl'),
+                    asset('FooBar-1.0.tar.gz'),
+                ],
+            },
+        },
+        "empty": None,
+        "sdist-only": {"releases": {"2.0": [asset('sdist-only-2.0.tar.gz')]}},
+        "quux": {"releases": {"1.5": [asset('quux-1.5-py3-none-any.whl')]}},
+    }
+    def project_data(self, project):
+        time.sleep(0.01 * (len(project) % 3))
+        return data[project]
+    monkeypatch.setattr(PyPIAPI, 'changelog_last_serial', lambda self: 42)
+    monkeypatch.setattr(PyPIAPI, 'list_packages', lambda self: list(data))
+    monkeypatch.setattr(PyPIAPI, 'project_data', project_data)
+    scan_pypi(workers=workers)
+    assert get_serial() == 42
+    assert [p.display_name for p in Project.query.order_by(Project.id)] \
+        == ['FooBar', 'empty', 'sdist-only', 'quux']
+    assert sorted(
+        (v.project.name, v.display_name) for v in Version.query
+    ) == [('foobar', '1.0'), ('quux', '1.5'), ('sdist-only', '2.0')]
+    assert sorted(w.filename for w in Wheel.query) == [
+        'FooBar-1.0-py2-none-any.whl',
+        'FooBar-1.0-py3-none-any.whl',
+        'quux-1.5-py3-none-any.whl',
+    ]
+
+def test_scan_pypi_resume(monkeypatch):
+    # Not in order of normalized name:
+    names = ['alpha', 'Beta', 'gamma', 'delta_', 'epsilon']
+    fetched = []
+    def project_data(self, project):
+        fetched.append(project)
+        if project == 'delta_' and crash:
+            raise RuntimeError('Simulated crash')
+        return {"releases": {"1.0": [asset(project + '-1.0-py3-none-any.whl')]}}
+    monkeypatch.setattr(PyPIAPI, 'changelog_last_serial', lambda self: 42)
+    monkeypatch.setattr(PyPIAPI, 'list_packages', lambda self: iter(names))
+    monkeypatch.setattr(PyPIAPI, 'project_data', project_data)
+    crash = True
+    with pytest.raises(RuntimeError):
+        scan_pypi(batch_size=2)
+    db.session.rollback()
+    checkpoint = get_scan_checkpoint()
+    assert checkpoint.serial == 42
+    assert checkpoint.project == 'Beta'
+    assert get_serial() is None
+    assert sorted(w.filename for w in Wheel.query) == [
+        'Beta-1.0-py3-none-any.whl',
+        'alpha-1.0-py3-none-any.whl',
+    ]
+    crash = False
+    fetched.clear()
+    monkeypatch.setattr(PyPIAPI, 'changelog_last_serial', lambda self: 99)
+    scan_pypi(batch_size=2, resume=True)
+    assert fetched == ['gamma', 'delta_', 'epsilon']
+    assert get_scan_checkpoint() is None
+    assert get_serial() == 42
+    assert len(Wheel.query.all()) == 5
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_scan_pypi_warm_across_batches(monkeypatch, workers):
+    names = ['alpha', 'Beta', 'gamma', 'delta_', 'epsilon']
+    for n in names:
+        add_project(n)
+    db.session.commit()
+    monkeypatch.setattr(PyPIAPI, 'changelog_last_serial', lambda self: 42)
+    monkeypatch.setattr(PyPIAPI, 'list_packages', lambda self: iter(names))
+    monkeypatch.setattr(PyPIAPI, 'project_data', lambda self, project: None)
+    cache = NameCache.for_model(Project)
+    hits, misses = cache.hits, cache.misses
+    scan_pypi(workers=workers, batch_size=2)
+    # Every project was found in the cache despite the session being
+    # committed & cleared after every two projects:
+    assert (cache.hits - hits, cache.misses - misses) == (5, 0)
+
+def test_scan_pypi_resume_no_checkpoint():
+    with pytest.raises(ValueError):
+        scan_pypi(resume=True)
+
+def test_scan_pypi_resume_missing_project(monkeypatch):
+    fetched = []
+    def project_data(self, project):
+        fetched.append(project)
+        return None
+    monkeypatch.setattr(PyPIAPI, 'list_packages', lambda self: iter(['a', 'b']))
+    monkeypatch.setattr(PyPIAPI, 'project_data', project_data)
+    start_scan_checkpoint(42).project = 'deleted'
+    scan_pypi(resume=True)
+    assert fetched == ['a', 'b']
+    assert get_scan_checkpoint() is None
+    assert get_serial() == 42
+
+@pytest.mark.parametrize('action,parsed', [
+    ('add py3 file foo-1.0-py3-none-any.whl',
+     ('add_wheel', 'foo-1.0-py3-none-any.whl')),
+    ('add source file foo-1.0.tar.gz', (None, None)),
+    ('remove file foo-1.0-py3-none-any.whl',
+     ('remove_wheel', 'foo-1.0-py3-none-any.whl')),
+    ('remove file foo-1.0.tar.gz', (None, None)),
+    ('create', ('add_project', None)),
+    ('remove project', ('remove_project', None)),
+    ('new release', ('add_version', None)),
+    ('remove release', ('remove_version', None)),
+    ('add Owner jwodder', (None, None)),
+    ('docdestroy', (None, None)),
+])
+def test_parse_action(action, parsed):
+    assert parse_action(action) == parsed
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_scan_changelog(monkeypatch, workers):
+    ts = int(datetime.now(timezone.utc).timestamp())
+    events = [
+        ('FooBar', None, ts, 'create', 101),
+        ('FooBar', '1.0', ts, 'new release', 102),
+        ('FooBar', '1.0', ts, 'add py2 file FooBar-1.0-py2-none-any.whl', 103),
+        ('FooBar', '1.0', ts, 'add py3 file FooBar-1.0-py3-none-any.whl', 104),
+        ('FooBar', '1.0', ts, 'add source file FooBar-1.0.tar.gz', 105),
+        ('FooBar', '1.0', ts, 'add py3 file FooBar-1.0-cp37-none-any.whl', 106),
+        ('FooBar', '1.0', ts, 'add Owner jwodder', 107),
+        ('quux', '1.5', ts, 'add py3 file quux-1.5-py3-none-any.whl', 108),
+        ('quux', '1.5', ts, 'add py2 file quux-1.5-py2-none-any.whl', 109),
+        ('glarch', '0.1', ts, 'add py3 file glarch-0.1-py3-none-any.whl', 110),
+        ('FooBar', '1.0', ts, 'remove file FooBar-1.0-cp37-none-any.whl', 111),
+        ('glarch', '0.1', ts, 'remove release', 112),
+        ('gnusto', '2.0', ts, 'add py3 file gnusto-2.0-py3-none-any.whl', 113),
+        ('Gnusto', None, ts, 'remove project', 114),
+    ]
+    fetched = []
+    def project_data(self, project):
+        fetched.append(project)
+        return {
+            "FooBar": PROJECT_DATA["foobar"],
+            "quux": {
+                "releases": {"1.5": [asset('quux-1.5-py3-none-any.whl')]},
+            },
+        }.get(project)
+    monkeypatch.setattr(
+        PyPIAPI, 'changelog_since_serial',
+        lambda self, since: [e for e in events if e[4] > since],
+    )
+    monkeypatch.setattr(PyPIAPI, 'project_data', project_data)
+    scan_changelog(100, workers=workers)
+    # Each project is fetched at most once, and not at all if all of its
+    # added wheels are later removed:
+    assert sorted(fetched) == ['FooBar', 'quux']
+    assert sorted(w.filename for w in Wheel.query) == [
+        'FooBar-1.0-py2-none-any.whl',
+        'FooBar-1.0-py3-none-any.whl',
+        'quux-1.5-py3-none-any.whl',
+    ]
+    assert [o.filename for o in OrphanWheel.query] \
+        == ['quux-1.5-py2-none-any.whl']
+    assert sorted(
+        (v.project.name, v.display_name) for v in Version.query
+    ) == [('foobar', '1.0'), ('quux', '1.5')]
+    assert get_serial() == 114
+
+@pytest.mark.parametrize('events_per_commit', [1, 2, 5, 100])
+def test_scan_changelog_chunks(monkeypatch, events_per_commit):
+    ts = int(datetime.now(timezone.utc).timestamp())
+    events = [
+        ('proj{}'.format(i), '1.0', ts, 'new release', 100 + i)
+        for i in range(1, 12)
+    ]
+    requested = []
+    def changelog_since_serial(self, since):
+        # Like PyPI, return a limited number of events per call:
+        requested.append(since)
+        return [e for e in events if e[4] > since][:4]
+    monkeypatch.setattr(
+        PyPIAPI, 'changelog_since_serial', changelog_since_serial,
+    )
+    scan_changelog(100, events_per_commit=events_per_commit)
+    assert requested == [100, 104, 108, 111]
+    assert get_serial() == 111
+    assert sorted(v.project.name for v in Version.query) \
+        == sorted('proj{}'.format(i) for i in range(1, 12))
+
+def test_scan_changelog_interrupted(monkeypatch):
+    ts = int(datetime.now(timezone.utc).timestamp())
+    events = [
+        ('proj{}'.format(i), '1.0', ts, 'new release', 100 + i)
+        for i in range(1, 8)
+    ] + [('gnusto', '1.0', ts, 'add py3 file gnusto-1.0-py3-none-any.whl', 108)]
+    def project_data(self, project):
+        raise RuntimeError('Simulated crash')
+    monkeypatch.setattr(
+        PyPIAPI, 'changelog_since_serial',
+        lambda self, since: [e for e in events if e[4] > since],
+    )
+    monkeypatch.setattr(PyPIAPI, 'project_data', project_data)
+    with pytest.raises(RuntimeError):
+        scan_changelog(100, events_per_commit=3)
+    db.session.rollback()
+    # The first two chunks were committed:
+    assert get_serial() == 106
+    assert sorted(v.project.name for v in Version.query) \
+        == sorted('proj{}'.format(i) for i in range(1, 7))
@@ -1,6 +1,7 @@
 import pytest
 from   wheelodex.util import VersionNoDot, glob2like, latest_version, \
-                                wheel_sort_key
+                                nodot_key, version_sort_key, \
+                                version_sort_string, wheel_sort_key
 
 @pytest.mark.parametrize('versions,latest', [
     ([], None),
@@ -12,6 +13,29 @@ from   wheelodex.util import VersionNoDot, glob2like, latest_version, \
 def test_latest_version(versions, latest):
     assert latest_version(versions) == latest
 
+# In ascending order; adjacent entries in the same sublist are equal
+VERSION_ORDER = [
+    ['1.0.dev0'], ['1.0a1.dev1'], ['1.0a1'], ['1.0b1'], ['1.0rc1'],
+    ['1.0rc1.post1'], ['1.0c2'], ['1.0.post1.dev2'], ['2013b'], ['banana'],
+    ['french toast'], ['r123'], ['0.9.x'], ['1.0_foo'], ['1.0-preview2x'],
+    ['1.0.0.0-final'], ['1.0-r1-foo'], ['1.0-SNAPSHOT'], ['1.0.x', '1.00.x'],
+    ['2.0-final'], ['10.0.x'], ['2013-02-14'],
+    ['0', '0.0'], ['0.9'], ['1', '1.0', '1.0.0'], ['1.0+ab'], ['1.0+abc'],
+    ['1.0+abc.def'], ['1.0+abc.5'], ['1.0+1'], ['1.0+1.2'], ['1.0+5'],
+    ['1.0.post0'], ['1.0.post1'], ['1.0.1'], ['9.9.9'], ['10.0'],
+    ['100000000000000000000'], ['1!0.5'], ['2!0.1'],
+]
+
+def test_version_sort_string():
+    for i, vs1 in enumerate(VERSION_ORDER):
+        for j, vs2 in enumerate(VERSION_ORDER):
+            for v1 in vs1:
+                for v2 in vs2:
+                    k1, k2 = version_sort_key(v1), version_sort_key(v2)
+                    s1, s2 = version_sort_string(v1), version_sort_string(v2)
+                    assert (k1 < k2) == (s1 < s2) == (i < j)
+                    assert (k1 == k2) == (s1 == s2) == (i == j)
+
 # In ascending order
 WHEEL_PREFERENCES = [
     'foo-1.0-nonsense-nonsense-nonsense.whl',
@@ -104,6 +128,7 @@ VERSIONS_NO_DOTS = [
 )
 def test_version_no_dot(lower, higher):
     assert VersionNoDot(lower) < VersionNoDot(higher)
+    assert nodot_key(lower) < nodot_key(higher)
 
 @pytest.mark.parametrize('glob,like', [
     ('python*', 'python%'),
@@ -1,21 +1,27 @@
-from   configparser  import ConfigParser
-from   datetime      import datetime, timedelta, timezone
+from   configparser    import ConfigParser
+from   contextlib      import ExitStack
+from   itertools       import islice
 import json
 import logging
+from   multiprocessing import Pool
 import click
-from   flask         import current_app
-from   flask.cli     import FlaskGroup
-from   flask_migrate import stamp
-from   pkg_resources import resource_filename
-from   sqlalchemy    import inspect
-from   .             import __version__
-from   .app          import create_app
-from   .models       import EntryPointGroup, OrphanWheel, Wheel, db
-from   .dbutil       import dbcontext, add_wheel, add_wheel_from_json, \
-                                get_serial, purge_old_versions, set_serial
-from   .process      import process_queue
-from   .pypi_api     import PyPIAPI
-from   .scan         import scan_pypi, scan_changelog
+from   flask           import current_app
+from   flask.cli       import FlaskGroup
+from   flask_migrate   import stamp
+from   pkg_resources   import resource_filename
+import pyrfc3339
+from   sqlalchemy      import inspect
+from   .               import __version__
+from   .app            import create_app
+from   .cache          import InspectionCache
+from   .models         import EntryPointGroup, db
+from   .dbutil         import dbcontext, add_wheel_from_json, \
+                                add_wheels_from_json, get_scan_checkpoint, \
+                                get_serial, iterwheels, purge_old_versions, \
+                                remove_wheel, set_serial, tombstones_since
+from   .process        import pipeline_queue, process_queue, reprocess_stale
+from   .scan           import process_orphan_wheels, scan_pypi, \
+                                scan_changelog
 
 log = logging.getLogger(__name__)
 
@@ -63,42 +69,199 @@ def initdb(force):
         click.echo('Database appears to already be initialized; doing nothing')
 
 @main.command('scan-pypi')
-def scan_pypi_cmd():
+@click.option('-w', '--workers', type=click.IntRange(min=1),
+              help='Number of projects to fetch from the JSON API at once')
+@click.option('--batch-size', type=click.IntRange(min=1),
+              help='Number of projects to scan between commits')
+@click.option('--resume', is_flag=True,
+              help='Continue an interrupted scan from its last checkpoint')
+def scan_pypi_cmd(workers, batch_size, resume):
     """ Scan all PyPI projects for wheels """
+    if workers is None:
+        workers = current_app.config["WHEELODEX_JSON_API_WORKERS"]
+    if batch_size is None:
+        batch_size = current_app.config["WHEELODEX_SCAN_BATCH_SIZE"]
     with dbcontext():
-        scan_pypi()
+        if resume and get_scan_checkpoint() is None:
+            raise click.UsageError('No scan checkpoint to resume from')
+        scan_pypi(workers=workers, batch_size=batch_size, resume=resume)
 
 @main.command('scan-changelog')
-def scan_changelog_cmd():
+@click.option('-w', '--workers', type=click.IntRange(min=1),
+              help='Number of projects to fetch from the JSON API at once')
+@click.option('--events-per-commit', type=click.IntRange(min=1),
+              help='Number of events to apply between commits')
+def scan_changelog_cmd(workers, events_per_commit):
     """ Scan the PyPI changelog for new wheels """
+    if workers is None:
+        workers = current_app.config["WHEELODEX_JSON_API_WORKERS"]
+    if events_per_commit is None:
+        events_per_commit \
+            = current_app.config["WHEELODEX_CHANGELOG_EVENTS_PER_COMMIT"]
     with dbcontext():
         serial = get_serial()
         if serial is None:
             raise click.UsageError('No saved state to update')
-        scan_changelog(serial)
+        scan_changelog(
+            serial,
+            workers           = workers,
+            events_per_commit = events_per_commit,
+        )
 
 @main.command('process-queue')
 @click.option('-S', '--max-wheel-size', type=int,
               help='Maximum size of wheels to process')
-def process_queue_cmd(max_wheel_size):
+@click.option('-P', '--partial', is_flag=True, default=None,
+              help='Analyze just the metadata of wheels over the maximum size')
+@click.option('-w', '--workers', type=click.IntRange(min=1),
+              help='Number of wheels to process concurrently')
+@click.option('--lease-batch', type=click.IntRange(min=1),
+              help='Claim wheels in leased batches of this size so that'
+                   ' multiple hosts can process the queue at once')
+@click.option('--commit-batch', type=click.IntRange(min=1),
+              help='Number of wheels to process per database transaction')
+@click.option('--pipeline', is_flag=True,
+              help='Overlap downloading & analysis with an asyncio pipeline')
+@click.option('--downloads', type=click.IntRange(min=1),
+              help='[pipeline] Number of wheels to download concurrently')
+@click.option('--inspectors', type=click.IntRange(min=1),
+              help='[pipeline] Number of processes for analyzing wheels')
+@click.option('--max-buffer-size', type=int,
+              help='[pipeline] Maximum total size of wheels on disk at once')
+def process_queue_cmd(max_wheel_size, partial, workers, lease_batch,
+                      commit_batch, pipeline, downloads, inspectors,
+                      max_buffer_size):
     """
     Analyze new wheels.
 
     This command downloads & analyzes wheels that have been registered but not
     analyzed yet and adds their data to the database.  Only wheels for the
     latest nonempty version of each project are analyzed.
+
+    With ``--partial``, wheels larger than the maximum wheel size are not
+    skipped but instead analyzed by downloading only their ``*.dist-info``
+    directories (using HTTP range requests).
+
+    With ``--lease-batch``, workers claim wheels from the queue in batches,
+    with each claim expiring after a configured number of seconds; this allows
+    multiple instances of this command to process the same queue at once.
+
+    With ``--pipeline``, downloads run concurrently in the background while
+    already-downloaded wheels are analyzed by a pool of processes; the
+    concurrency is then set with ``--downloads`` and ``--inspectors`` instead
+    of ``--workers``.
     """
     if max_wheel_size is None:
         # Setting the option's default to the below expression or a
         # lambdafication thereof doesn't work:
         max_wheel_size = current_app.config.get("WHEELODEX_MAX_WHEEL_SIZE")
+    if partial is None:
+        partial = current_app.config["WHEELODEX_PARTIAL_LARGE_WHEELS"]
+    if pipeline and workers is not None:
+        raise click.UsageError(
+            '--pipeline and --workers are incompatible; use --downloads and'
+            ' --inspectors instead'
+        )
+    if workers is None:
+        workers = current_app.config["WHEELODEX_PROCESS_WORKERS"]
+    if commit_batch is None:
+        commit_batch = current_app.config["WHEELODEX_COMMIT_BATCH_SIZE"]
+    if downloads is None:
+        downloads = current_app.config["WHEELODEX_PIPELINE_DOWNLOADS"]
+    if inspectors is None:
+        inspectors = current_app.config["WHEELODEX_PIPELINE_INSPECTORS"]
+    if max_buffer_size is None:
+        max_buffer_size \
+            = current_app.config["WHEELODEX_PIPELINE_MAX_BUFFER_SIZE"]
+    if pipeline and lease_batch is not None:
+        raise click.UsageError('--pipeline and --lease-batch are incompatible')
+    cache = get_inspection_cache()
     with dbcontext():
-        process_queue(max_wheel_size=max_wheel_size)
+        if pipeline:
+            pipeline_queue(
+                max_wheel_size  = max_wheel_size,
+                downloads       = downloads,
+                inspectors      = inspectors,
+                max_buffer_size = max_buffer_size,
+                partial         = partial,
+                commit_batch    = commit_batch,
+                cache           = cache,
+            )
+        else:
+            process_queue(
+                max_wheel_size = max_wheel_size,
+                workers        = workers,
+                partial        = partial,
+                lease_batch    = lease_batch,
+                lease_seconds  = current_app.config["WHEELODEX_LEASE_SECONDS"],
+                commit_batch   = commit_batch,
+                cache          = cache,
+            )
+
+@main.command()
+@click.option('-S', '--max-wheel-size', type=int,
+              help='Maximum size of wheels to process')
+@click.option('-P', '--partial', is_flag=True, default=None,
+              help='Analyze just the metadata of wheels over the maximum size')
+@click.option('-n', '--limit', type=click.IntRange(min=1),
+              help='Maximum number of wheels to reanalyze')
+@click.option('-r', '--rate', type=click.FloatRange(min=0),
+              help='Maximum number of wheels to reanalyze per minute')
+def reprocess(max_wheel_size, partial, limit, rate):
+    """
+    Reanalyze wheels analyzed with older versions of wheel-inspect.
+
+    This command finds wheels whose data was produced by a version of
+    wheel-inspect other than the one currently installed and analyzes them
+    again, replacing their data in place.  Wheels for the latest version of
+    each project are reanalyzed first.  Run this command periodically (e.g.,
+    from cron) with ``--limit`` and/or ``--rate`` to refresh the data in the
+    background after upgrading wheel-inspect.
+    """
+    if max_wheel_size is None:
+        max_wheel_size = current_app.config.get("WHEELODEX_MAX_WHEEL_SIZE")
+    if partial is None:
+        partial = current_app.config["WHEELODEX_PARTIAL_LARGE_WHEELS"]
+    if rate is None:
+        rate = current_app.config["WHEELODEX_REPROCESS_RATE"]
+    with dbcontext():
+        reprocess_stale(
+            max_wheel_size = max_wheel_size,
+            partial        = partial,
+            limit          = limit,
+            rate           = rate,
+            cache          = get_inspection_cache(),
+        )
+
+def get_inspection_cache():
+    """
+    Returns an `InspectionCache` as configured by the current application's
+    config, or `None` if no cache is configured
+    """
+    if current_app.config["WHEELODEX_INSPECTION_CACHE_DIR"] is not None:
+        return InspectionCache(
+            current_app.config["WHEELODEX_INSPECTION_CACHE_DIR"],
+            current_app.config["WHEELODEX_INSPECTION_CACHE_MAX_SIZE"],
+        )
+    else:
+        return None
+
+def parse_timestamp(ctx, param, value):
+    """ Parse an RFC 3339 timestamp given as the value of a command option """
+    if value is None:
+        return None
+    try:
+        return pyrfc3339.parse(value)
+    except ValueError:
+        raise click.BadParameter('{!r}: not an RFC 3339 timestamp'
+                                 .format(value))
 
 @main.command()
 @click.option('-A', '--all', 'dump_all', is_flag=True, help='Dump all wheels')
 @click.option('-o', '--outfile', default='-', help='File to dump to')
-def dump(dump_all, outfile):
+@click.option('--since', metavar='TIMESTAMP', callback=parse_timestamp,
+              help='Only dump wheels changed or removed since the given time')
+def dump(dump_all, outfile, since):
     """
     Dump wheel data as line-delimited JSON.
 
@@ -108,54 +271,104 @@ def dump(dump_all, outfile):
     include registered wheels that have not yet been analyzed.
 
     The output format is a stream of newline-delimited one-line JSON objects.
-    The order in which the wheels are output is undefined.
+    The wheels are output in the order in which they were registered.
 
     If the output filename contains the substring "%(serial)s", it is replaced
     with the serial ID of the last seen PyPI event.
+
+    With ``--since TIMESTAMP`` (an RFC 3339 timestamp), only the wheels that
+    were registered, analyzed, or had processing errors after the given time
+    are output, preceded by a ``{"removed": {"filename": ..., "timestamp":
+    ...}}`` object for each wheel that was removed from the database after
+    that time.  Such an incremental dump can be applied to a database
+    containing an earlier dump with the `load` command.
     """
     with dbcontext():
         outfile %= {"serial": get_serial()}
+        encoder = json.JSONEncoder()
         with click.open_file(outfile, 'w') as fp:
-            q = Wheel.query
-            if not dump_all:
-                q = q.filter(Wheel.data.has())
-            # Dumping in pages gives a needed efficiency boost:
-            q = q.paginate(page=1, per_page=100)
-            ### TODO: Should the query be ordered by something?
-            while True:
-                for whl in q.items:
-                    click.echo(json.dumps(whl.as_json()), file=fp)
-                if q.has_next:
-                    q = q.next()  # noqa: B305
-                else:
-                    break
+            if since is not None:
+                for tomb in tombstones_since(since):
+                    fp.write(encoder.encode(tomb.as_json()))
+                    fp.write('\n')
+            for whl in iterwheels(data_only=not dump_all, since=since):
+                fp.write(encoder.encode(whl.as_json()))
+                fp.write('\n')
 
 @main.command()
 @click.option('-S', '--serial', type=int,
               help='Also update PyPI serial to given value')
+@click.option('-B', '--bulk', is_flag=True,
+              help='Add wheels in bulk, committing after each chunk')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=1000,
+              show_default=True,
+              help='Number of wheels per chunk in --bulk mode')
+@click.option('-J', '--jobs', type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help='Number of processes for parsing JSON in --bulk mode')
 @click.argument('infile', type=click.File())
-def load(infile, serial):
+def load(infile, serial, bulk, chunk_size, jobs):
     """
     Load wheel data from line-delimited JSON.
 
     This command reads a file of JSONified wheel data, such as produced by
     the `dump` command, and adds the wheels to the database.  Wheels in the
-    database that already have data are not modified.
+    database that already have data are only modified if the input contains
+    newer data for them, and wheels listed as removed in an incremental dump
+    are deleted.
+
+    With ``--bulk``, the input is read ``--chunk-size`` lines at a time, and
+    each chunk is added to the database with a small number of bulk queries
+    and then committed; this is much faster when restoring a large dump.  The
+    parsing of the JSON can additionally be spread across multiple processes
+    with ``--jobs``.
     """
     with dbcontext(), infile:
         if serial is not None:
             set_serial(serial)
-        for line in infile:
-            add_wheel_from_json(json.loads(line))
+        if not bulk:
+            for line in infile:
+                about = json.loads(line)
+                if "removed" in about:
+                    remove_wheel(about["removed"]["filename"])
+                else:
+                    add_wheel_from_json(about)
+            return
+        with ExitStack() as stack:
+            if jobs > 1:
+                pool = stack.enter_context(Pool(jobs))
+                abouts = pool.imap(json.loads, infile, chunksize=64)
+            else:
+                abouts = map(json.loads, infile)
+            while True:
+                chunk = list(islice(abouts, chunk_size))
+                if not chunk:
+                    break
+                # Incremental dumps list all removals before any wheels.
+                removed = 0
+                for about in chunk:
+                    if "removed" in about:
+                        remove_wheel(about["removed"]["filename"])
+                        removed += 1
+                added = add_wheels_from_json(
+                    [a for a in chunk if "removed" not in a]
+                )
+                db.session.commit()
+                db.session.expunge_all()
+                log.info(
+                    'Added %d new wheels, removed %d wheels', added, removed,
+                )
 
 @main.command('purge-old-versions')
 def purge_old_versions_cmd():
     """ Delete old versions from the database """
     with dbcontext():
-        purge_old_versions()
+        purge_old_versions(commit=True)
 
-@main.command()
-def process_orphan_wheels():
+@main.command('process-orphan-wheels')
+@click.option('-w', '--workers', type=click.IntRange(min=1),
+              help='Number of projects to query PyPI about at once')
+def process_orphan_wheels_cmd(workers):
     """
     Register or expire orphan wheels.
 
@@ -165,36 +378,13 @@ def process_orphan_wheels():
     configured number of seconds are considered expired and deleted from the
     database.
     """
-    log.info('BEGIN process_orphan_wheels')
-    pypi = PyPIAPI()
-    max_age = current_app.config["WHEELODEX_MAX_ORPHAN_AGE_SECONDS"]
+    if workers is None:
+        workers = current_app.config["WHEELODEX_JSON_API_WORKERS"]
     with dbcontext():
-        for orphan in OrphanWheel.query:
-            data = pypi.asset_data(
-                orphan.project.name,
-                orphan.version.display_name,
-                orphan.filename,
-            )
-            if data is not None:
-                log.info('Wheel %s: data found', orphan.filename)
-                add_wheel(
-                    version  = orphan.version,
-                    filename = data["filename"],
-                    url      = data["url"],
-                    size     = data["size"],
-                    md5      = data["digests"].get("md5").lower(),
-                    sha256   = data["digests"].get("sha256").lower(),
-                    uploaded = str(data["upload_time"]),
-                )
-                db.session.delete(orphan)
-            else:
-                log.info('Wheel %s: data not found', orphan.filename)
-        expired = OrphanWheel.query.filter(
-            OrphanWheel.uploaded
-                < datetime.now(timezone.utc) - timedelta(seconds=max_age)
-        ).delete()
-        log.info('%d orphan wheels expired', expired)
-    log.info('END process_orphan_wheels')
+        process_orphan_wheels(
+            max_age = current_app.config["WHEELODEX_MAX_ORPHAN_AGE_SECONDS"],
+            workers = workers,
+        )
 
 @main.command()
 @click.argument(
@@ -7,10 +7,23 @@ DEFAULT_CONFIG = {
     "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
     "SQLALCHEMY_TRACK_MODIFICATIONS": False,
     "WHEELODEX_MAX_WHEEL_SIZE": None,
+    "WHEELODEX_PARTIAL_LARGE_WHEELS": False,
+    "WHEELODEX_PROCESS_WORKERS": 1,
+    "WHEELODEX_LEASE_SECONDS": 60*60,  # 1 hour
+    "WHEELODEX_COMMIT_BATCH_SIZE": 1,
+    "WHEELODEX_INSPECTION_CACHE_DIR": None,  # None = no cache
+    "WHEELODEX_INSPECTION_CACHE_MAX_SIZE": 1 << 30,  # 1 GiB
+    "WHEELODEX_REPROCESS_RATE": None,  # wheels per minute; None = no limit
+    "WHEELODEX_PIPELINE_DOWNLOADS": 4,
+    "WHEELODEX_PIPELINE_INSPECTORS": None,  # None = number of CPUs
+    "WHEELODEX_PIPELINE_MAX_BUFFER_SIZE": 1 << 30,  # 1 GiB
     "WHEELODEX_ENTRY_POINTS_PER_PAGE": 100,
     "WHEELODEX_ENTRY_POINT_GROUPS_PER_PAGE": 100,
     "WHEELODEX_RDEPENDS_PER_PAGE": 100,
     "WHEELODEX_MAX_ORPHAN_AGE_SECONDS": 2*24*60*60,  # 2 days
+    "WHEELODEX_JSON_API_WORKERS": 4,
+    "WHEELODEX_SCAN_BATCH_SIZE": 1000,
+    "WHEELODEX_CHANGELOG_EVENTS_PER_COMMIT": 1000,
     "WHEELODEX_PROJECTS_PER_PAGE": 100,
     "WHEELODEX_SEARCH_RESULTS_PER_PAGE": 100,
     "WHEELODEX_RECENT_WHEELS_QTY": 100,
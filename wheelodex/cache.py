@@ -0,0 +1,130 @@
+"""
+An on-disk cache of `inspect_wheel()` results
+
+Wheels are immutable, so the result of analyzing a wheel is determined
+entirely by the wheel's contents (identified by its SHA256 digest) and the
+version of ``wheel-inspect`` used to analyze it.  Caching results under that
+key lets a wheel that has been removed & re-registered, or that is being
+reprocessed, be analyzed again without downloading it.
+
+Only full analyses are cached.  The results of `process_wheel_partial()` are
+less thorough, so they are never stored, and a cached result can always be
+used in place of either kind of analysis.
+"""
+
+from   collections   import OrderedDict
+import json
+import logging
+import os
+import os.path
+from   tempfile      import NamedTemporaryFile
+import threading
+from   wheel_inspect import __version__ as wheel_inspect_version
+
+log = logging.getLogger(__name__)
+
+
+class InspectionCache:
+    """
+    A cache of `inspect_wheel()` results stored as JSON files under
+    ``directory``, keyed by the SHA256 digests of the wheels and the current
+    version of ``wheel-inspect``.  If ``max_size`` is set, the least recently
+    used entries are evicted whenever the total size of the cache files
+    exceeds that many bytes.  Instances are safe to share between threads.
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = os.path.join(directory, wheel_inspect_version)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        #: A mapping from the paths of the cache files to their sizes, in
+        #: order from least to most recently used
+        self.entries = OrderedDict()
+        self.total_size = 0
+        #: The number of lookups that found a cached result
+        self.hits = 0
+        #: The number of lookups that did not find a cached result
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for fname in filenames:
+                if fname.endswith('.json'):
+                    st = os.stat(os.path.join(dirpath, fname))
+                    files.append(
+                        (st.st_mtime, os.path.join(dirpath, fname), st.st_size)
+                    )
+        for _, path, size in sorted(files):
+            self.entries[path] = size
+            self.total_size += size
+
+    def path_for(self, sha256):
+        """
+        Returns the path of the cache file for the wheel with the given SHA256
+        digest
+        """
+        return os.path.join(self.directory, sha256[:2], sha256 + '.json')
+
+    def get(self, sha256, filename):
+        """
+        Returns the cached `inspect_wheel()` result for the wheel named
+        ``filename`` with the given SHA256 digest, or `None` if there is no
+        such result
+        """
+        if not sha256:
+            return None
+        path = self.path_for(sha256.lower())
+        try:
+            with open(path) as fp:
+                about = json.load(fp)
+        except (OSError, ValueError):
+            about = None
+        # The same bytes could conceivably be uploaded under a different
+        # filename, in which case the filename-derived fields won't match.
+        if about is None or about.get("filename") != filename:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            if path in self.entries:
+                self.entries.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        log.info('Using cached analysis of %s', filename)
+        return about
+
+    def put(self, sha256, about):
+        """
+        Store the `inspect_wheel()` result ``about`` for the wheel with the
+        given SHA256 digest in the cache, evicting older entries as needed
+        """
+        if not sha256:
+            return
+        path = self.path_for(sha256.lower())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and then move it into place so that
+        # readers never see a partially-written entry:
+        with NamedTemporaryFile(
+            'w', dir=os.path.dirname(path), suffix='.tmp', delete=False,
+        ) as fp:
+            json.dump(about, fp)
+        size = os.path.getsize(fp.name)
+        os.replace(fp.name, path)
+        with self.lock:
+            self.total_size += size - self.entries.pop(path, 0)
+            self.entries[path] = size
+            evicted = []
+            while self.max_size is not None \
+                    and self.total_size > self.max_size \
+                    and len(self.entries) > 1:
+                oldpath, oldsize = self.entries.popitem(last=False)
+                self.total_size -= oldsize
+                evicted.append(oldpath)
+        for oldpath in evicted:
+            try:
+                os.remove(oldpath)
+            except FileNotFoundError:
+                pass
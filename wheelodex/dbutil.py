@@ -5,17 +5,24 @@ All of these functions require a Flask application context with a database
 connection to be in effect.
 """
 
+from   collections     import defaultdict
 from   contextlib      import contextmanager
-from   datetime        import datetime, timezone
+from   datetime        import datetime, timedelta, timezone
 import logging
-from   typing          import Optional, Union
+import time
+from   typing          import Iterator, Optional, Union
 from   packaging.utils import canonicalize_name as normalize, \
                                 canonicalize_version as normversion
 import pyrfc3339
-from   sqlalchemy.orm  import aliased
-from   .models         import OrphanWheel, Project, PyPISerial, Version, \
-                                Wheel, WheelData, db, dependency_tbl
-from   .util           import version_sort_key, wheel_sort_key
+from   sqlalchemy      import inspect
+from   sqlalchemy.orm  import aliased, joinedload, selectinload
+from   wheel_inspect   import __version__ as wheel_inspect_version
+from   .models         import EntryPointGroup, NameCache, OrphanWheel, \
+                                ProcessingError, Project, PyPISerial, \
+                                QueueState, ScanCheckpoint, Version, Wheel, \
+                                WheelData, WheelTombstone, bulk_insert, db, \
+                                dependency_tbl
+from   .util           import version_sort_string, wheel_sort_key
 
 log = logging.getLogger(__name__)
 
@@ -50,15 +57,64 @@ def set_serial(value: int):
     else:
         ps.serial = max(ps.serial, value)
 
-def add_wheel(version: 'Version', filename, url, size, md5, sha256, uploaded):
+def get_scan_checkpoint() -> Optional[ScanCheckpoint]:
+    """
+    Returns the checkpoint of the current or interrupted `scan_pypi()` run, if
+    any
+    """
+    return ScanCheckpoint.query.one_or_none()
+
+def start_scan_checkpoint(serial: int) -> ScanCheckpoint:
+    """
+    Replace any existing scan checkpoint with a new one for a scan that
+    started at PyPI serial ID ``serial`` and return it
+    """
+    ScanCheckpoint.query.delete()
+    checkpoint = ScanCheckpoint(serial=serial)
+    db.session.add(checkpoint)
+    return checkpoint
+
+def add_wheel(version: 'Version', filename, url, size, md5, sha256, uploaded,
+              registered: Optional[datetime] = None):
     r"""
     Registers a wheel for the given `Version` and updates the ``ordering``
-    values for the `Version`'s `Wheel`\ s.  The new `Wheel` object is returned.
-    If a wheel with the given filename is already registered, no change is made
-    to the database, and the already-registered wheel is returned.
+    values for the `Version`'s `Wheel`\ s and the ``state`` values for the
+    `Project`'s `Wheel`\ s.  The new `Wheel` object is returned.  If a wheel
+    with the given filename is already registered, no change is made to the
+    database, and the already-registered wheel is returned.
+
+    The new wheel's position is found with a binary search over the
+    `Version`'s existing wheels (which are assumed to already be in order),
+    and only the wheels that sort after it have their ``ordering`` values
+    changed.
+
+    :param datetime registered: the time at which the wheel was registered;
+        defaults to the current time
     """
     whl = Wheel.query.filter(Wheel.filename == filename).one_or_none()
     if whl is None:
+        ### TODO: Is `version.wheels` safe to use when some of its elements
+        ### may have been deleted earlier in the transaction?
+        extant = sorted(version.wheels, key=lambda x: x.ordering)
+        key = wheel_sort_key(filename)
+        # Find the position after all wheels that sort less than or equal to
+        # the new wheel, computing sort keys only for the wheels compared
+        # against:
+        lo, hi = 0, len(extant)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < wheel_sort_key(extant[mid].filename):
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo < len(extant):
+            ordering = extant[lo].ordering
+            for w in extant[lo:]:
+                w.ordering += 1
+        elif extant:
+            ordering = extant[-1].ordering + 1
+        else:
+            ordering = 0
         whl = Wheel(
             version  = version,
             filename = filename,
@@ -67,64 +123,551 @@ def add_wheel(version: 'Version', filename, url, size, md5, sha256, uploaded):
             md5      = md5,
             sha256   = sha256,
             uploaded = uploaded,
+            ordering = ordering,
         )
+        if registered is not None:
+            whl.registered = registered
         db.session.add(whl)
-        for i,w in enumerate(
-            ### TODO: Is `version.wheels` safe to use when some of its elements
-            ### may have been deleted earlier in the transaction?
-            sorted(version.wheels, key=lambda x: wheel_sort_key(x.filename))
-        ):
-            w.ordering = i
+        update_queue_states(version.project)
     return whl
 
 def add_wheel_from_json(about: dict):
     """
     Add a wheel (possibly with data) from a structure produced by
-    `Wheel.as_json()`
+    `Wheel.as_json()`.  If the wheel is already registered, its data is only
+    replaced if the structure's data is newer.  A newly-registered wheel's
+    ``registered`` timestamp is taken from the structure if present.
     """
     version = add_version(
         about["pypi"].pop("project"),
         about["pypi"].pop("version"),
     )
-    whl = add_wheel(version, **about["pypi"])
-    if "data" in about and whl.data is None:
-        whl.set_data(about["data"])
-        whl.data.processed = pyrfc3339.parse(about["wheelodex"]["processed"])
-        whl.data.wheel_inspect_version \
-            = about["wheelodex"]["wheel_inspect_version"]
+    whl = add_wheel(version, registered=_registered(about), **about["pypi"])
+    if "data" in about:
+        processed = pyrfc3339.parse(about["wheelodex"]["processed"])
+        if whl.data is None or _as_aware(whl.data.processed) < processed:
+            whl.set_data(about["data"])
+            whl.data.processed = processed
+            whl.data.wheel_inspect_version \
+                = about["wheelodex"]["wheel_inspect_version"]
+
+def _registered(about: dict) -> Optional[datetime]:
+    registered = about.get("wheelodex", {}).get("registered")
+    return pyrfc3339.parse(registered) if registered is not None else None
+
+def _as_aware(dt: datetime) -> datetime:
+    # SQLite doesn't store time zones, but all of our timestamps are in UTC.
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+def add_wheels_from_json(abouts: list) -> int:
+    r"""
+    Add wheels (possibly with data) from a list of structures produced by
+    `Wheel.as_json()`.  The result is the same as calling
+    `add_wheel_from_json()` on each structure in turn, but the existing
+    projects, versions, and wheels are looked up with one query per
+    `NameCache.CHUNK_SIZE` names, the new `Version`\ s, `Wheel`\ s, and
+    `WheelData`\ s are written with bulk Core inserts, and the wheels'
+    ``ordering`` and ``state`` values are recomputed once per affected
+    version & project rather than once per wheel.
+
+    As the new rows are written directly to the database, any `Project`\ s,
+    `Version`\ s, or `Wheel`\ s already loaded into the session are expired
+    afterwards, and any objects that were only loaded or created in order to
+    look up their IDs are expunged from the session.
+
+    :return: the number of new wheels registered
+    """
+    new = {}
+    for about in abouts:
+        new.setdefault(about["pypi"]["filename"], about)
+    for filenames in _chunks(list(new)):
+        for fname, in db.session.query(Wheel.filename)\
+                                .filter(Wheel.filename.in_(filenames)):
+            # Wheels that are already registered only need their data added
+            # (if any), which is done the slow way, as it should be rare:
+            add_wheel_from_json(new.pop(fname))
+    if not new:
+        return 0
+    db.session.flush()
+    before = set(db.session.identity_map.keys())
+
+    project_ids = NameCache.for_model(Project).get_ids({
+        about["pypi"]["project"] for about in new.values()
+    })
+    versions = {}
+    for about in new.values():
+        versions.setdefault(
+            (
+                project_ids[about["pypi"]["project"]],
+                normversion(about["pypi"]["version"]),
+            ),
+            about["pypi"]["version"],
+        )
+    version_ids = _get_version_ids(versions)
+    bulk_insert(Version.__table__, [
+        {
+            "project_id": pid,
+            "name": vnorm,
+            "display_name": versions[pid, vnorm],
+            "sort_key": version_sort_string(vnorm),
+        }
+        for pid, vnorm in versions if (pid, vnorm) not in version_ids
+    ])
+    version_ids = _get_version_ids(versions)
+
+    now = datetime.now(timezone.utc)
+    wheel_rows = []
+    for fname, about in new.items():
+        pypi = about["pypi"]
+        wheel_rows.append({
+            "filename": fname,
+            "url": pypi["url"],
+            "version_id": version_ids[
+                project_ids[pypi["project"]], normversion(pypi["version"])
+            ],
+            "size": pypi["size"],
+            "md5": pypi["md5"],
+            "sha256": pypi["sha256"],
+            "uploaded": pypi["uploaded"],
+            "ordering": 0,
+            "lease_owner": None,
+            "lease_expires": None,
+            "registered": _registered(about) or now,
+            # Wheels without data are put in the queue (if appropriate) by
+            # `update_queue_states()` below.
+            "state": QueueState.DONE if "data" in about
+                                     else QueueState.SUPERSEDED,
+        })
+    bulk_insert(Wheel.__table__, wheel_rows)
+    wheel_ids = {}
+    for filenames in _chunks(list(new)):
+        wheel_ids.update(
+            db.session.query(Wheel.filename, Wheel.id)
+                      .filter(Wheel.filename.in_(filenames))
+        )
+
+    with_data = [
+        (fname, about) for fname, about in new.items() if "data" in about
+    ]
+    bulk_insert(WheelData.__table__, [
+        {
+            "wheel_id": wheel_ids[fname],
+            "raw_data": about["data"],
+            "processed": pyrfc3339.parse(about["wheelodex"]["processed"]),
+            "wheel_inspect_version":
+                about["wheelodex"]["wheel_inspect_version"],
+            "valid": about["data"]["valid"],
+        }
+        for fname, about in with_data
+    ])
+    data_ids = {}
+    for wids in _chunks([wheel_ids[fname] for fname, _ in with_data]):
+        data_ids.update(
+            db.session.query(WheelData.wheel_id, WheelData.id)
+                      .filter(WheelData.wheel_id.in_(wids))
+        )
+    WheelData.insert_related([
+        (data_ids[wheel_ids[fname]], about["data"])
+        for fname, about in with_data
+    ])
+    # As with `Wheel.set_data()`, the last wheel with data for each project
+    # determines the project's summary:
+    summaries = {}
+    for _, about in with_data:
+        summary = about["data"]["dist_info"].get("metadata", {}).get("summary")
+        summaries[project_ids[about["pypi"]["project"]]] \
+            = summary[:2048] if summary is not None else None
+    if summaries:
+        db.session.execute(
+            Project.__table__.update()
+                             .where(Project.id == db.bindparam('_id'))
+                             .values(summary=db.bindparam('_summary')),
+            [{"_id": pid, "_summary": s} for pid, s in summaries.items()],
+        )
+
+    # Recompute the orderings of the wheels of the affected versions:
+    touched = {row["version_id"] for row in wheel_rows}
+    wheels_by_version = defaultdict(list)
+    for vids in _chunks(list(touched)):
+        for wid, vid, fname, ordering in db.session.query(
+            Wheel.id, Wheel.version_id, Wheel.filename, Wheel.ordering,
+        ).filter(Wheel.version_id.in_(vids)):
+            wheels_by_version[vid].append(
+                (wheel_sort_key(fname), wid, ordering)
+            )
+    reorderings = []
+    for wheels in wheels_by_version.values():
+        wheels.sort()
+        reorderings.extend(
+            {"_id": wid, "_ordering": i}
+            for i, (_, wid, ordering) in enumerate(wheels)
+            if ordering != i
+        )
+    if reorderings:
+        db.session.execute(
+            Wheel.__table__.update()
+                           .where(Wheel.id == db.bindparam('_id'))
+                           .values(ordering=db.bindparam('_ordering')),
+            reorderings,
+        )
+
+    _update_queue_states_bulk({pid for pid, _ in version_ids})
+    db.session.expire_all()
+    for key, obj in db.session.identity_map.items():
+        if key not in before:
+            db.session.expunge(obj)
+    return len(new)
+
+def _update_queue_states_bulk(project_ids):
+    r"""
+    Update the ``state`` values of the unprocessed `Wheel`\ s of the
+    `Project`\ s with the given IDs in the same way as
+    `update_queue_states()`, but with a fixed number of statements per
+    `NameCache.CHUNK_SIZE` projects.  The session is not synchronized with the
+    changes.
+    """
+    for pids in _chunks(list(project_ids)):
+        latest = {}
+        for vid, pid, sort_key in db.session.query(
+            Version.id, Version.project_id, Version.sort_key,
+        ).filter(Version.project_id.in_(pids)).filter(Version.wheels.any()):
+            if pid not in latest or latest[pid][0] < sort_key:
+                latest[pid] = (sort_key, vid)
+        if not latest:
+            continue
+        latest_ids = [vid for _, vid in latest.values()]
+        for vids in _chunks(latest_ids):
+            Wheel.query.filter(Wheel.version_id.in_(vids))\
+                       .filter(Wheel.state == QueueState.SUPERSEDED)\
+                       .update({"state": QueueState.PENDING},
+                               synchronize_session=False)
+        others = db.session.query(Version.id)\
+                           .filter(Version.project_id.in_(pids))\
+                           .filter(Version.id.notin_(latest_ids))
+        Wheel.query.filter(Wheel.version_id.in_(others.subquery()))\
+                   .filter(Wheel.state.in_([QueueState.PENDING,
+                                            QueueState.IN_PROGRESS]))\
+                   .update({"state": QueueState.SUPERSEDED},
+                           synchronize_session=False)
+
+def _get_version_ids(keys) -> dict:
+    r"""
+    Given an iterable of ``(project_id, normalized_version)`` pairs, return a
+    `dict` mapping those pairs to the IDs of the corresponding `Version`\ s,
+    omitting any that do not exist
+    """
+    keys = set(keys)
+    found = {}
+    for pids in _chunks(list({pid for pid, _ in keys})):
+        for vid, pid, name in db.session.query(
+            Version.id, Version.project_id, Version.name,
+        ).filter(Version.project_id.in_(pids)):
+            if (pid, name) in keys:
+                found[pid, name] = vid
+    return found
+
+def _chunks(seq: list) -> Iterator[list]:
+    """
+    Split ``seq`` into lists of at most `NameCache.CHUNK_SIZE` elements for
+    use in ``IN`` queries
+    """
+    for i in range(0, len(seq), NameCache.CHUNK_SIZE):
+        yield seq[i:i+NameCache.CHUNK_SIZE]
+
+def iterwheels(data_only=False, since=None, batch_size=1000) \
+        -> Iterator[Wheel]:
+    r"""
+    Returns an iterator over all `Wheel`\ s in order of ID, with each wheel's
+    `Version`, `Project`, `WheelData`, and `ProcessingError`\ s loaded in the
+    same queries as the wheel itself so that `Wheel.as_json()` doesn't need
+    to issue any queries of its own.
+
+    As with `iterqueue()`, the wheels are fetched lazily in batches of
+    ``batch_size``, each batch being queried starting after the last ID seen
+    so far, so the total time taken grows linearly with the number of wheels.
+
+    :param bool data_only: If true, only wheels with data are returned
+    :param datetime since: If set, only wheels that were registered, had
+        their data updated, or had a processing error after this time are
+        returned
+    :param int batch_size: the maximum number of wheels to fetch per query
+    """
+    last_id = None
+    while True:
+        q = Wheel.query.options(
+            joinedload(Wheel.version).joinedload(Version.project),
+            joinedload(Wheel.data),
+            selectinload(Wheel.errors),
+        )
+        if data_only:
+            q = q.filter(Wheel.data.has())
+        if since is not None:
+            q = q.filter(
+                (Wheel.registered > since)
+                | Wheel.data.has(WheelData.processed > since)
+                | Wheel.errors.any(ProcessingError.timestamp > since)
+            )
+        if last_id is not None:
+            q = q.filter(Wheel.id > last_id)
+        batch = q.order_by(Wheel.id.asc()).limit(batch_size).all()
+        if not batch:
+            return
+        last_id = batch[-1].id
+        yield from batch
+        del batch
+
+def tombstones_since(since: datetime):
+    r"""
+    Returns a query for the `WheelTombstone`\ s for wheels removed after the
+    given time, in order of removal
+    """
+    return WheelTombstone.query.filter(WheelTombstone.removed > since)\
+                               .order_by(WheelTombstone.removed.asc(),
+                                         WheelTombstone.id.asc())
+
+def add_tombstones(wheels):
+    r"""
+    Record `WheelTombstone`\ s for the `Wheel`\ s selected by the query
+    ``wheels``.  This must be called before the wheels are deleted.
+    """
+    db.session.execute(
+        WheelTombstone.__table__.insert().from_select(
+            ['filename', 'removed'],
+            wheels.with_entities(
+                Wheel.filename,
+                db.literal(
+                    datetime.now(timezone.utc),
+                    db.DateTime(timezone=True),
+                ),
+            ).statement,
+        )
+    )
 
-def iterqueue(max_wheel_size=None) -> [Wheel]:
+def iterqueue(max_wheel_size=None, batch_size=1000) -> Iterator[Wheel]:
     """
-    Returns the "queue" of wheels to process: a list of all wheels with neither
-    data nor errors for the latest nonempty (i.e., having wheels) version of
-    each project
+    Returns an iterator over the "queue" of wheels to process: all wheels with
+    neither data nor errors for the latest nonempty (i.e., having wheels)
+    version of each project, in order of ID.  Wheels currently claimed by a
+    worker via `claim_wheels()` are omitted.
+
+    The queue is fetched lazily in batches of ``batch_size`` wheels, each
+    batch being queried afresh starting after the last ID seen so far, so only
+    one batch of `Wheel` objects needs to be held in memory at a time, and the
+    session can safely be committed between wheels.  Wheels that are
+    processed or claimed elsewhere before their batch is fetched are skipped,
+    and wheels added to the queue with higher IDs than those already returned
+    are picked up.
 
     :param int max_wheel_size: If set, only wheels this size or smaller are
         returned
+    :param int batch_size: the maximum number of wheels to fetch per query
     """
-    subq = db.session.query(
-        Project.id,
-        db.func.max(Version.ordering).label('max_order'),
-    ).join(Version).join(Wheel).group_by(Project.id).subquery()
-    q = Wheel.query.join(Version)\
-                   .join(Project)\
-                   .join(subq, (Project.id == subq.c.id)
-                            & (Version.ordering == subq.c.max_order))\
-                   .filter(~Wheel.data.has())\
-                   .filter(~Wheel.errors.any())
+    last_id = None
+    while True:
+        q = queue_query(max_wheel_size=max_wheel_size)
+        if last_id is not None:
+            q = q.filter(Wheel.id > last_id)
+        batch = q.order_by(Wheel.id.asc()).limit(batch_size).all()
+        if not batch:
+            return
+        last_id = batch[-1].id
+        yield from batch
+        # Drop our references to the batch before fetching the next one so
+        # that the session's weak identity map can let go of the objects:
+        del batch
+
+def queue_query(max_wheel_size=None):
+    """
+    Returns a query object for the wheels returned by `iterqueue()`: the
+    `QueueState.PENDING` wheels plus any `QueueState.IN_PROGRESS` wheels whose
+    leases have expired.  No ordering is applied to the query.
+    """
+    q = Wheel.query.filter(
+        (Wheel.state == QueueState.PENDING)
+        | ((Wheel.state == QueueState.IN_PROGRESS)
+            & (Wheel.lease_expires < datetime.now(timezone.utc)))
+    )
     if max_wheel_size is not None:
         q = q.filter(Wheel.size <= max_wheel_size)
-    ### TODO: Would leaving off the ".all()" give an iterable that plays well
-    ### with wheels being given data concurrently?
-    return q.all()
+    return q
+
+def iter_stale_wheels(max_wheel_size=None, batch_size=1000) \
+        -> Iterator[Wheel]:
+    """
+    Returns an iterator over the wheels whose data was produced by a version
+    of ``wheel-inspect`` other than the one currently installed.  Wheels
+    belonging to the latest version with wheels of each project are returned
+    first, followed by the wheels for older versions; within each group, the
+    wheels are returned in order of ID, fetched lazily in batches of
+    ``batch_size`` as with `iterqueue()`.  Wheels that have had a processing
+    error since their data was last updated are skipped so that wheels that
+    can no longer be reanalyzed are not retried forever.
+
+    :param int max_wheel_size: If set, only wheels this size or smaller are
+        returned
+    :param int batch_size: the maximum number of wheels to fetch per query
+    """
+    subq = db.session.query(
+        Version.project_id,
+        db.func.max(Version.sort_key).label('max_key'),
+    ).join(Wheel).group_by(Version.project_id).subquery()
+    in_latest = Version.sort_key == subq.c.max_key
+    for latest in (True, False):
+        last_id = None
+        while True:
+            q = Wheel.query.join(WheelData)\
+                           .join(Version)\
+                           .join(subq, Version.project_id == subq.c.project_id)\
+                           .filter(in_latest if latest else ~in_latest)\
+                           .filter(WheelData.wheel_inspect_version
+                                   != wheel_inspect_version)\
+                           .filter(~Wheel.errors.any(
+                               ProcessingError.timestamp > WheelData.processed
+                           ))
+            if max_wheel_size is not None:
+                q = q.filter(Wheel.size <= max_wheel_size)
+            if last_id is not None:
+                q = q.filter(Wheel.id > last_id)
+            batch = q.order_by(Wheel.id.asc()).limit(batch_size).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            yield from batch
+            del batch
+
+def claim_wheels(owner: str, limit: int, lease_seconds: int,
+                 max_wheel_size=None) -> [Wheel]:
+    r"""
+    Atomically claim up to ``limit`` of the wheels in the queue (see
+    `iterqueue()`), leasing them to ``owner`` for ``lease_seconds`` seconds and
+    setting their states to `QueueState.IN_PROGRESS`, and return the claimed
+    `Wheel`\ s in order of ID.  Wheels whose leases have expired (e.g.,
+    because their worker crashed) are eligible to be claimed again.
+
+    The caller must commit the session promptly for the claims to be seen by
+    other workers.  ``owner`` must be unique to the calling worker.
+
+    :param int max_wheel_size: If set, only wheels this size or smaller are
+        claimed
+    """
+    expires = datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)
+    q = queue_query(max_wheel_size=max_wheel_size).order_by(Wheel.id.asc())\
+                                                  .limit(limit)
+    if db.session.bind.dialect.name == 'postgresql':
+        # Rows being claimed by other workers are locked, so skip them:
+        wheels = q.with_for_update(of=Wheel, skip_locked=True).all()
+        for whl in wheels:
+            whl.state = QueueState.IN_PROGRESS
+            whl.lease_owner = owner
+            whl.lease_expires = expires
+        db.session.flush()
+        return wheels
+    else:
+        # Without SKIP LOCKED, claim the candidates with a conditional UPDATE
+        # (which rechecks that they're still in the queue) so that any claimed
+        # by another worker in the meantime are left alone, and then see
+        # which ones we got.
+        ids = [wid for wid, in q.with_entities(Wheel.id)]
+        if not ids:
+            return []
+        queue_query(max_wheel_size=max_wheel_size)\
+            .filter(Wheel.id.in_(ids))\
+            .update(
+                {
+                    "state": QueueState.IN_PROGRESS,
+                    "lease_owner": owner,
+                    "lease_expires": expires,
+                },
+                synchronize_session=False,
+            )
+        return Wheel.query.populate_existing()\
+                          .filter(Wheel.id.in_(ids))\
+                          .filter(Wheel.lease_owner == owner)\
+                          .order_by(Wheel.id.asc())\
+                          .all()
 
 def remove_wheel(filename: str):
     r"""
     Delete all `Wheel`\ s and `OrphanWheel`\ s with the given filename from the
     database
     """
-    Wheel.query.filter(Wheel.filename == filename).delete()
-    OrphanWheel.query.filter(OrphanWheel.filename == filename).delete()
+    whl = Wheel.query.filter(Wheel.filename == filename).one_or_none()
+    if whl is not None:
+        project = whl.project
+        add_tombstones(Wheel.query.filter(Wheel.filename == filename))
+        bulk_delete(Wheel.query.filter(Wheel.filename == filename))
+        update_queue_states(project)
+    bulk_delete(OrphanWheel.query.filter(OrphanWheel.filename == filename))
+
+def bulk_delete(query):
+    r"""
+    Delete the rows selected by ``query`` (a query for a single model) with a
+    single ``DELETE`` statement and expunge the deleted objects from the
+    session, along with any `Wheel`\ s of deleted `Version`\ s (which the
+    database deletes by cascade).
+
+    The criteria are not evaluated against the objects in the session (as
+    `Query.delete()` does by default), as that would refresh every expired
+    object of the model in the session, failing for any whose rows no longer
+    exist.
+    """
+    model = query.column_descriptions[0]["entity"]
+    ids = {i for i, in query.with_entities(model.id)}
+    if not ids:
+        return
+    query.delete(synchronize_session=False)
+    # Only the objects' identities & loaded states are examined so as not to
+    # trigger any refreshes:
+    doomed = []
+    for obj in db.session.identity_map.values():
+        state = inspect(obj)
+        if isinstance(obj, model) and state.identity[0] in ids:
+            doomed.append(obj)
+        elif model is Version and isinstance(obj, Wheel) \
+                and state.dict.get("version_id") in ids:
+            doomed.append(obj)
+    for obj in doomed:
+        # Expunging a `Version` also expunges its loaded `Wheel`s.
+        if obj in db.session:
+            db.session.expunge(obj)
+
+def update_queue_states(project: Project):
+    r"""
+    Update the ``state`` values of the unprocessed `Wheel`\ s of the given
+    `Project` so that only those belonging to the latest version with wheels
+    are `QueueState.PENDING` and the rest are `QueueState.SUPERSEDED`.  This
+    needs to be called whenever a project's latest version with wheels may
+    have changed.
+    """
+    vids = [
+        vid for vid, in db.session.query(Version.id)
+                                  .filter(Version.project == project)
+                                  .filter(Version.wheels.any())
+                                  .order_by(Version.sort_key.desc())
+    ]
+    if not vids:
+        return
+    latest_id, others = vids[0], vids[1:]
+    # The session is synchronized by hand below rather than by the `UPDATE`s
+    # so as not to make them each issue an extra `SELECT`.
+    Wheel.query.filter(Wheel.version_id == latest_id)\
+               .filter(Wheel.state == QueueState.SUPERSEDED)\
+               .update({"state": QueueState.PENDING},
+                       synchronize_session=False)
+    if others:
+        # In-progress wheels are superseded as well so that their claims
+        # won't be renewed once they expire.
+        Wheel.query.filter(Wheel.version_id.in_(others))\
+                   .filter(Wheel.state.in_([QueueState.PENDING,
+                                            QueueState.IN_PROGRESS]))\
+                   .update({"state": QueueState.SUPERSEDED},
+                           synchronize_session=False)
+    vids = set(vids)
+    for obj in list(db.session.identity_map.values()):
+        if isinstance(obj, Wheel):
+            state = inspect(obj)
+            if state.persistent and state.dict.get("version_id") in vids:
+                db.session.expire(obj, ["state"])
 
 def add_project(name: str):
     """
@@ -134,6 +677,30 @@ def add_project(name: str):
     """
     return Project.from_name(name)
 
+def name_cache_stats() -> dict:
+    r"""
+    Returns a `dict` mapping `Project` and `EntryPointGroup` to the ``(hits,
+    misses)`` counts of the current session's `NameCache`\ s for them
+    """
+    stats = {}
+    for model in (Project, EntryPointGroup):
+        cache = NameCache.for_model(model)
+        stats[model] = (cache.hits, cache.misses)
+    return stats
+
+def log_name_cache_stats(*stats):
+    r"""
+    Log the hit & miss counts of the current session's `NameCache`\ s or, if
+    any ``stats`` (as returned by `name_cache_stats()`, e.g., for the sessions
+    of worker threads) are given, the totals of those
+    """
+    if not stats:
+        stats = [name_cache_stats()]
+    for model in (Project, EntryPointGroup):
+        log.info('%s name cache: %d hits, %d misses', model.__name__,
+                 sum(st[model][0] for st in stats),
+                 sum(st[model][1] for st in stats))
+
 def get_project(name: str):
     """
     Return the `Project` with the given name (*modulo* normalization), or
@@ -152,12 +719,12 @@ def remove_project(project: str):
     # PyPI changelog.
     p = get_project(project)
     if p is not None:
-        Version.query.filter(Version.project == p).delete()
+        add_tombstones(Wheel.query.join(Version).filter(Version.project == p))
+        bulk_delete(Version.query.filter(Version.project == p))
 
 def add_version(project: Union[str, 'Project'], version: str):
     r"""
-    Create a `Version` with the given project & version string and return it;
-    the ``ordering`` values for the project's `Version`\ s are updated as well.
+    Create a `Version` with the given project & version string and return it.
     If there already exists a version with the same details, do nothing and
     return that instead.
     """
@@ -168,14 +735,13 @@ def add_version(project: Union[str, 'Project'], version: str):
                      .filter(Version.name == vnorm)\
                      .one_or_none()
     if v is None:
-        v = Version(project=project, name=vnorm, display_name=version)
+        v = Version(
+            project      = project,
+            name         = vnorm,
+            display_name = version,
+            sort_key     = version_sort_string(vnorm),
+        )
         db.session.add(v)
-        for i,u in enumerate(
-            ### TODO: Is `project.versions` safe to use when some of its
-            ### elements may have been deleted earlier in the transaction?
-            sorted(project.versions, key=lambda x: version_sort_key(x.name))
-        ):
-            u.ordering = i
     return v
 
 def get_version(project: Union[str, 'Project'], version: str):
@@ -201,48 +767,82 @@ def remove_version(project: str, version: str):
     # "remove" events in the PyPI changelog.
     p = get_project(project)
     if p is not None:
-        Version.query.filter(Version.project == p)\
-                     .filter(Version.name == normversion(version))\
-                     .delete()
+        add_tombstones(
+            Wheel.query.join(Version)
+                       .filter(Version.project == p)
+                       .filter(Version.name == normversion(version))
+        )
+        bulk_delete(
+            Version.query.filter(Version.project == p)
+                         .filter(Version.name == normversion(version))
+        )
+        update_queue_states(p)
 
-def purge_old_versions():
-    """
+def purge_old_versions(batch_size=1000, commit=False):
+    r"""
     For each project, keep (a) the latest version, (b) the latest version with
     wheels registered, and (c) the latest version with wheel data, and delete
     all other versions.
+
+    The projects with more than one version are processed ``batch_size`` at
+    a time, each batch taking a fixed number of set-based SQL statements: the
+    versions to keep are found with window functions, and the rest are
+    deleted with a single ``DELETE`` (relying on the database's cascades to
+    delete their `Wheel`\ s etc.).  If ``commit`` is true, the session is
+    committed after each batch so that no single transaction grows too large.
     """
     log.info('BEGIN purge_old_versions')
-    for p in Project.query.join(Version)\
-                          .group_by(Project)\
-                          .having(db.func.count(Version.id) > 1):
-        latest = p.latest_version
-        log.info('Project %s: keeping latest version: %s',
-                 p.display_name, latest.display_name)
-        latest_wheel = Version.query.with_parent(p)\
-                                    .filter(Version.wheels.any())\
-                                    .order_by(Version.ordering.desc())\
-                                    .first()
-        if latest_wheel is not None:
-            log.info('Project %s: keeping latest version with wheels: %s',
-                     p.display_name, latest_wheel.display_name)
-            latest_data = Version.query.with_parent(p)\
-                                       .filter(Version.wheels.any(
-                                           Wheel.data.has()
-                                       ))\
-                                       .order_by(Version.ordering.desc())\
-                                       .first()
-            if latest_data is not None:
-                log.info('Project %s: keeping latest version with data: %s',
-                         p.display_name, latest_wheel.display_name)
-        else:
-            latest_data = None
-        for v in p.versions:
-            if v not in (latest, latest_wheel, latest_data):
-                log.info('Project %s: deleting version %s',
-                         p.display_name, v.display_name)
-                db.session.delete(v)
+    last_id = None
+    while True:
+        start = time.monotonic()
+        q = db.session.query(Version.project_id)\
+                      .group_by(Version.project_id)\
+                      .having(db.func.count(Version.id) > 1)
+        if last_id is not None:
+            q = q.filter(Version.project_id > last_id)
+        project_ids = [
+            pid for pid, in q.order_by(Version.project_id.asc())
+                             .limit(batch_size)
+        ]
+        if not project_ids:
+            break
+        last_id = project_ids[-1]
+        has_wheels = db.exists().where(Wheel.version_id == Version.id)
+        has_data = has_wheels.where(WheelData.wheel_id == Wheel.id)
+        keep = _latest_version_ids(project_ids).union(
+            _latest_version_ids(project_ids, has_wheels),
+            _latest_version_ids(project_ids, has_data),
+        ).subquery()
+        add_tombstones(
+            Wheel.query.join(Version)
+                       .filter(Version.project_id.in_(project_ids))
+                       .filter(Version.id.notin_(keep))
+        )
+        deleted = Version.query.filter(Version.project_id.in_(project_ids))\
+                               .filter(Version.id.notin_(keep))\
+                               .delete(synchronize_session=False)
+        if commit:
+            db.session.commit()
+        log.info('Deleted %d old versions of %d projects in %.3fs',
+                 deleted, len(project_ids), time.monotonic() - start)
+    db.session.expire_all()
     log.info('END purge_old_versions')
 
+def _latest_version_ids(project_ids, *criteria):
+    """
+    Returns a query for the IDs of the latest `Version` satisfying
+    ``criteria`` of each of the projects with the given IDs
+    """
+    rownum = db.func.row_number().over(
+        partition_by=Version.project_id,
+        order_by=Version.sort_key.desc(),
+    ).label('rownum')
+    ranked = db.session.query(Version.id.label('id'), rownum)\
+                       .filter(Version.project_id.in_(project_ids))\
+                       .filter(*criteria)\
+                       .subquery()
+    return db.session.query(ranked.c.id).filter(ranked.c.rownum == 1)
+
 def add_orphan_wheel(version: Version, filename, uploaded_epoch):
     """
     Register an `OrphanWheel` for the given version, with the given filename,
@@ -0,0 +1,178 @@
+"""Replace Version.ordering with Version.sort_key
+
+Revision ID: 5e2a9d7c41b3
+Revises: 9c4d2a6e1b87
+Create Date: 2018-11-10 19:42:05.318274+00:00
+
+"""
+from   itertools         import groupby, islice
+import re
+from   alembic           import op
+from   packaging.version import InvalidVersion, Version
+import sqlalchemy as S
+
+# revision identifiers, used by Alembic.
+revision = '5e2a9d7c41b3'
+down_revision = '9c4d2a6e1b87'
+branch_labels = None
+depends_on = None
+
+schema = S.MetaData()
+
+version = S.Table(
+    'versions', schema,
+    S.Column('id', S.Integer, primary_key=True, nullable=False),
+    S.Column('project_id', S.Integer, nullable=False),
+    S.Column('name', S.Unicode(2048), nullable=False),
+    S.Column('ordering', S.Integer, nullable=False, default=0),
+    S.Column('sort_key', S.Unicode(2048), nullable=True),
+)
+
+#: Number of rows to fetch & update at a time
+PAGE_SIZE = 1000
+
+# This is a frozen copy of `wheelodex.util.version_sort_string()` as of this
+# revision so that later changes to that function don't change what this
+# migration writes.
+def _sort_key(v):
+    # Each component of the key is written with a prefix-free encoding so that
+    # comparing the concatenated bytes is the same as comparing the tuples
+    # that `packaging` uses for its own comparisons.
+    try:
+        v = Version(v)
+    except InvalidVersion:
+        buf = bytearray([1, 0])
+        for part in _legacy_key(v):
+            buf.append(1)
+            _encode_str(buf, part)
+        buf.append(0)
+        return buf.hex()
+    buf = bytearray([int(not v.is_prerelease), 1])
+    _encode_int(buf, v.epoch)
+    release = list(v.release)
+    while release and release[-1] == 0:
+        release.pop()
+    for n in release:
+        buf.append(1)
+        _encode_int(buf, n)
+    buf.append(0)
+    if v.pre is not None:
+        buf.append(1)
+        _encode_str(buf, v.pre[0])
+        _encode_int(buf, v.pre[1])
+    elif v.post is None and v.dev is not None:
+        # "1.0.dev0" sorts before "1.0a0"
+        buf.append(0)
+    else:
+        buf.append(2)
+    if v.post is None:
+        buf.append(0)
+    else:
+        buf.append(1)
+        _encode_int(buf, v.post)
+    if v.dev is None:
+        buf.append(2)
+    else:
+        buf.append(1)
+        _encode_int(buf, v.dev)
+    if v.local is None:
+        buf.append(0)
+    else:
+        buf.append(1)
+        for part in v.local.split('.'):
+            # Numeric segments sort after alphanumeric ones
+            if part.isdigit():
+                buf.append(2)
+                _encode_int(buf, int(part))
+            else:
+                buf.append(1)
+                _encode_str(buf, part)
+        buf.append(0)
+    return buf.hex()
+
+_LEGACY_COMPONENT_RGX = re.compile(r'(\d+|[a-z]+|\.|-)')
+
+_LEGACY_REPLACEMENTS = {
+    "pre": "c",
+    "preview": "c",
+    "-": "final-",
+    "rc": "c",
+    "dev": "@",
+}
+
+def _legacy_key(v):
+    parts = []
+    for part in _LEGACY_COMPONENT_RGX.split(v.lower()):
+        part = _LEGACY_REPLACEMENTS.get(part, part)
+        if not part or part == '.':
+            continue
+        if part[:1].isdigit():
+            part = part.zfill(8)
+        else:
+            part = '*' + part
+            if part < '*final':
+                while parts and parts[-1] == '*final-':
+                    parts.pop()
+            while parts and parts[-1] == '00000000':
+                parts.pop()
+        parts.append(part)
+    while parts and parts[-1] == '00000000':
+        parts.pop()
+    parts.append('*final')
+    return tuple(parts)
+
+def _encode_int(buf, n):
+    b = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    buf.append(len(b))
+    buf.extend(b)
+
+def _encode_str(buf, s):
+    buf.extend(s.encode('utf-8'))
+    buf.append(0)
+
+def upgrade():
+    op.add_column('versions', S.Column('sort_key', S.Unicode(length=2048), nullable=True))
+    conn = op.get_bind()
+    update = version.update().values(sort_key=S.bindparam('key'))\
+                             .where(version.c.id == S.bindparam('vid'))
+    last_id = None
+    while True:
+        q = S.select([version.c.id, version.c.name])\
+             .order_by(version.c.id)\
+             .limit(PAGE_SIZE)
+        if last_id is not None:
+            q = q.where(version.c.id > last_id)
+        rows = conn.execute(q).fetchall()
+        if not rows:
+            break
+        conn.execute(
+            update,
+            [{"vid": vid, "key": _sort_key(name)} for vid, name in rows],
+        )
+        last_id = rows[-1][0]
+    op.alter_column('versions', 'sort_key', nullable=False)
+    op.create_index('ix_versions_project_id_sort_key', 'versions', ['project_id', 'sort_key'], unique=False)
+    op.drop_column('versions', 'ordering')
+
+def downgrade():
+    op.add_column('versions', S.Column('ordering', S.Integer(), nullable=False, server_default='0'))
+    conn = op.get_bind()
+    rows = conn.execute(
+        S.select([version.c.id, version.c.project_id])
+         .order_by(version.c.project_id, version.c.sort_key)
+    ).fetchall()
+    update = version.update().values(ordering=S.bindparam('new_ordering'))\
+                             .where(version.c.id == S.bindparam('vid'))
+    params = (
+        {"vid": vid, "new_ordering": i}
+        for _, vs in groupby(rows, lambda r: r.project_id)
+        for i, (vid, _) in enumerate(vs)
+    )
+    while True:
+        page = list(islice(params, PAGE_SIZE))
+        if not page:
+            break
+        conn.execute(update, page)
+    op.alter_column('versions', 'ordering', server_default=None)
+    op.drop_index('ix_versions_project_id_sort_key', table_name='versions')
+    op.drop_column('versions', 'sort_key')
@@ -0,0 +1,85 @@
+"""Add Wheel.state
+
+Revision ID: 9c4d2a6e1b87
+Revises: 3f1b7e0c2d45
+Create Date: 2018-11-07 21:16:48.204935+00:00
+
+"""
+from   datetime import datetime, timezone
+from   alembic  import op
+import sqlalchemy as S
+
+# revision identifiers, used by Alembic.
+revision = '9c4d2a6e1b87'
+down_revision = '3f1b7e0c2d45'
+branch_labels = None
+depends_on = None
+
+schema = S.MetaData()
+
+version = S.Table(
+    'versions', schema,
+    S.Column('id', S.Integer, primary_key=True, nullable=False),
+    S.Column('project_id', S.Integer, nullable=False),
+    S.Column('ordering', S.Integer, nullable=False, default=0),
+)
+
+wheel = S.Table(
+    'wheels', schema,
+    S.Column('id', S.Integer, primary_key=True, nullable=False),
+    S.Column('version_id', S.Integer, nullable=False),
+    S.Column('lease_expires', S.DateTime(timezone=True), nullable=True),
+    S.Column('state', S.Unicode(16), nullable=False),
+)
+
+wheel_data = S.Table(
+    'wheel_data', schema,
+    S.Column('id', S.Integer, primary_key=True, nullable=False),
+    S.Column('wheel_id', S.Integer, nullable=False, unique=True),
+)
+
+processing_error = S.Table(
+    'processing_errors', schema,
+    S.Column('id', S.Integer, primary_key=True, nullable=False),
+    S.Column('wheel_id', S.Integer, nullable=False),
+)
+
+def upgrade():
+    op.add_column('wheels', S.Column('state', S.Unicode(length=16), nullable=False, server_default='superseded'))
+    conn = op.get_bind()
+    has_data = S.exists().where(wheel_data.c.wheel_id == wheel.c.id)
+    has_errors = S.exists().where(processing_error.c.wheel_id == wheel.c.id)
+    conn.execute(wheel.update().values(state='done').where(has_data))
+    conn.execute(
+        wheel.update().values(state='failed')
+                      .where(~has_data)
+                      .where(has_errors)
+    )
+    # Wheels belonging to the latest version with wheels of each project are
+    # the ones in the queue:
+    v2 = version.alias()
+    w2 = wheel.alias()
+    newer_nonempty = S.exists().where(v2.c.project_id == version.c.project_id)\
+                               .where(v2.c.ordering > version.c.ordering)\
+                               .where(S.exists().where(w2.c.version_id == v2.c.id))
+    latest_nonempty = S.select([version.c.id]).where(~newer_nonempty)
+    conn.execute(
+        wheel.update().values(state='pending')
+                      .where(wheel.c.state == 'superseded')
+                      .where(wheel.c.version_id.in_(latest_nonempty))
+    )
+    conn.execute(
+        wheel.update().values(state='in_progress')
+                      .where(wheel.c.state == 'pending')
+                      .where(wheel.c.lease_expires > datetime.now(timezone.utc))
+    )
+    op.alter_column('wheels', 'state', server_default=None)
+    op.create_index('ix_wheels_state_id', 'wheels', ['state', 'id'], unique=False)
+    op.create_index(op.f('ix_wheels_version_id'), 'wheels', ['version_id'], unique=False)
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_index(op.f('ix_wheels_version_id'), table_name='wheels')
+    op.drop_index('ix_wheels_state_id', table_name='wheels')
+    op.drop_column('wheels', 'state')
+    # ### end Alembic commands ###
@@ -29,6 +29,26 @@ class PyPISerial(Base):
         return reprify(self, ['serial'])
 
 
+class ScanCheckpoint(Base):
+    """
+    A table for storing the progress of an interrupted `scan_pypi()` run so
+    that it can be resumed.  There should never be more than one row in this
+    table, and it should only exist while a scan is in progress.
+    """
+
+    __tablename__ = 'scan_checkpoint'
+
+    id      = S.Column(S.Integer, primary_key=True, nullable=False)  # noqa: B001
+    #: PyPI's serial ID as of the start of the scan
+    serial  = S.Column(S.Integer, nullable=False)
+    #: The name of the last project whose wheels were committed, or `None` if
+    #: no projects have been committed yet
+    project = S.Column(S.Unicode(2048), nullable=True)
+
+    def __repr__(self):
+        return reprify(self, ['serial', 'project'])
+
+
 class Project(Base):
     """ A PyPI project """
 
@@ -55,20 +75,24 @@ class Project(Base):
         Construct a `Project` with the given name and return it.  If such a
         project already exists, return that one instead.
         """
-        proj = cls.query.filter(cls.name == normalize(name)).one_or_none()
-        if proj is None:
-            proj = cls(name=normalize(name), display_name=name)
-            db.session.add(proj)
-        return proj
+        return NameCache.for_model(cls).get(name)
+
+    @staticmethod
+    def _name_key(name: str):
+        return normalize(name)
+
+    @classmethod
+    def _new_named(cls, name: str):
+        return cls(name=normalize(name), display_name=name)
 
     @property
     def latest_version(self):
         r"""
-        The `Version` for this `Project` with the highest ``ordering`` value,
+        The `Version` for this `Project` with the highest ``sort_key`` value,
         or `None` if there are no `Version`\ s
         """
         return Version.query.filter(Version.project == self)\
-                            .order_by(Version.ordering.desc())\
+                            .order_by(Version.sort_key.desc())\
                             .first()
 
     @property
@@ -80,7 +104,7 @@ class Project(Base):
         return Wheel.query.join(Version)\
                           .filter(Version.project == self)\
                           .filter(Wheel.data.has())\
-                          .order_by(Version.ordering.desc())\
+                          .order_by(Version.sort_key.desc())\
                           .order_by(Wheel.ordering.desc())\
                           .first()
 
@@ -95,7 +119,7 @@ class Project(Base):
                           .filter(Version.project == self)\
                           .outerjoin(WheelData)\
                           .order_by(WheelData.id.isnot(None).desc())\
-                          .order_by(Version.ordering.desc())\
+                          .order_by(Version.sort_key.desc())\
                           .order_by(Wheel.ordering.desc())\
                           .first()
 
@@ -106,7 +130,7 @@ class Project(Base):
         element is a `Version`'s ``display_name`` and the second element is a
         list of ``(Wheel, bool)`` pairs listing the wheels for that version and
         whether they have data.  The versions are ordered from highest
-        ``ordering`` to lowest, and the `Wheel`\ s within each version are
+        ``sort_key`` to lowest, and the `Wheel`\ s within each version are
         ordered from highest ``ordering`` to lowest.  Versions that do not have
         wheels are ignored.
         """
@@ -114,7 +138,7 @@ class Project(Base):
                       .join(Wheel)\
                       .outerjoin(WheelData)\
                       .filter(Version.project == self)\
-                      .order_by(Version.ordering.desc())\
+                      .order_by(Version.sort_key.desc())\
                       .order_by(Wheel.ordering.desc())
         results = []
         for v, ws in groupby(q, lambda r: r[0]):
@@ -126,7 +150,10 @@ class Version(Base):
     """ A version (a.k.a. release) of a `Project` """
 
     __tablename__ = 'versions'
-    __table_args__ = (S.UniqueConstraint('project_id', 'name'),)
+    __table_args__ = (
+        S.UniqueConstraint('project_id', 'name'),
+        S.Index('ix_versions_project_id_sort_key', 'project_id', 'sort_key'),
+    )
 
     id = S.Column(S.Integer, primary_key=True, nullable=False)  # noqa: B001
     project_id = S.Column(
@@ -143,20 +170,38 @@ class Version(Base):
     name = S.Column(S.Unicode(2048), nullable=False)
     #: The preferred non-normalized version string
     display_name = S.Column(S.Unicode(2048), nullable=False)
-    #: The index of this version when all versions for the project are sorted
-    #: in PEP 440 order with prereleases at the bottom.  (The latest version
-    #: has the highest `ordering` value.)  This column is set every time a new
-    #: version is added to the project with `add_version()`.
-    ordering = S.Column(S.Integer, nullable=False, default=0)
+    #: A string that sorts lexicographically in PEP 440 order with
+    #: prereleases at the bottom, as computed by `version_sort_string()`.
+    #: (The latest version has the highest `sort_key` value.)  As the key
+    #: depends only on the version string, adding a version never requires
+    #: touching the project's other versions.
+    sort_key = S.Column(S.Unicode(2048), nullable=False)
 
     def __repr__(self):
-        return reprify(self, 'project name display_name ordering'.split())
+        return reprify(self, 'project name display_name'.split())
+
+
+class QueueState:
+    """ The possible values of `Wheel.state` """
+
+    #: The wheel has not been processed yet and is in the processing queue
+    PENDING = 'pending'
+    #: The wheel has been claimed for processing with `claim_wheels()`
+    IN_PROGRESS = 'in_progress'
+    #: The wheel has data
+    DONE = 'done'
+    #: An error occurred while processing the wheel
+    FAILED = 'failed'
+    #: The wheel has not been processed, but it's not in the queue because it
+    #: does not belong to its project's latest version with wheels
+    SUPERSEDED = 'superseded'
 
 
 class Wheel(Base):
     """ A wheel belonging to a `Version` """
 
     __tablename__ = 'wheels'
+    __table_args__ = (S.Index('ix_wheels_state_id', 'state', 'id'),)
 
     id = S.Column(S.Integer, primary_key=True, nullable=False)  # noqa: B001
     filename = S.Column(S.Unicode(2048), nullable=False, unique=True)
@@ -165,6 +210,7 @@ class Wheel(Base):
         S.Integer,
         S.ForeignKey('versions.id', ondelete='CASCADE'),
         nullable=False,
+        index=True,
     )
     version  = relationship(
         'Version',
@@ -179,6 +225,27 @@ class Wheel(Base):
     #: applying `wheel_sort_key()` to their filenames.  This column is set
     #: every time a new wheel is added to the version with `add_wheel()`.
     ordering = S.Column(S.Integer, nullable=False, default=0)
+    #: An identifier for the `process_queue()` worker that has claimed this
+    #: wheel for processing with `claim_wheels()`, if any
+    lease_owner   = S.Column(S.Unicode(255), nullable=True)
+    #: The time at which the claim on this wheel expires, after which it may
+    #: be claimed by another worker
+    lease_expires = S.Column(S.DateTime(timezone=True), nullable=True)
+    #: The wheel's processing state, one of the values in `QueueState`.  This
+    #: column is kept up to date by `add_wheel()`, the ``remove_*()``
+    #: functions, `claim_wheels()`, `set_data()`, and `add_error()` so that the
+    #: processing queue can be found by looking up the `QueueState.PENDING`
+    #: wheels in an index.
+    state    = S.Column(S.Unicode(16), nullable=False,
+                        default=QueueState.PENDING)
+    #: The time at which the wheel was registered in the database, or `None`
+    #: if it was registered before this column was added
+    registered = S.Column(
+        S.DateTime(timezone=True),
+        nullable=True,
+        default=lambda: datetime.now(timezone.utc),
+        index=True,
+    )
 
     def __repr__(self):
         return reprify(self, ['filename'])
@@ -191,14 +258,15 @@ class Wheel(Base):
     def set_data(self, raw_data: dict):
         """
         Use the results of a call to `inspect_wheel()` to populate this wheel's
-        `WheelData`
+        `WheelData`.  If the wheel already has data, it is replaced in place.
         """
-        ### TODO: This errors if `self.data` is already non-None (because then
-        ### there are temporarily two WheelData objects with the same
-        ### `wheel_id`).  Fix this.
-        self.data = WheelData.from_raw_data(raw_data)
+        if self.data is None:
+            self.data = WheelData()
+        self.data.store_raw_data(raw_data)
         summary = raw_data["dist_info"].get("metadata", {}).get("summary")
         self.project.summary = summary[:2048] if summary is not None else None
+        self.state = QueueState.DONE
+        self.release_lease()
 
     def add_error(self, errmsg: str):
         """
@@ -209,6 +277,14 @@ class Wheel(Base):
             timestamp         = datetime.now(timezone.utc),
             wheelodex_version = __version__,
         ))
+        if self.data is None:
+            self.state = QueueState.FAILED
+        self.release_lease()
+
+    def release_lease(self):
+        """ Clear any claim on this wheel made by `claim_wheels()` """
+        self.lease_owner = None
+        self.lease_expires = None
 
     def as_json(self):
         """
@@ -228,12 +304,16 @@ class Wheel(Base):
                 "uploaded": self.uploaded,
             },
         }
+        wheelodex = {}
+        if self.registered is not None:
+            wheelodex["registered"] = self.registered.isoformat()
         if self.data is not None:
             about["data"] = self.data.raw_data
-            about["wheelodex"] = {
-                "processed": self.data.processed.isoformat(),
-                "wheel_inspect_version": self.data.wheel_inspect_version,
-            }
+            wheelodex["processed"] = self.data.processed.isoformat()
+            wheelodex["wheel_inspect_version"] \
+                = self.data.wheel_inspect_version
+        if wheelodex:
+            about["wheelodex"] = wheelodex
         if self.errors:
             about["errored"] = True
         return about
@@ -260,6 +340,23 @@ class ProcessingError(Base):
     wheelodex_version = S.Column(S.Unicode(32), nullable=False)
 
 
+def bulk_insert(table: S.Table, rows: list, chunk_size=1000):
+    r"""
+    Insert the `dict`\ s in ``rows`` into ``table`` using the current session's
+    connection, bypassing the ORM.  On PostgreSQL, the rows are inserted
+    ``chunk_size`` at a time with multi-row ``INSERT`` statements in order to
+    avoid a round trip per row; on other databases, they are inserted with a
+    single ``executemany()``.
+    """
+    if not rows:
+        return
+    if db.session.bind.dialect.name == 'postgresql':
+        for i in range(0, len(rows), chunk_size):
+            db.session.execute(table.insert().values(rows[i:i+chunk_size]))
+    else:
+        db.session.execute(table.insert(), rows)
+
+
 #: A mapping between `WheelData` values and the `Project`\ s listed in their
 #: :mailheader:`Requires-Dist` fields
 dependency_tbl = S.Table('dependency_tbl', Base.metadata,
@@ -308,40 +405,95 @@ class WheelData(Base):
                                 backref='rdepends')
     valid     = S.Column(S.Boolean, nullable=False)
 
-    @classmethod
-    def from_raw_data(cls, raw_data: dict):
+    def store_raw_data(self, raw_data: dict):
         """
-        Construct a new `WheelData` object, complete with related objects, from
-        the return value of a call to `inspect_wheel()`
+        Populate this object and its related objects from the return value of
+        a call to `inspect_wheel()`, replacing any data already present.  The
+        object must already be in the session (e.g., by being attached to a
+        `Wheel`), as it is flushed in order to obtain its ID.
+
+        The related rows are written with `insert_related()`.
         """
-        file_paths = {
-            # Make this a set because some wheels have duplicate entries in
-            # their RECORDs
-            f["path"] for f in raw_data["dist_info"].get("record", [])
-        }
-        return cls(
-            raw_data  = raw_data,
-            processed = datetime.now(timezone.utc),
-            wheel_inspect_version = wheel_inspect_version,
-            entry_points = [
-                EntryPoint(group=grobj, name=e)
-                for group, eps in raw_data["dist_info"].get("entry_points", {})
-                                                       .items()
-                for grobj in [EntryPointGroup.from_name(group)]
-                for e in eps
-            ],
-            dependencies = [
-                Project.from_name(p)
-                for p in raw_data["derived"]["dependencies"]
-            ],
-            valid = raw_data["valid"],
-            keywords = [
-                Keyword(name=k) for k in raw_data["derived"]["keywords"]
-            ],
-            files = [File(path=f) for f in file_paths],
-            modules = [Module(name=m) for m in raw_data["derived"]["modules"]],
+        self.raw_data = raw_data
+        self.processed = datetime.now(timezone.utc)
+        self.wheel_inspect_version = wheel_inspect_version
+        self.valid = raw_data["valid"]
+        replacing = self.id is not None
+        # Flush to get an ID for this object:
+        db.session.flush()
+        if replacing:
+            for tbl in (EntryPoint.__table__, File.__table__,
+                        Module.__table__, Keyword.__table__, dependency_tbl):
+                db.session.execute(
+                    tbl.delete().where(tbl.c.wheel_data_id == self.id)
+                )
+        self.insert_related([(self.id, raw_data)])
+        # Make the ORM reload the collections from the new rows:
+        db.session.expire(
+            self,
+            ['dependencies', 'entry_points', 'files', 'modules', 'keywords'],
         )
 
+    @staticmethod
+    def insert_related(items: list):
+        r"""
+        Insert the dependencies and the `EntryPoint`, `File`, `Module`, and
+        `Keyword` rows for ``items``, a list of ``(wheel_data_id, raw_data)``
+        pairs in which ``raw_data`` is the return value of a call to
+        `inspect_wheel()`.
+
+        Because a wheel can contain tens of thousands of files, the rows are
+        written with one bulk Core statement per table rather than as ORM
+        objects.  The IDs of the dependencies and entry point groups are
+        looked up (and the projects & groups created if necessary) in bulk
+        via `NameCache`.
+        """
+        project_ids = NameCache.for_model(Project).get_ids({
+            d
+            for _, raw_data in items
+            for d in raw_data["derived"]["dependencies"]
+        })
+        group_ids = NameCache.for_model(EntryPointGroup).get_ids({
+            group
+            for _, raw_data in items
+            for group in raw_data["dist_info"].get("entry_points", {})
+        })
+        dependencies, entry_points, files, modules, keywords = [],[],[],[],[]
+        for wdid, raw_data in items:
+            dependencies.extend(
+                {"wheel_data_id": wdid, "project_id": pid}
+                for pid in {
+                    project_ids[d] for d in raw_data["derived"]["dependencies"]
+                }
+            )
+            entry_points.extend(
+                {"wheel_data_id": wdid, "group_id": group_ids[group], "name": e}
+                for group, eps
+                    in raw_data["dist_info"].get("entry_points", {}).items()
+                for e in eps
+            )
+            files.extend(
+                {"wheel_data_id": wdid, "path": f}
+                # Make this a set because some wheels have duplicate entries
+                # in their RECORDs
+                for f in {
+                    f["path"] for f in raw_data["dist_info"].get("record", [])
+                }
+            )
+            modules.extend(
+                {"wheel_data_id": wdid, "name": m}
+                for m in raw_data["derived"]["modules"]
+            )
+            keywords.extend(
+                {"wheel_data_id": wdid, "name": k}
+                for k in raw_data["derived"]["keywords"]
+            )
+        bulk_insert(dependency_tbl, dependencies)
+        bulk_insert(EntryPoint.__table__, entry_points)
+        bulk_insert(File.__table__, files)
+        bulk_insert(Module.__table__, modules)
+        bulk_insert(Keyword.__table__, keywords)
+
 
 class EntryPointGroup(Base):
     """ An entry point group """
@@ -366,11 +518,15 @@ class EntryPointGroup(Base):
         Construct an `EntryPointGroup` with the given name and return it.  If
         such a group already exists, return that one instead.
         """
-        epg = cls.query.filter(cls.name == name).one_or_none()
-        if epg is None:
-            epg = cls(name=name)
-            db.session.add(epg)
-        return epg
+        return NameCache.for_model(cls).get(name)
+
+    @staticmethod
+    def _name_key(name: str):
+        return name
+
+    @classmethod
+    def _new_named(cls, name: str):
+        return cls(name=name)
 
 
 class EntryPoint(Base):
@@ -498,3 +654,165 @@ class OrphanWheel(Base):
     def project(self):
         """ The `Project` to which the wheel belongs """
         return self.version.project
+
+
+class WheelTombstone(Base):
+    """
+    A record of a `Wheel` having been deleted from the database, kept so that
+    incremental dumps (``dump --since``) can tell their consumers which wheels
+    to delete
+    """
+
+    __tablename__ = 'wheel_tombstones'
+
+    id = S.Column(S.Integer, primary_key=True, nullable=False)  # noqa: B001
+    filename = S.Column(S.Unicode(2048), nullable=False)
+    removed  = S.Column(S.DateTime(timezone=True), nullable=False, index=True)
+
+    def __repr__(self):
+        return reprify(self, ['filename', 'removed'])
+
+    def as_json(self):
+        """
+        Returns a JSONable representation of the tombstone for inclusion in
+        dumps alongside the output of `Wheel.as_json()`
+        """
+        return {
+            "removed": {
+                "filename": self.filename,
+                "timestamp": self.removed.isoformat(),
+            },
+        }
+
+
+class NameCache:
+    r"""
+    A cache of the IDs of the `Project`\ s or `EntryPointGroup`\ s (specified
+    by ``model``) with given names, used to avoid querying for the same names
+    over & over again.  Each database session has its own caches, obtained
+    via `NameCache.for_model()`; they are cleared whenever the session is
+    rolled back, as any rows created since the last commit may no longer
+    exist.
+    """
+
+    #: The maximum number of names to look up in a single ``IN`` query
+    CHUNK_SIZE = 500
+
+    def __init__(self, model):
+        self.model = model
+        #: A mapping from name keys (normalized names for `Project`\ s) to IDs
+        self.ids = {}
+        #: The number of names that were found in the cache
+        self.hits = 0
+        #: The number of names that had to be looked up in the database
+        self.misses = 0
+
+    def __repr__(self):
+        return reprify(self, 'model hits misses'.split())
+
+    @classmethod
+    def for_model(cls, model) -> 'NameCache':
+        """
+        Returns the current session's `NameCache` for ``model``, creating it
+        if necessary
+        """
+        caches = db.session.info.setdefault('name_caches', {})
+        try:
+            return caches[model]
+        except KeyError:
+            cache = caches[model] = cls(model)
+            return cache
+
+    def clear(self):
+        """ Forget all cached IDs.  The hit & miss counts are retained. """
+        self.ids.clear()
+
+    def warm(self, names) -> list:
+        """
+        Look up all of the names in ``names`` that are not already cached
+        using as few queries as possible and cache their IDs.  The model
+        objects that were looked up are returned; hold on to them in order to
+        keep them in the session's identity map so that subsequent calls to
+        `get()` for their names don't need to query the database at all.
+        """
+        keys = list({
+            k for k in map(self.model._name_key, names) if k not in self.ids
+        })
+        found = []
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            for obj in self.model.query.filter(
+                self.model.name.in_(keys[i:i+self.CHUNK_SIZE])
+            ):
+                self.ids[obj.name] = obj.id
+                found.append(obj)
+        return found
+
+    def forget(self, names):
+        """ Forget the cached IDs (if any) for the names in ``names`` """
+        for key in map(self.model._name_key, names):
+            self.ids.pop(key, None)
+
+    def get(self, name: str):
+        """
+        Return the model object with the given name, creating it if it does
+        not already exist
+        """
+        key = self.model._name_key(name)
+        obj_id = self.ids.get(key)
+        if obj_id is not None:
+            # `query.get()` only queries the database if the object is not
+            # already loaded in the session, and only that case is a hit.
+            loaded = db.session.identity_map.get(
+                self.model.__mapper__.identity_key_from_primary_key([obj_id])
+            )
+            fresh = loaded is not None and not S.inspect(loaded).expired
+            obj = self.model.query.get(obj_id)
+            if obj is not None:
+                if fresh:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                return obj
+            # The object was deleted.
+            del self.ids[key]
+        self.misses += 1
+        obj = self.model.query.filter(self.model.name == key).one_or_none()
+        if obj is None:
+            obj = self.model._new_named(name)
+            db.session.add(obj)
+            db.session.flush()
+        self.ids[key] = obj.id
+        return obj
+
+    def get_ids(self, names) -> dict:
+        """
+        Returns a `dict` mapping each name in ``names`` to the ID of the model
+        object with that name, creating any objects that do not already
+        exist.  Names that are not already cached are looked up in bulk.
+        """
+        keys = {name: self.model._name_key(name) for name in names}
+        missing = {k for k in keys.values() if k not in self.ids}
+        self.hits += len(set(keys.values())) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            self.warm(missing)
+            # Create one object per key, even if the key was given under
+            # multiple names:
+            new = [
+                self.model._new_named(name)
+                for k, name in {
+                    k: name for name, k in keys.items() if k not in self.ids
+                }.items()
+            ]
+            if new:
+                db.session.add_all(new)
+                db.session.flush()
+                for obj in new:
+                    self.ids[obj.name] = obj.id
+        return {name: self.ids[k] for name, k in keys.items()}
+
+
+@S.event.listens_for(db.session, 'after_soft_rollback')
+def _clear_name_caches(session, previous_transaction):
+    for cache in session.info.get('name_caches', {}).values():
+        cache.clear()
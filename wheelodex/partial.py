@@ -0,0 +1,172 @@
+"""
+Fetching only the metadata portions of remote wheels with HTTP range requests
+
+A wheel is a zipfile, and a zipfile can be navigated starting from the end:
+the end-of-central-directory record at the end of the file gives the location
+of the central directory, and the central directory gives the location of
+each member.  The functions in this module use this to download just the
+parts of a wheel needed to read its ``*.dist-info/`` directory, writing them
+at their original offsets into a sparse local file of the same size as the
+remote wheel.  The result can then be opened with `zipfile.ZipFile` as though
+it were the complete wheel, as long as only the fetched members are read.
+"""
+
+import logging
+import re
+import struct
+from   zipfile import ZipFile
+import requests
+from   .util   import USER_AGENT
+
+log = logging.getLogger(__name__)
+
+#: The number of bytes to fetch from the end of a wheel in the first request.
+#: This is enough to hold the end-of-central-directory record plus a
+#: maximum-length zipfile comment and, for most wheels, the entire central
+#: directory as well.
+TAIL_SIZE = 1 << 16
+
+EOCD_SIG = b'PK\x05\x06'
+EOCD_FMT = '<4s4H2LH'
+EOCD_SIZE = struct.calcsize(EOCD_FMT)
+
+ZIP64_LOCATOR_SIG = b'PK\x06\x07'
+ZIP64_LOCATOR_FMT = '<4sLQL'
+ZIP64_LOCATOR_SIZE = struct.calcsize(ZIP64_LOCATOR_FMT)
+
+ZIP64_EOCD_SIG = b'PK\x06\x06'
+ZIP64_EOCD_FMT = '<4sQ2H2L4Q'
+ZIP64_EOCD_SIZE = struct.calcsize(ZIP64_EOCD_FMT)
+
+
+class RangeFetcher:
+    """
+    Fetches byte ranges of the file at ``url`` (of size ``size``) and writes
+    them at the same offsets into the local file object ``fp``
+    """
+
+    def __init__(self, url, size, fp, session=None):
+        self.url = url
+        self.size = size
+        self.fp = fp
+        if session is None:
+            session = requests.Session()
+            session.headers["User-Agent"] = USER_AGENT
+        self.s = session
+        #: The total number of bytes fetched so far
+        self.fetched = 0
+
+    def fetch(self, start, end):
+        """
+        Fetch the bytes from ``start`` (inclusive) to ``end`` (exclusive),
+        write them to the local file, and return them
+        """
+        end = min(end, self.size)
+        if start >= end:
+            return b''
+        r = self.s.get(
+            self.url,
+            headers={
+                "Range": 'bytes={}-{}'.format(start, end-1),
+                # Range offsets refer to the encoded body, so make sure the
+                # body isn't encoded:
+                "Accept-Encoding": "identity",
+            },
+        )
+        r.raise_for_status()
+        m = re.match(r'bytes (\d+)-(\d+)/', r.headers.get("Content-Range", ''))
+        if r.status_code != 206 or not m or int(m.group(1)) != start \
+                or len(r.content) != end - start:
+            raise ValueError('Server did not honor range request for {}'
+                             .format(self.url))
+        self.fp.seek(start)
+        self.fp.write(r.content)
+        self.fetched += len(r.content)
+        return r.content
+
+    def fetch_ranges(self, ranges):
+        """
+        Fetch each of the ``(start, end)`` pairs in ``ranges``, merging
+        adjacent and overlapping ranges into single requests
+        """
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        for start, end in merged:
+            self.fetch(start, end)
+
+
+def fetch_wheel_metadata(url, size, path, prefix, session=None):
+    """
+    Create a sparse file at ``path`` the same size as the remote wheel at
+    ``url`` (of size ``size`` bytes) that contains the wheel's central
+    directory and all members whose names begin with ``prefix`` (e.g.,
+    ``"foo-1.0.dist-info/"``) at their original offsets.
+
+    :return: the number of bytes downloaded
+    :raises ValueError: if the server doesn't support range requests or the
+        file is not a valid zipfile
+    """
+    with open(path, 'wb') as fp:
+        # Setting the file's size without writing anything creates a sparse
+        # file on filesystems that support them.
+        fp.truncate(size)
+        fetcher = RangeFetcher(url, size, fp, session=session)
+        tail_start = max(size - TAIL_SIZE, 0)
+        tail = fetcher.fetch(tail_start, size)
+        cd_offset, cd_size = _locate_central_directory(fetcher, tail,
+                                                       tail_start)
+        if cd_offset < tail_start:
+            fetcher.fetch(cd_offset, min(cd_offset + cd_size, tail_start))
+        fp.flush()
+        # The central directory is now in place, so zipfile can tell us where
+        # the members are.  Each member's local header, data, and data
+        # descriptor run from its header offset to the next member's (or to
+        # the start of the central directory).
+        with ZipFile(path) as zf:
+            infos = sorted(zf.infolist(), key=lambda i: i.header_offset)
+        bounds = [i.header_offset for i in infos[1:]] + [cd_offset]
+        fetcher.fetch_ranges(
+            (info.header_offset, end)
+            for info, end in zip(infos, bounds)
+            if info.filename.startswith(prefix)
+        )
+    log.info('Fetched %d of %d bytes of %s', fetcher.fetched, size, url)
+    return fetcher.fetched
+
+def _locate_central_directory(fetcher, tail, tail_start):
+    """
+    Find the end-of-central-directory record in ``tail`` (the bytes of the
+    file starting at offset ``tail_start``) and return the offset & size of
+    the central directory, handling Zip64 if necessary
+    """
+    eocd_pos = tail.rfind(EOCD_SIG)
+    if eocd_pos < 0 or len(tail) - eocd_pos < EOCD_SIZE:
+        raise ValueError('End of central directory record not found')
+    _, _, _, _, _, cd_size, cd_offset, _ = struct.unpack(
+        EOCD_FMT, tail[eocd_pos:eocd_pos + EOCD_SIZE],
+    )
+    if cd_offset == 0xFFFFFFFF or cd_size == 0xFFFFFFFF:
+        loc_pos = eocd_pos - ZIP64_LOCATOR_SIZE
+        if loc_pos < 0:
+            raise ValueError('Zip64 end of central directory locator not'
+                             ' found')
+        sig, _, z64_offset, _ = struct.unpack(
+            ZIP64_LOCATOR_FMT, tail[loc_pos:loc_pos + ZIP64_LOCATOR_SIZE],
+        )
+        if sig != ZIP64_LOCATOR_SIG:
+            raise ValueError('Zip64 end of central directory locator not'
+                             ' found')
+        if z64_offset >= tail_start:
+            rec = tail[z64_offset - tail_start:][:ZIP64_EOCD_SIZE]
+        else:
+            rec = fetcher.fetch(z64_offset, z64_offset + ZIP64_EOCD_SIZE)
+        fields = struct.unpack(ZIP64_EOCD_FMT, rec)
+        if fields[0] != ZIP64_EOCD_SIG:
+            raise ValueError('Zip64 end of central directory record not'
+                             ' found')
+        cd_size, cd_offset = fields[-2:]
+    return (cd_offset, cd_size)
@@ -1,93 +1,715 @@
 """ Functions for downloading & analyzing wheels """
 
+import asyncio
+from   collections        import namedtuple
+from   concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import hashlib
 import logging
 import os
 import os.path
-from   tempfile          import TemporaryDirectory
+import socket
+from   tempfile           import TemporaryDirectory
+import threading
+import time
 import traceback
-from   requests_download import download
-from   wheel_inspect     import inspect_wheel
-from   .models           import db
-from   .dbutil           import iterqueue
-from   .util             import USER_AGENT
+from   flask              import current_app
+from   requests_download  import TrackerBase, download
+from   wheel_inspect      import Wheel as WheelInspector, errors
+from   .models            import Wheel, db
+from   .dbutil            import claim_wheels, iter_stale_wheels, iterqueue, \
+                                 log_name_cache_stats, name_cache_stats
+from   .partial           import fetch_wheel_metadata
+from   .util              import USER_AGENT
 
 log = logging.getLogger(__name__)
 
-def process_queue(max_wheel_size=None):
+def process_queue(max_wheel_size=None, workers=1, partial=False,
+                  lease_batch=None, lease_seconds=3600, commit_batch=1,
+                  cache=None):
     """
-    Process all of the wheels returned by `iterqueue()` one by one and store
-    the results in the database.  If an error occurs, the traceback is stored
-    as a `ProcessingError` for the wheel.  The database session is committed
-    after each wheel in order to save memory.
+    Process all of the wheels returned by `iterqueue()` and store the results
+    in the database.  If an error occurs, the traceback is stored as a
+    `ProcessingError` for the wheel.  The database session is committed after
+    every ``commit_batch`` wheels, with each wheel's results stored inside a
+    savepoint so that a failure to store one wheel's data only rolls back that
+    wheel.  The session is also cleared after each batch in order to save
+    memory.
+
+    If ``workers`` is greater than 1, the wheels are processed concurrently by
+    a pool of that many threads, each of which runs in its own application
+    context and thus uses its own database session; the workers take the
+    wheels ``commit_batch`` at a time and commit after each such batch.  The
+    `NameCache` statistics logged at the end are the totals for all of the
+    workers' sessions.
+
+    If ``lease_batch`` is set, then instead of processing a snapshot of the
+    queue taken at the start, each worker repeatedly claims ``lease_batch``
+    wheels at a time with `claim_wheels()` and processes them until the queue
+    is empty.  This allows multiple instances of this function to safely run
+    against the same database at once (e.g., on different hosts).
 
     This function requires a Flask application context with a database
     connection to be in effect.
 
     :param int max_wheel_size: If set, only wheels this size or smaller are
-        analyzed
+        analyzed in full
+    :param int workers: the number of wheels to process at once
+    :param bool partial: If true, wheels larger than ``max_wheel_size`` are
+        analyzed using just their metadata (see `process_wheel_partial()`)
+        instead of being skipped
+    :param int lease_batch: the number of wheels for each worker to claim at
+        a time
+    :param int lease_seconds: how long a worker's claim on a batch of wheels
+        lasts before other workers may claim them
+    :param int commit_batch: the number of wheels to process per transaction
+    :param InspectionCache cache: If set, wheels whose analyses are in this
+        cache are not downloaded, and new full analyses are added to it
     """
+    queue_max = None if partial else max_wheel_size
+    # The `name_cache_stats()` of the workers' sessions, if any:
+    stats = []
     with TemporaryDirectory() as tmpdir:
-        for whl in iterqueue(max_wheel_size=max_wheel_size):
-            try:
-                about = process_wheel(
-                    filename = whl.filename,
-                    url      = whl.url,
-                    size     = whl.size,
-                    md5      = whl.md5,
-                    sha256   = whl.sha256,
-                    tmpdir   = tmpdir,
+        if lease_batch is not None:
+            claimer = functools.partial(
+                _process_leased,
+                tmpdir         = tmpdir,
+                lease_batch    = lease_batch,
+                lease_seconds  = lease_seconds,
+                max_wheel_size = queue_max,
+                max_full_size  = max_wheel_size,
+                commit_batch   = commit_batch,
+                cache          = cache,
+            )
+            if workers > 1:
+                app = current_app._get_current_object()
+                db.session.close()
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    stats.extend(pool.map(
+                        lambda _: _in_app_context(app, claimer),
+                        range(workers),
+                    ))
+            else:
+                claimer()
+        elif workers > 1:
+            app = current_app._get_current_object()
+            wheel_ids = [whl.id for whl in iterqueue(max_wheel_size=queue_max)]
+            # Release the main thread's connection while the workers run:
+            db.session.close()
+            log.info('Processing %d wheels with %d workers',
+                     len(wheel_ids), workers)
+            batches = [
+                wheel_ids[i:i+commit_batch]
+                for i in range(0, len(wheel_ids), commit_batch)
+            ]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Consuming the results also propagates any exceptions not
+                # handled by `process_queued_wheel()`:
+                stats.extend(pool.map(
+                    lambda ids: _process_wheel_ids(
+                        app, ids, tmpdir, max_wheel_size, cache,
+                    ),
+                    batches,
+                ))
+        else:
+            # Fetching the queue in batches of the same size as the commit
+            # batches means that, whenever the session is cleared, the queue
+            # iterator is about to fetch fresh `Wheel` objects anyway.
+            for i, whl in enumerate(
+                iterqueue(max_wheel_size=queue_max, batch_size=commit_batch),
+                start=1,
+            ):
+                process_queued_wheel(
+                    whl, tmpdir, max_wheel_size, commit=False, cache=cache,
                 )
-                whl.set_data(about)
-                # Some errors in inserting data aren't raised until we actually
-                # try to insert by calling commit(), so include the commit()
-                # under the `try`.
-                db.session.commit()
-            except Exception:
-                # rollback() needs to be called before log.exception() or else
-                # SQLAlchemy gets all complainy.
-                db.session.rollback()
-                log.exception('Error processing %s', whl.filename)
-                whl.add_error(traceback.format_exc())
+                if i % commit_batch == 0:
+                    db.session.commit()
+                    db.session.expunge_all()
+            db.session.commit()
+    log_name_cache_stats(*stats)
+
+def reprocess_stale(max_wheel_size=None, partial=False, limit=None, rate=None,
+                    cache=None):
+    """
+    Reanalyze wheels whose data was produced by an older version of
+    ``wheel-inspect`` (see `iter_stale_wheels()`), replacing their data in
+    place.  The session is committed after each wheel, so the old data stays
+    visible until the new data is ready.  If an error occurs, the traceback
+    is stored as a `ProcessingError` for the wheel, and its old data is left
+    intact.
+
+    This function requires a Flask application context with a database
+    connection to be in effect.
+
+    :param int max_wheel_size: If set, only wheels this size or smaller are
+        analyzed in full
+    :param bool partial: If true, wheels larger than ``max_wheel_size`` are
+        analyzed using just their metadata (see `process_wheel_partial()`)
+        instead of being skipped
+    :param int limit: If set, at most this many wheels are reanalyzed
+    :param float rate: If set, wheels are reanalyzed at no more than this
+        many per minute so as to leave capacity for processing new wheels
+    :param InspectionCache cache: If set, wheels whose analyses are in this
+        cache are not downloaded, and new full analyses are added to it
+    """
+    interval = 60 / rate if rate else 0
+    start = time.monotonic()
+    qty = 0
+    with TemporaryDirectory() as tmpdir:
+        for whl in iter_stale_wheels(
+            max_wheel_size=None if partial else max_wheel_size,
+        ):
+            if limit is not None and qty >= limit:
+                break
+            delay = start + qty * interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            log.info('Reanalyzing %s (last analyzed with wheel-inspect %s)',
+                     whl.filename, whl.data.wheel_inspect_version)
+            process_queued_wheel(whl, tmpdir, max_wheel_size, cache=cache)
+            qty += 1
+    log.info('%d wheels reanalyzed', qty)
+
+def _in_app_context(app, func):
+    """ Call ``func`` inside a new application context for ``app`` """
+    with app.app_context():
+        return func()
+
+def _process_leased(tmpdir, lease_batch, lease_seconds, max_wheel_size=None,
+                    max_full_size=None, commit_batch=1, cache=None):
+    """
+    Repeatedly claim batches of wheels with `claim_wheels()` and process them
+    until there are no more wheels to claim, committing after every
+    ``commit_batch`` wheels and at the end of each claimed batch.  Returns
+    the session's `name_cache_stats()`.
+    """
+    owner = '{}:{}:{}'.format(
+        socket.gethostname(),
+        os.getpid(),
+        threading.get_ident(),
+    )
+    while True:
+        wheels = claim_wheels(
+            owner,
+            limit          = lease_batch,
+            lease_seconds  = lease_seconds,
+            max_wheel_size = max_wheel_size,
+        )
+        db.session.commit()
+        if not wheels:
+            break
+        log.info('Worker %s: claimed %d wheels', owner, len(wheels))
+        for i, whl in enumerate(wheels, start=1):
+            process_queued_wheel(
+                whl, tmpdir, max_full_size, commit=False, cache=cache,
+            )
+            if i % commit_batch == 0:
                 db.session.commit()
+        db.session.commit()
+        del wheels
+        db.session.expunge_all()
+    return name_cache_stats()
+
+def _process_wheel_ids(app, wheel_ids, tmpdir, max_full_size=None,
+                       cache=None):
+    r"""
+    Process the `Wheel`\ s with IDs ``wheel_ids`` inside a new application
+    context for ``app``, commit, and return the session's
+    `name_cache_stats()`.  This is the unit of work run by each thread in
+    `process_queue()`'s worker pool.
+    """
+    with app.app_context():
+        for wheel_id in wheel_ids:
+            whl = Wheel.query.get(wheel_id)
+            if whl is None:
+                log.info('Wheel ID %d deleted before processing; skipping',
+                         wheel_id)
+                continue
+            process_queued_wheel(
+                whl, tmpdir, max_full_size, commit=False, cache=cache,
+            )
+        db.session.commit()
+        return name_cache_stats()
+
+def process_queued_wheel(whl: Wheel, tmpdir, max_full_size=None, commit=True,
+                         cache=None):
+    """
+    Download & analyze the `Wheel` ``whl`` in ``tmpdir`` and store the results
+    in the database.  If an error occurs, the traceback is stored as a
+    `ProcessingError` for the wheel instead.  The results are stored inside a
+    savepoint, so an error in storing them rolls back only the changes for
+    this wheel.
+
+    :param int max_full_size: If set, wheels larger than this are analyzed
+        with `process_wheel_partial()` instead of `process_wheel()`
+    :param bool commit: whether to commit the session afterwards
+    :param InspectionCache cache: If set, the wheel is only downloaded if its
+        analysis is not in this cache, and a new full (i.e., not partial)
+        analysis is added to it
+    """
+    partial = max_full_size is not None and whl.size > max_full_size
+    processor = process_wheel_partial if partial else process_wheel
+    try:
+        about = cache.get(whl.sha256, whl.filename) if cache is not None \
+            else None
+        if about is None:
+            about = processor(
+                filename = whl.filename,
+                url      = whl.url,
+                size     = whl.size,
+                md5      = whl.md5,
+                sha256   = whl.sha256,
+                tmpdir   = tmpdir,
+            )
+            # Partial analyses must not be cached, as a later lookup for a full
+            # analysis would then get the partial one instead.
+            if cache is not None and not partial:
+                cache.put(whl.sha256, about)
+        # Some errors in inserting data aren't raised until the data is
+        # actually flushed, which happens when the savepoint is released, so
+        # include the whole savepoint under the `try`.
+        with db.session.begin_nested():
+            whl.set_data(about)
+    except Exception:
+        log.exception('Error processing %s', whl.filename)
+        whl.add_error(traceback.format_exc())
+    if commit:
+        db.session.commit()
 
 def process_wheel(filename, url, size, md5, sha256, tmpdir):
     """
     Process an individual wheel.  The wheel is downloaded from ``url`` to the
     directory ``tmpdir``, analyzed with `inspect_wheel()`, and then deleted.
     The wheel's size and digests are also checked against ``size``, ``md5``,
-    and ``sha256`` (provided by PyPI) to verify download integrity.
+    and ``sha256`` (provided by PyPI) during the download to verify download
+    integrity.
 
     :return: the results of the call to `inspect_wheel()`
     """
     fpath = os.path.join(tmpdir, filename)
+    try:
+        digests = download_wheel(filename, url, fpath, size, md5, sha256)
+        log.info('Inspecting %s ...', filename)
+        about = inspect_prehashed_wheel(fpath, digests)
+    finally:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+    log.info('Finished inspecting %s', filename)
+    return about
+
+def download_wheel(filename, url, fpath, size, md5, sha256):
+    """
+    Download the wheel ``filename`` from ``url`` to ``fpath``, checking its
+    size & digests against ``size``, ``md5``, and ``sha256`` (provided by
+    PyPI) as it's downloaded.  The download is aborted with a `ValueError` as
+    soon as a mismatch is detected.
+
+    :return: a `dict` mapping ``"md5"`` and ``"sha256"`` to the hex digests of
+        the downloaded file
+    """
     log.info('Downloading %s from %s ...', filename, url)
+    verifier = DownloadVerifier(filename, size, {"md5": md5, "sha256": sha256})
     # Write "user-agent" in lowercase so it overrides requests_download's
     # header correctly:
-    download(url, fpath, headers={"user-agent": USER_AGENT})
-    log.info('Inspecting %s ...', filename)
+    download(
+        url,
+        fpath,
+        headers  = {"user-agent": USER_AGENT},
+        trackers = [verifier],
+    )
+    return verifier.hexdigests()
+
+
+class DownloadVerifier(TrackerBase):
+    """
+    A `requests_download` tracker that hashes a wheel as it's downloaded and
+    raises a `ValueError` as soon as the download is known to not match the
+    size or digests reported by PyPI
+    """
+
+    def __init__(self, filename, size, digests):
+        #: The filename of the wheel being downloaded, for logging
+        self.filename = filename
+        #: The size of the wheel as reported by PyPI
+        self.size = size
+        #: A `dict` mapping algorithm names to the hex digests reported by
+        #: PyPI; `None` values are not checked
+        self.expected = digests
+        self.received = 0
+        self.hashers = {alg: hashlib.new(alg) for alg in digests}
+
+    def on_start(self, response):
+        self.received = 0
+        # Content-Length is the size of the encoded body, so it can only be
+        # compared to the wheel size when no encoding is in effect.
+        clen = response.headers.get("Content-Length")
+        if clen is not None and "Content-Encoding" not in response.headers \
+                and int(clen) != self.size:
+            self.mismatch('Size', self.size, 'Content-Length ' + clen)
+
+    def on_chunk(self, chunk):
+        self.received += len(chunk)
+        if self.received > self.size:
+            self.mismatch(
+                'Size', self.size, 'at least {} bytes'.format(self.received),
+            )
+        for h in self.hashers.values():
+            h.update(chunk)
+
+    def on_finish(self):
+        if self.received != self.size:
+            self.mismatch('Size', self.size, self.received)
+        for alg, digest in sorted(self.hexdigests().items()):
+            expected = self.expected[alg]
+            if expected is not None and expected != digest:
+                self.mismatch(alg + ' hash', expected, digest)
+
+    def hexdigests(self):
+        """ Return the hex digests of the data downloaded so far """
+        return {alg: h.hexdigest() for alg, h in self.hashers.items()}
+
+    def mismatch(self, what, expected, got):
+        log.error('Wheel %s: %s mismatch: PyPI reports %s, got %s',
+                  self.filename, what.lower(), expected, got)
+        raise ValueError('{} mismatch: PyPI reports {}, got {}'
+                         .format(what, expected, got))
+
+
+class PrehashedWheel(WheelInspector):
+    """
+    A `wheel_inspect.Wheel` that reports the digests passed to it (e.g.,
+    those computed & verified by `DownloadVerifier`) as the file's digests
+    """
+
+    def __init__(self, path, digests):
+        super().__init__(path)
+        self.digests = digests
+
+    def inspect(self):
+        about = super().inspect()
+        about["file"]["digests"] = dict(self.digests)
+        return about
+
+
+def inspect_prehashed_wheel(path, digests):
+    """
+    Like `inspect_wheel()`, but use the already-computed ``digests`` for the
+    file's digests
+    """
+    with PrehashedWheel(path, digests) as whl:
+        return whl.inspect()
+
+
+class PartialWheel(PrehashedWheel):
+    """
+    A `PrehashedWheel` for a sparse copy of a wheel produced by
+    `fetch_wheel_metadata()`, in which only the central directory and the
+    :file:`*.dist-info` members are actually present
+    """
+
+    def verify_record(self):
+        # Only the dist-info members can be checked against their RECORD
+        # digests; everything else is checked for presence & size using just
+        # the central directory.
+        prefix = self.dist_info + '/'
+        for entry in self.record:
+            if not entry:
+                if entry.path != prefix + 'RECORD':
+                    raise errors.NullEntryError(entry.path)
+            elif entry.path.startswith(prefix):
+                entry.verify(self.zipfile)
+            else:
+                try:
+                    info = self.zipfile.getinfo(entry.path)
+                except KeyError:
+                    raise errors.FileMissingError(entry.path)
+                if entry.size != info.file_size:
+                    raise errors.RecordSizeMismatchError(
+                        entry.path,
+                        entry.size,
+                        info.file_size,
+                    )
+        for path in self.zipfile.namelist():
+            if path not in self.record and path not in (
+                prefix + 'RECORD.jws',
+                prefix + 'RECORD.p7s',
+            ):
+                raise errors.ExtraFileError(path)
+
+
+def process_wheel_partial(filename, url, size, md5, sha256, tmpdir):
+    """
+    Process an individual wheel without downloading all of it.  Only the
+    wheel's zip directory and :file:`*.dist-info` files are fetched from
+    ``url`` (using HTTP range requests) into a sparse file in ``tmpdir``,
+    which is then analyzed and deleted.  The wheel's digests cannot be
+    verified in this mode, so ``md5`` and ``sha256`` are reported as-is, and
+    the files in the wheel's :file:`RECORD` outside of the
+    :file:`*.dist-info` directory are only checked for presence and size.
+
+    :return: the results of inspecting the wheel, in the same format as
+        `inspect_wheel()`
+    """
+    fpath = os.path.join(tmpdir, filename)
+    whl = PartialWheel(fpath, {"md5": md5, "sha256": sha256})
+    log.info('Fetching metadata for %s from %s ...', filename, url)
     try:
-        about = inspect_wheel(fpath)
+        fetch_wheel_metadata(url, size, fpath, whl.dist_info + '/')
+        log.info('Inspecting %s ...', filename)
+        with whl:
+            about = whl.inspect()
     finally:
-        os.remove(fpath)
-    if about["file"]["size"] != size:
-        log.error('Wheel %s: size mismatch: PyPI reports %d, got %d',
-                  size, about["file"]["size"])
-        raise ValueError('Size mismatch: PyPI reports {}, got {}'
-                         .format(size, about["file"]["size"]))
-    for alg, expected in [("md5", md5), ("sha256", sha256)]:
-        if expected is not None and expected != about["file"]["digests"][alg]:
-            log.error(
-                'Wheel %s: %s hash mismatch: PyPI reports %s, got %s',
-                alg,
-                expected,
-                about["file"]["digests"][alg],
-            )
-            raise ValueError(
-                '{} hash mismatch: PyPI reports {}, got {}'.format(
-                    alg,
-                    expected,
-                    about["file"]["digests"][alg],
-                )
-            )
+        if os.path.exists(fpath):
+            os.remove(fpath)
     log.info('Finished inspecting %s', filename)
     return about
+
+#: The attributes of a queued `Wheel` needed to process it outside of the
+#: database session
+QueuedWheel = namedtuple('QueuedWheel', 'id filename url size md5 sha256')
+
+def pipeline_queue(max_wheel_size=None, downloads=4, inspectors=None,
+                   max_buffer_size=None, partial=False, commit_batch=1,
+                   cache=None):
+    """
+    Process all of the wheels returned by `iterqueue()` using an asyncio
+    pipeline that overlaps downloading with analysis.  Up to ``downloads``
+    wheels are downloaded at once in a thread pool; each downloaded wheel is
+    then passed to a pool of ``inspectors`` processes running
+    `inspect_wheel()`, and the results are stored in the database by a single
+    writer thread with its own application context, so that neither database
+    nor cache I/O blocks the event loop.  As in `process_queue()`, each
+    wheel's results are stored inside a savepoint so that a failure to store
+    one wheel's data only rolls back that wheel, and the writer's session is
+    committed & cleared after every ``commit_batch`` wheels.
+
+    This function requires a Flask application context with a database
+    connection to be in effect.
+
+    :param int max_wheel_size: If set, only wheels this size or smaller are
+        analyzed in full
+    :param int downloads: the maximum number of wheels to download at once
+    :param int inspectors: the number of processes to analyze wheels with;
+        defaults to the number of CPUs
+    :param int max_buffer_size: If set, the wheels being downloaded or
+        analyzed at any one time are limited to this many bytes in total
+        (except that a single wheel larger than the limit is still processed
+        on its own)
+    :param bool partial: If true, wheels larger than ``max_wheel_size`` are
+        analyzed using just their metadata (see `process_wheel_partial()`)
+        instead of being skipped
+    :param int commit_batch: the number of wheels to store per transaction
+    :param InspectionCache cache: If set, wheels whose analyses are in this
+        cache are not downloaded, and new full analyses are added to it
+    """
+    queue = [
+        QueuedWheel(w.id, w.filename, w.url, w.size, w.md5, w.sha256)
+        for w in iterqueue(max_wheel_size=None if partial else max_wheel_size)
+    ]
+    if inspectors is None:
+        inspectors = os.cpu_count() or 1
+    app = current_app._get_current_object()
+    # Release the main thread's connection while the writer thread runs:
+    db.session.close()
+    log.info('Processing %d wheels with %d downloaders and %d inspectors',
+             len(queue), downloads, inspectors)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with TemporaryDirectory() as tmpdir, \
+                ThreadPoolExecutor(max_workers=downloads) as download_pool, \
+                ProcessPoolExecutor(max_workers=inspectors) as inspect_pool, \
+                ThreadPoolExecutor(max_workers=1) as writer_pool:
+            stats = loop.run_until_complete(_run_pipeline(
+                queue,
+                app             = app,
+                tmpdir          = tmpdir,
+                downloads       = downloads,
+                inspectors      = inspectors,
+                download_pool   = download_pool,
+                inspect_pool    = inspect_pool,
+                writer_pool     = writer_pool,
+                max_buffer_size = max_buffer_size,
+                max_full_size   = max_wheel_size,
+                commit_batch    = commit_batch,
+                cache           = cache,
+            ))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    log_name_cache_stats(stats)
+
+async def _run_pipeline(queue, app, tmpdir, downloads, inspectors,
+                        download_pool, inspect_pool, writer_pool,
+                        max_buffer_size, max_full_size, commit_batch=1,
+                        cache=None):
+    """
+    Run the pipeline for `pipeline_queue()`, storing the results with
+    ``writer_pool`` (which must have only one thread), and return the
+    writer's `name_cache_stats()`
+    """
+    loop = asyncio.get_event_loop()
+    pending = asyncio.Queue()
+    for qw in queue:
+        pending.put_nowait(qw)
+    # Bound the results backlog so that a slow database doesn't let
+    # inspection results pile up in memory:
+    results = asyncio.Queue(maxsize=downloads + inspectors)
+    download_slots = asyncio.Semaphore(downloads)
+    budget = ByteBudget(max_buffer_size)
+
+    async def fetch_and_inspect():
+        while True:
+            try:
+                qw = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if cache is not None:
+                about = await loop.run_in_executor(
+                    download_pool, cache.get, qw.sha256, qw.filename,
+                )
+                if about is not None:
+                    await results.put((qw, about, None))
+                    continue
+            if max_full_size is not None and qw.size > max_full_size:
+                # Partial processing only needs a few requests and hardly any
+                # disk space (or CPU), so do all of it in the download pool.
+                try:
+                    async with download_slots:
+                        about = await loop.run_in_executor(
+                            download_pool, process_wheel_partial,
+                            qw.filename, qw.url, qw.size, qw.md5, qw.sha256,
+                            tmpdir,
+                        )
+                except Exception:
+                    log.exception('Error processing %s', qw.filename)
+                    await results.put((qw, None, traceback.format_exc()))
+                else:
+                    # Partial analyses are not cached; see
+                    # `process_queued_wheel()`.
+                    await results.put((qw, about, None))
+                continue
+            await budget.acquire(qw.size)
+            fpath = os.path.join(tmpdir, qw.filename)
+            try:
+                async with download_slots:
+                    digests = await loop.run_in_executor(
+                        download_pool, download_wheel, qw.filename, qw.url,
+                        fpath, qw.size, qw.md5, qw.sha256,
+                    )
+                log.info('Inspecting %s ...', qw.filename)
+                about = await loop.run_in_executor(
+                    inspect_pool, inspect_prehashed_wheel, fpath, digests,
+                )
+                log.info('Finished inspecting %s', qw.filename)
+                if cache is not None:
+                    await loop.run_in_executor(
+                        download_pool, cache.put, qw.sha256, about,
+                    )
+            except Exception:
+                log.exception('Error processing %s', qw.filename)
+                result = (qw, None, traceback.format_exc())
+            else:
+                result = (qw, about, None)
+            finally:
+                if os.path.exists(fpath):
+                    os.remove(fpath)
+                await budget.release(qw.size)
+            await results.put(result)
+
+    async def fetch_all():
+        try:
+            # Run enough fetchers that the download slots stay full while
+            # other wheels are waiting for or undergoing inspection:
+            await asyncio.gather(*[
+                fetch_and_inspect()
+                for _ in range(min(downloads + inspectors, len(queue)))
+            ])
+        finally:
+            await results.put(None)
+
+    # The writer thread keeps the same application context (and thus the
+    # same database session) for the whole run:
+    ctx = app.app_context()
+    await loop.run_in_executor(writer_pool, ctx.push)
+    fetcher = loop.create_task(fetch_all())
+    try:
+        stored = 0
+        while True:
+            r = await results.get()
+            if r is None:
+                break
+            await loop.run_in_executor(writer_pool, _store_result, *r)
+            stored += 1
+            if stored % commit_batch == 0:
+                await loop.run_in_executor(writer_pool, _commit_and_clear)
+        await loop.run_in_executor(writer_pool, _commit_and_clear)
+        # Propagate any exceptions not caught by the fetchers:
+        await fetcher
+        return await loop.run_in_executor(writer_pool, name_cache_stats)
+    finally:
+        fetcher.cancel()
+        await loop.run_in_executor(writer_pool, ctx.pop)
+
+def _commit_and_clear():
+    """ Commit the current session and then clear it to save memory """
+    db.session.commit()
+    db.session.expunge_all()
+
+def _store_result(qw: QueuedWheel, about, errmsg):
+    """
+    Store the results of processing a queued wheel in the database: either
+    the `inspect_wheel()` output ``about`` or, if an error occurred, the
+    traceback ``errmsg``.  As in `process_queued_wheel()`, the data is stored
+    inside a savepoint, and if storing it fails, the traceback of that
+    failure is stored instead.  The session is not committed.
+    """
+    whl = Wheel.query.get(qw.id)
+    if whl is None:
+        log.info('Wheel %s deleted before processing; skipping', qw.filename)
+        return
+    if errmsg is None:
+        try:
+            # Some errors in inserting data aren't raised until the data is
+            # actually flushed, which happens when the savepoint is released,
+            # so include the whole savepoint under the `try`.
+            with db.session.begin_nested():
+                whl.set_data(about)
+            return
+        except Exception:
+            log.exception('Error processing %s', qw.filename)
+            errmsg = traceback.format_exc()
+    whl.add_error(errmsg)
+
+
+class ByteBudget:
+    """
+    An asyncio synchronization primitive for limiting the total size of the
+    wheels being held on disk at once.  If ``limit`` is `None`, no limit is
+    enforced.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, size):
+        """
+        Wait until ``size`` bytes can be reserved without exceeding the limit,
+        and then reserve them.  If nothing is currently reserved, the
+        reservation is always granted so that an oversized wheel can't stall
+        the pipeline.
+        """
+        async with self.cond:
+            await self.cond.wait_for(
+                lambda: self.limit is None or self.used == 0
+                        or self.used + size <= self.limit
+            )
+            self.used += size
+
+    async def release(self, size):
+        """ Release a reservation of ``size`` bytes """
+        async with self.cond:
+            self.used -= size
+            self.cond.notify_all()
@@ -1,8 +1,11 @@
 """ PyPI API client """
 
+from   contextlib    import closing
+from   html.parser   import HTMLParser
 import logging
+import threading
+import time
 from   xmlrpc.client import ProtocolError, ServerProxy
-from   pypi_simple   import PyPISimple
 import requests
 from   retrying      import retry
 from   .util         import USER_AGENT
@@ -12,6 +15,9 @@ log = logging.getLogger(__name__)
 #: PyPI's XML-RPC and JSON API endpoint
 ENDPOINT = 'https://pypi.org/pypi'
 
+#: PyPI's Simple API endpoint
+SIMPLE_ENDPOINT = 'https://pypi.org/simple/'
+
 def on_xml_exception(method):
     """
     If an XML-RPC request fails due to a 5xx error, this function logs the
@@ -43,13 +49,26 @@ def on_http_exception(e):
 class PyPIAPI:
     """
     A client for select features of PyPI's APIs with automatic retrying of
-    requests that fail due to server errors
+    requests that fail due to server errors.  The HTTP-based methods may be
+    called from multiple threads at once.
     """
 
     def __init__(self):
         self.client = ServerProxy(ENDPOINT, use_builtin_types=True)
-        self.s = requests.Session()
-        self.s.headers["User-Agent"] = USER_AGENT
+        self._local = threading.local()
+
+    @property
+    def s(self) -> requests.Session:
+        """
+        The `requests.Session` for the current thread.  Sessions are not
+        thread-safe, so each thread that makes requests gets its own.
+        """
+        try:
+            return self._local.session
+        except AttributeError:
+            s = self._local.session = requests.Session()
+            s.headers["User-Agent"] = USER_AGENT
+            return s
 
     @retry(
         retry_on_exception          = on_xml_exception('changelog_last_serial'),
@@ -60,16 +79,64 @@ class PyPIAPI:
         """ Returns the serial ID of the last event on PyPI """
         return self.client.changelog_last_serial()
 
+    def list_packages(self):
+        """
+        Returns an iterator of the names of all packages on PyPI.  The Simple
+        index is streamed and parsed incrementally, so neither the whole page
+        nor the whole list of names is held in memory at once.
+
+        If the connection fails partway through the page, the page is fetched
+        again from the start (after an exponential backoff), and the names
+        that were already yielded are skipped, relying on the index listing
+        projects in the same order each time.
+        """
+        yielded = 0
+        attempt = 0
+        while True:
+            try:
+                for i, name in enumerate(self._stream_simple_index()):
+                    if i >= yielded:
+                        yield name
+                        yielded += 1
+                        attempt = 0
+                return
+            except (requests.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                attempt += 1
+                log.warning('Reading Simple index failed after %d projects:'
+                            ' %s; retrying', yielded, e)
+                time.sleep(min(2 ** attempt, 10))
+
+    def _stream_simple_index(self):
+        """
+        Fetch & parse PyPI's Simple index once, yielding project names as
+        they're parsed
+        """
+        # The Warehouse devs prefer it if the Simple API is used for this
+        # instead of the XML-RPC API.
+        parser = SimpleIndexParser()
+        with closing(self.simple_index()) as r:
+            for chunk in r.iter_content(chunk_size=65536, decode_unicode=True):
+                parser.feed(chunk)
+                yield from parser.drain()
+        parser.close()
+        yield from parser.drain()
+
     @retry(
         retry_on_exception          = on_http_exception,
         wait_exponential_multiplier = 1000,
         wait_exponential_max        = 10000,
     )
-    def list_packages(self):
-        """ Returns a list of the names of all packages on PyPI """
-        # The Warehouse devs prefer it if the Simple API is used for this
-        # instead of the XML-RPC API.
-        return PyPISimple().get_projects()
+    def simple_index(self):
+        """
+        Start fetching PyPI's Simple index and return the streaming
+        `requests.Response`
+        """
+        r = self.s.get(SIMPLE_ENDPOINT, stream=True)
+        r.raise_for_status()
+        if 'charset' not in r.headers.get('content-type', '').lower():
+            r.encoding = 'utf-8'
+        return r
 
     @retry(
         retry_on_exception          = on_http_exception,
@@ -113,3 +180,34 @@ class PyPIAPI:
         Return a list of PyPI changelog entries since the given serial ID
         """
         return self.client.changelog_since_serial(since)
+
+
+class SimpleIndexParser(HTMLParser):
+    """
+    An incremental parser for Simple repository index pages.  As the page is
+    fed to the parser, the text of each ``<a>`` element (i.e., each project
+    name) is added to a buffer, which is emptied by `drain()`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.names = []
+        self._name = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self._name = ''
+
+    def handle_data(self, data):
+        if self._name is not None:
+            self._name += data
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._name is not None:
+            self.names.append(self._name.strip())
+            self._name = None
+
+    def drain(self):
+        """ Return & clear the list of project names parsed so far """
+        names, self.names = self.names, []
+        return names
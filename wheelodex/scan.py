@@ -1,19 +1,45 @@
 """ Functions for scanning PyPI for wheels to register """
 
+from   collections        import defaultdict, deque
+from   concurrent.futures import ThreadPoolExecutor
+from   datetime           import datetime, timedelta, timezone
+from   itertools          import islice
 import logging
-from   .dbutil   import add_orphan_wheel, add_project, add_version, add_wheel, \
-                            remove_project, remove_version, remove_wheel, \
-                            set_serial
-from   .pypi_api import PyPIAPI
-from   .util     import latest_version
+import time
+from   packaging.utils    import canonicalize_name as normalize, \
+                                  canonicalize_version as normversion
+from   sqlalchemy.orm     import joinedload
+from   .dbutil            import add_orphan_wheel, add_project, add_version, \
+                                    add_wheel, add_wheels_from_json, \
+                                    get_scan_checkpoint, \
+                                    log_name_cache_stats, remove_project, \
+                                    remove_version, remove_wheel, set_serial, \
+                                    start_scan_checkpoint
+from   .models            import NameCache, OrphanWheel, Project, Version, db
+from   .pypi_api          import PyPIAPI
+from   .util              import latest_version
 
 log = logging.getLogger(__name__)
 
-def scan_pypi():
+def scan_pypi(workers=1, batch_size=1000, resume=False):
     """
     Use PyPI's XML-RPC and JSON APIs to find & register all wheels for the
-    latest version of every project on PyPI.  The database's serial ID is also
-    set to PyPI's current value as of the start of the function.
+    latest version of every project on PyPI.  The database's serial ID is set
+    to PyPI's serial ID as of the start of the scan once the scan completes.
+
+    The projects' JSON is fetched ahead of time by up to ``workers`` threads
+    while the results are written to the database in the order the projects
+    are listed.
+
+    The session is committed & cleared after every ``batch_size`` projects
+    along with a `ScanCheckpoint` recording the last project committed and the
+    serial ID from the start of the scan, and the list of projects is streamed
+    from PyPI, so the scan's memory usage does not grow with the number of
+    projects.  If ``resume`` is true, the scan continues after the project
+    named in the existing checkpoint (relying on PyPI's Simple index listing
+    projects in the same order each time) instead of starting over, and so a
+    scan that is interrupted only loses the work done since the last commit.
+    The checkpoint is deleted when the scan completes.
 
     This function requires a Flask application context with a database
     connection to be in effect.
@@ -29,74 +55,219 @@ def scan_pypi():
     """
     log.info('BEGIN scan_pypi')
     pypi = PyPIAPI()
-    serial = pypi.changelog_last_serial()
-    log.info('changlog_last_serial() = %d', serial)
-    set_serial(serial)
-    for pkg in pypi.list_packages():
-        log.info('Adding wheels for project %r', pkg)
-        project = add_project(pkg)
-        data = pypi.project_data(pkg)
-        if data is None or not data.get("releases", {}):
-            log.info('Project has no releases')
-            continue
-        versions = list(data["releases"].keys())
-        log.debug('Available versions: %r', versions)
-        latest = latest_version(versions)
-        log.info('Using latest version: %r', latest)
-        qty_queued = 0
-        vobj = add_version(project, latest)
-        for asset in data["releases"][latest]:
-            if not asset["filename"].endswith('.whl'):
-                log.debug('Asset %s: not a wheel; skipping', asset["filename"])
-            else:
-                log.debug('Asset %s: adding', asset["filename"])
-                qty_queued += 1
-                add_wheel(
-                    version  = vobj,
-                    filename = asset["filename"],
-                    url      = asset["url"],
-                    size     = asset["size"],
-                    md5      = asset["digests"]["md5"].lower(),
-                    sha256   = asset["digests"]["sha256"].lower(),
-                    uploaded = str(asset["upload_time"]),
-                )
-        log.info('%s: %d wheels added', pkg, qty_queued)
+    if resume:
+        checkpoint = get_scan_checkpoint()
+        if checkpoint is None:
+            raise ValueError('No scan checkpoint to resume from')
+        log.info('Resuming scan from serial %d after project %r',
+                 checkpoint.serial, checkpoint.project)
+    else:
+        serial = pypi.changelog_last_serial()
+        log.info('changlog_last_serial() = %d', serial)
+        checkpoint = start_scan_checkpoint(serial)
+        db.session.commit()
+    names = pypi.list_packages()
+    if checkpoint.project is not None:
+        names = _resume_after(checkpoint.project, names, pypi.list_packages)
+    names = iter(names)
+    cache = NameCache.for_model(Project)
+    projects = []
+    qty = 0
+    while True:
+        batch = list(islice(names, batch_size))
+        if not batch:
+            break
+        # Look up the batch's existing projects in bulk so that
+        # `add_project()` can find them without querying the database.  The
+        # projects are kept referenced (and thus in the session's identity
+        # map) until the batch is committed, after which they are expired &
+        # expunged, so this is done afresh for each batch.  Any IDs that are
+        # already cached are looked up again, as their objects may likewise
+        # be stale.
+        cache.forget(batch)
+        projects[:] = cache.warm(batch)
+        for pkg, data in prefetch(pypi.project_data, batch, workers):
+            _scan_project(pkg, data)
+        qty += len(batch)
+        checkpoint.project = batch[-1]
+        db.session.commit()
+        # Don't let the session accumulate objects over the whole scan:
+        db.session.expunge_all()
+        db.session.add(checkpoint)
+        cache.forget(batch)
+        log.info('Checkpoint: %d projects committed; last project: %r',
+                 qty, batch[-1])
+    set_serial(checkpoint.serial)
+    db.session.delete(checkpoint)
+    log_name_cache_stats()
     log.info('END scan_pypi')
 
-def scan_changelog(since):
+def _resume_after(project, names, relist):
+    """
+    Yield the names in the iterable ``names`` that come after ``project``
+    (*modulo* normalization).  If ``project`` does not occur in ``names``
+    (e.g., because it has since been deleted from PyPI), log a warning and
+    yield all of the names in ``relist()`` instead.
+    """
+    key = normalize(project)
+    names = iter(names)
+    for name in names:
+        if normalize(name) == key:
+            yield from names
+            return
+    log.warning('Checkpointed project %r not found; rescanning all projects',
+                project)
+    yield from relist()
+
+def _scan_project(pkg, data):
+    """
+    Register the project named ``pkg`` and the wheels for its latest version
+    given its JSON API data ``data`` (or `None` if the project has no
+    releases)
+    """
+    log.info('Adding wheels for project %r', pkg)
+    project = add_project(pkg)
+    if data is None or not data.get("releases", {}):
+        log.info('Project has no releases')
+        return
+    versions = list(data["releases"].keys())
+    log.debug('Available versions: %r', versions)
+    latest = latest_version(versions)
+    log.info('Using latest version: %r', latest)
+    qty_queued = 0
+    vobj = add_version(project, latest)
+    for asset in data["releases"][latest]:
+        if not asset["filename"].endswith('.whl'):
+            log.debug('Asset %s: not a wheel; skipping', asset["filename"])
+        else:
+            log.debug('Asset %s: adding', asset["filename"])
+            qty_queued += 1
+            add_wheel(
+                version  = vobj,
+                filename = asset["filename"],
+                url      = asset["url"],
+                size     = asset["size"],
+                md5      = asset["digests"]["md5"].lower(),
+                sha256   = asset["digests"]["sha256"].lower(),
+                uploaded = str(asset["upload_time"]),
+            )
+    log.info('%s: %d wheels added', pkg, qty_queued)
+
+def scan_changelog(since, workers=1, events_per_commit=1000):
     """
     Use PyPI's XML-RPC and JSON APIs to update the wheel registry based on all
-    events that have happened on PyPI since serial ID ``since``.  The
-    database's serial ID is also set to PyPI's current value as of the start of
-    the function.
+    events that have happened on PyPI since serial ID ``since``.
+
+    The changelog is requested from PyPI repeatedly, starting after the last
+    event seen each time, until no more events are returned.  Each response
+    is held in memory in full, so the amount of changelog held at once is
+    bounded only by PyPI's own cap on the number of events returned per call
+    (currently 50,000), not by ``events_per_commit``.  The events in each
+    response are applied ``events_per_commit`` at a time with
+    `apply_changelog_events()` (which queries the JSON API for up to
+    ``workers`` projects at once), and the session is committed & cleared
+    after each such chunk along with the database's serial ID, which is
+    advanced to that of the chunk's last event, so an interruption only loses
+    the current chunk.
 
     This function requires a Flask application context with a database
     connection to be in effect.
     """
     log.info('BEGIN scan_changelog(%d)', since)
     pypi = PyPIAPI()
-    for proj, rel, ts, action, serial in pypi.changelog_since_serial(since):
-        actwords = action.split()
-
-        # As of pypa/warehouse revision 97f28df (2018-09-20), the possible
-        # "action" strings are (found by searching for "JournalEntry" in the
-        # code):
-        # - "add {python_version} file {filename}"
-        # - "remove file {filename}"
-        # - "create" [new project]
-        # - "remove project"
-        # - "new release"
-        # - "remove release"
-        # - "add Owner {username}"
-        # - "add {role_name} {username}"
-        # - "remove {role_name} {username}"
-        # - "change {role_name} {username} to {role_name2}" [?]
-        # - "nuke user"
-        # - "docdestroy"
-
-        if actwords[0] == 'add' and len(actwords) == 4 and \
-                actwords[2] == 'file' and actwords[3].endswith('.whl'):
-            filename = actwords[3]
+    total = 0
+    while True:
+        events = pypi.changelog_since_serial(since)
+        if not events:
+            break
+        for i in range(0, len(events), events_per_commit):
+            chunk = events[i:i+events_per_commit]
+            start = time.monotonic()
+            apply_changelog_events(pypi, chunk, workers)
+            db.session.commit()
+            # Don't let the session accumulate objects over the whole scan:
+            db.session.expunge_all()
+            elapsed = time.monotonic() - start
+            total += len(chunk)
+            log.info(
+                'Applied events %d-%d (%d events) in %.2fs (%.1f events/s);'
+                ' %d events total; lag: %s',
+                chunk[0][4], chunk[-1][4], len(chunk), elapsed,
+                len(chunk) / elapsed if elapsed > 0 else 0.0, total,
+                timedelta(seconds=int(time.time() - chunk[-1][2])),
+            )
+        if events[-1][4] <= since:
+            break
+        since = events[-1][4]
+    log_name_cache_stats()
+    log.info('END scan_changelog')
+
+def apply_changelog_events(pypi, events, workers=1):
+    """
+    Update the wheel registry based on the given list of PyPI changelog
+    events, which must be in order of serial ID.  The database's serial ID is
+    then advanced to that of the last event.
+
+    Rather than querying the JSON API once for every added wheel, the events
+    are first grouped by project, and the JSON for each project with added
+    wheels is fetched only once, with up to ``workers`` projects fetched at
+    once.  Wheels that are added and then removed (directly or by removing
+    their version or project) later in the list are not looked up at all.
+
+    This function requires a Flask application context with a database
+    connection to be in effect.
+    """
+    actions = [parse_action(action) for _, _, _, action, _ in events]
+    # Find the wheel additions that are undone by later events, walking the
+    # events backwards so that only removals that follow an addition count:
+    removed_files = set()
+    removed_versions = set()
+    removed_projects = set()
+    undone = set()
+    for i in reversed(range(len(events))):
+        proj, rel, _, _, _ = events[i]
+        kind, filename = actions[i]
+        if kind == 'add_wheel':
+            if filename in removed_files \
+                    or normalize(proj) in removed_projects \
+                    or (normalize(proj), normversion(rel)) in removed_versions:
+                undone.add(i)
+        elif kind == 'remove_wheel':
+            removed_files.add(filename)
+        elif kind == 'remove_version':
+            removed_versions.add((normalize(proj), normversion(rel)))
+        elif kind == 'remove_project':
+            removed_projects.add(normalize(proj))
+
+    # The worker threads are only given plain strings so that they don't
+    # touch the session:
+    wanted = defaultdict(set)
+    for i, ((proj, rel, _, _, _), (kind, filename)) \
+            in enumerate(zip(events, actions)):
+        if kind == 'add_wheel' and i not in undone:
+            wanted[proj].add((rel, filename))
+
+    def fetch_assets(project):
+        data = pypi.project_data(project)
+        if data is None:
+            return {}
+        releases = data.get("releases", {})
+        return {
+            (version, filename): asset
+            for version, filename in wanted[project]
+            for asset in releases.get(version, [])
+            if asset["filename"] == filename
+        }
+
+    assets = {}
+    for _, found in prefetch(fetch_assets, list(wanted), workers):
+        assets.update(found)
+    log.info('%d events: fetched JSON for %d projects', len(events),
+             len(wanted))
+
+    for i, ((proj, rel, ts, action, serial), (kind, filename)) \
+            in enumerate(zip(events, actions)):
+        if kind == 'add_wheel':
             log.info('Event %d: wheel %s added', serial, filename)
             # New wheels should more often than not belong to the latest
             # version of the project, and if they don't, they can be pruned out
@@ -104,8 +275,11 @@ def scan_changelog(since):
             # comparing `rel` to the latest version in the database at this
             # point.
             v = add_version(proj, rel)
-            data = pypi.asset_data(proj, rel, filename)
-            if data is not None:
+            data = assets.get((rel, filename))
+            if i in undone:
+                log.info('Asset %s: removed by a later event; skipping',
+                         filename)
+            elif data is not None:
                 log.info('Asset %s: adding', filename)
                 add_wheel(
                     version  = v,
@@ -121,25 +295,24 @@ def scan_changelog(since):
                          filename)
                 add_orphan_wheel(v, filename, ts)
 
-        elif actwords[:2] == ['remove', 'file'] and len(actwords) == 3 and \
-                actwords[2].endswith('.whl'):
-            log.info('Event %d: wheel %s removed', serial, actwords[2])
-            remove_wheel(actwords[2])
+        elif kind == 'remove_wheel':
+            log.info('Event %d: wheel %s removed', serial, filename)
+            remove_wheel(filename)
 
-        elif action == 'create':
+        elif kind == 'add_project':
             log.info('Event %d: project %r created', serial, proj)
             add_project(proj)
 
-        elif action == 'remove project':
+        elif kind == 'remove_project':
             log.info('Event %d: project %r removed', serial, proj)
             remove_project(proj)
 
-        elif action == 'new release':
+        elif kind == 'add_version':
             log.info('Event %d: version %r of project %r released', serial,
                      rel, proj)
             add_version(proj, rel)
 
-        elif action == 'remove release':
+        elif kind == 'remove_version':
             log.info('Event %d: version %r of project %r removed', serial,
                      rel, proj)
             remove_version(proj, rel)
@@ -147,5 +320,140 @@ def scan_changelog(since):
         else:
             log.debug('Event %d: %r: ignoring', serial, action)
 
-        set_serial(serial)
-    log.info('END scan_changelog')
+    if events:
+        set_serial(events[-1][4])
+
+def parse_action(action):
+    """
+    Classify a PyPI changelog event's "action" string.  Returns a pair of one
+    of ``'add_wheel'``, ``'remove_wheel'``, ``'add_project'``,
+    ``'remove_project'``, ``'add_version'``, ``'remove_version'``, or `None`
+    (for actions that don't concern Wheelodex) and, for the ``*_wheel``
+    actions, the wheel's filename (`None` otherwise).
+    """
+    actwords = action.split()
+
+    # As of pypa/warehouse revision 97f28df (2018-09-20), the possible
+    # "action" strings are (found by searching for "JournalEntry" in the
+    # code):
+    # - "add {python_version} file {filename}"
+    # - "remove file {filename}"
+    # - "create" [new project]
+    # - "remove project"
+    # - "new release"
+    # - "remove release"
+    # - "add Owner {username}"
+    # - "add {role_name} {username}"
+    # - "remove {role_name} {username}"
+    # - "change {role_name} {username} to {role_name2}" [?]
+    # - "nuke user"
+    # - "docdestroy"
+
+    if actwords[0] == 'add' and len(actwords) == 4 and \
+            actwords[2] == 'file' and actwords[3].endswith('.whl'):
+        return ('add_wheel', actwords[3])
+    elif actwords[:2] == ['remove', 'file'] and len(actwords) == 3 and \
+            actwords[2].endswith('.whl'):
+        return ('remove_wheel', actwords[2])
+    elif action == 'create':
+        return ('add_project', None)
+    elif action == 'remove project':
+        return ('remove_project', None)
+    elif action == 'new release':
+        return ('add_version', None)
+    elif action == 'remove release':
+        return ('remove_version', None)
+    else:
+        return (None, None)
+
+def process_orphan_wheels(max_age, workers=1):
+    """
+    Query PyPI's JSON API to see if it can find the data for any orphaned
+    wheels.  Those that are found are registered as "normal" wheels and no
+    longer orphaned.  Those that aren't found despite being older than
+    ``max_age`` seconds are considered expired and deleted from the database.
+
+    The orphans are grouped by project so that each project's JSON is fetched
+    only once, with up to ``workers`` projects fetched at once, and the wheels
+    that are found are then registered together with `add_wheels_from_json()`.
+
+    This function requires a Flask application context with a database
+    connection to be in effect.
+    """
+    log.info('BEGIN process_orphan_wheels')
+    pypi = PyPIAPI()
+    orphans = defaultdict(list)
+    for orphan in OrphanWheel.query.options(
+        joinedload(OrphanWheel.version).joinedload(Version.project)
+    ):
+        orphans[orphan.project.name].append(orphan)
+    # The worker threads are only given plain strings so that they don't
+    # touch the session:
+    wanted = {
+        project: {(o.version.display_name, o.filename) for o in orphs}
+        for project, orphs in orphans.items()
+    }
+
+    def fetch_assets(project):
+        data = pypi.project_data(project)
+        if data is None:
+            return {}
+        releases = data.get("releases", {})
+        return {
+            filename: asset
+            for version, filename in wanted[project]
+            for asset in releases.get(version, [])
+            if asset["filename"] == filename
+        }
+
+    found = []
+    for project, assets in prefetch(fetch_assets, list(wanted), workers):
+        for orphan in orphans[project]:
+            data = assets.get(orphan.filename)
+            if data is not None:
+                log.info('Wheel %s: data found', orphan.filename)
+                found.append({
+                    "pypi": {
+                        "project":  orphan.project.display_name,
+                        "version":  orphan.version.display_name,
+                        "filename": data["filename"],
+                        "url":      data["url"],
+                        "size":     data["size"],
+                        "md5":      data["digests"].get("md5").lower(),
+                        "sha256":   data["digests"].get("sha256").lower(),
+                        "uploaded": str(data["upload_time"]),
+                    },
+                })
+                db.session.delete(orphan)
+            else:
+                log.info('Wheel %s: data not found', orphan.filename)
+    add_wheels_from_json(found)
+    log.info('%d orphan wheels registered', len(found))
+    expired = OrphanWheel.query.filter(
+        OrphanWheel.uploaded
+            < datetime.now(timezone.utc) - timedelta(seconds=max_age)
+    ).delete(synchronize_session=False)
+    log.info('%d orphan wheels expired', expired)
+    log.info('END process_orphan_wheels')
+
+def prefetch(func, items, workers=1):
+    """
+    Yield ``(item, func(item))`` for each element of the iterable ``items``,
+    in order, while calling ``func`` on upcoming items in a pool of
+    ``workers`` threads.  At most ``2 * workers`` calls are pending at any
+    time, so ``items`` is consumed only a little ahead of the caller.
+
+    ``func`` is run in the worker threads and so must not touch the database
+    session.
+    """
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(n):
+            for x in islice(items, n):
+                pending.append((x, executor.submit(func, x)))
+        submit(2 * workers)
+        while pending:
+            x, future = pending.popleft()
+            submit(1)
+            yield (x, future.result())
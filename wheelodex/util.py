@@ -1,10 +1,10 @@
 from   collections       import defaultdict
-from   functools         import total_ordering
+from   functools         import lru_cache, total_ordering
 import platform
 import re
 from   flask             import Response
 from   flask.json        import dumps
-from   packaging.version import parse
+from   packaging.version import InvalidVersion, Version
 import requests
 import requests_download
 from   wheel_inspect     import parse_wheel_filename
@@ -34,8 +34,121 @@ def version_sort_key(v):
     Returns a sort key for the given version string that sorts in PEP 440
     order, but with prereleases sorted less than non-prereleases
     """
-    v = parse(v)
-    return (not v.is_prerelease, v)
+    try:
+        v = Version(v)
+    except InvalidVersion:
+        # Non-PEP 440 versions are never prereleases and sort before all PEP
+        # 440 versions.
+        return (True, 0, legacy_version_key(v))
+    return (not v.is_prerelease, 1, v)
+
+def version_sort_string(v):
+    """
+    Returns a string of hexadecimal digits that sorts lexicographically in the
+    same order as `version_sort_key()` sorts the given version string, so that
+    versions can be ordered by the database (or by `bisect`) without parsing
+    them.  Versions that compare equal under PEP 440 produce the same string.
+    """
+    # Each component of the key is written with a prefix-free encoding so that
+    # comparing the concatenated bytes is the same as comparing the tuples
+    # that `packaging` uses for its own comparisons.
+    try:
+        v = Version(v)
+    except InvalidVersion:
+        buf = bytearray([1, 0])
+        for part in legacy_version_key(v):
+            buf.append(1)
+            _encode_str(buf, part)
+        buf.append(0)
+        return buf.hex()
+    buf = bytearray([int(not v.is_prerelease), 1])
+    _encode_int(buf, v.epoch)
+    release = list(v.release)
+    while release and release[-1] == 0:
+        release.pop()
+    for n in release:
+        buf.append(1)
+        _encode_int(buf, n)
+    buf.append(0)
+    if v.pre is not None:
+        buf.append(1)
+        _encode_str(buf, v.pre[0])
+        _encode_int(buf, v.pre[1])
+    elif v.post is None and v.dev is not None:
+        # "1.0.dev0" sorts before "1.0a0"
+        buf.append(0)
+    else:
+        buf.append(2)
+    if v.post is None:
+        buf.append(0)
+    else:
+        buf.append(1)
+        _encode_int(buf, v.post)
+    if v.dev is None:
+        buf.append(2)
+    else:
+        buf.append(1)
+        _encode_int(buf, v.dev)
+    if v.local is None:
+        buf.append(0)
+    else:
+        buf.append(1)
+        for part in v.local.split('.'):
+            # Numeric segments sort after alphanumeric ones
+            if part.isdigit():
+                buf.append(2)
+                _encode_int(buf, int(part))
+            else:
+                buf.append(1)
+                _encode_str(buf, part)
+        buf.append(0)
+    return buf.hex()
+
+_LEGACY_COMPONENT_RGX = re.compile(r'(\d+|[a-z]+|\.|-)')
+
+_LEGACY_REPLACEMENTS = {
+    "pre": "c",
+    "preview": "c",
+    "-": "final-",
+    "rc": "c",
+    "dev": "@",
+}
+
+def legacy_version_key(v):
+    """
+    Returns a tuple of strings that sorts non-PEP 440 version strings in the
+    same way as setuptools' pre-PEP 440 version scheme (which is also how
+    ``packaging`` sorted them before it dropped support for them in version
+    22)
+    """
+    parts = []
+    for part in _LEGACY_COMPONENT_RGX.split(v.lower()):
+        part = _LEGACY_REPLACEMENTS.get(part, part)
+        if not part or part == '.':
+            continue
+        if part[:1].isdigit():
+            part = part.zfill(8)
+        else:
+            part = '*' + part
+            if part < '*final':
+                while parts and parts[-1] == '*final-':
+                    parts.pop()
+            while parts and parts[-1] == '00000000':
+                parts.pop()
+        parts.append(part)
+    while parts and parts[-1] == '00000000':
+        parts.pop()
+    parts.append('*final')
+    return tuple(parts)
+
+def _encode_int(buf, n):
+    b = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    buf.append(len(b))
+    buf.extend(b)
+
+def _encode_str(buf, s):
+    buf.extend(s.encode('utf-8'))
+    buf.append(0)
 
 def reprify(obj, fields):
     """
@@ -94,6 +207,34 @@ class VersionNoDot:
         return 'VersionNoDot({!r})'.format(self.vstr)
 
 
+#: The regular expressions used to classify platform tags in
+#: `wheel_sort_key()`, in increasing order of preference
+PLATFORM_PATTERNS = [
+    re.compile(r'macosx_10_(?P<version>\d+)_(?P<arch>\w+)'),
+    re.compile('macosx'),
+    re.compile('win32'),
+    re.compile('win64'),
+    re.compile('win_amd64'),
+    re.compile(r'linux_(?P<arch>\w+)'),
+    re.compile(r'manylinux(?P<version>\d+)_(?P<arch>\w+)'),
+    re.compile('any'),
+]
+
+BUILD_RGX = re.compile(r'(?P<buildno>\d+)(?P<buildstr>[^-]*)')
+PYTHON_TAG_RGX = re.compile(r'(\w+?)(\d+)')
+ABI_TAG_RGX = re.compile(r'(\wp)(\d+)(\w*)')
+
+def nodot_key(vstr):
+    """
+    Returns a string that compares the same way as ``VersionNoDot(vstr)``.
+    Appending a character greater than any digit makes each string sort after
+    all of its extensions while leaving other comparisons lexicographic, and
+    plain string comparison is much faster than calling
+    `VersionNoDot.__le__()`.
+    """
+    return vstr + '\uffff'
+
+@lru_cache(maxsize=8192)
 def wheel_sort_key(filename):
     """
     Returns a sort key for the given wheel filename that will be used to select
@@ -137,7 +278,7 @@ def wheel_sort_key(filename):
         return (0, filename)
 
     if whlname.build is not None:
-        n = re.fullmatch(r'(?P<buildno>\d+)(?P<buildstr>[^-]*)', whlname.build)
+        n = BUILD_RGX.fullmatch(whlname.build)
         if not n:
             return (0, filename)
         build_rank = (int(n.group('buildno')), n.group('buildstr'))
@@ -146,12 +287,12 @@ def wheel_sort_key(filename):
 
     pyver_rank = []
     for py in whlname.python_tags:
-        n = re.fullmatch(r'(\w+?)(\d+)', py)
+        n = PYTHON_TAG_RGX.fullmatch(py)
         if not n:
             return (0, filename)
         pyver_rank.append((
             PYTHON_PREFERENCES[n.group(1)],
-            VersionNoDot(n.group(2)),
+            nodot_key(n.group(2)),
         ))
     pyver_rank.sort(reverse=True)
 
@@ -163,26 +304,17 @@ def wheel_sort_key(filename):
     if abi == 'none':
         abi_rank = (1,)
     else:
-        n = re.fullmatch(r'(\wp)(\d+)(\w*)', abi)
+        n = ABI_TAG_RGX.fullmatch(abi)
         if n:
             py_imp, py_ver, flags = n.groups()
-            abi_rank = (0,PYTHON_PREFERENCES[py_imp],VersionNoDot(py_ver),flags)
+            abi_rank = (0, PYTHON_PREFERENCES[py_imp], nodot_key(py_ver), flags)
         else:
-            abi_rank = (0, -1, -1, '')
+            abi_rank = (0, -1, '', '')
 
     platform_rank = []
     for plat in whlname.platform_tags:
-        for rank, rgx in enumerate([
-            r'macosx_10_(?P<version>\d+)_(?P<arch>\w+)',
-            'macosx',
-            'win32',
-            'win64',
-            'win_amd64',
-            r'linux_(?P<arch>\w+)',
-            r'manylinux(?P<version>\d+)_(?P<arch>\w+)',
-            'any',
-        ]):
-            n = re.fullmatch(rgx, plat)
+        for rank, rgx in enumerate(PLATFORM_PATTERNS):
+            n = rgx.fullmatch(plat)
             if n:
                 d = n.groupdict()
                 version = d.get('version')
@@ -201,7 +333,16 @@ def wheel_sort_key(filename):
         '.'.join(whlname.platform_tags),
     )
 
-    return (1, pyver_rank, platform_rank, abi_rank, tiebreaker, build_rank)
+    # Return tuples rather than lists so that the cached keys can't be
+    # modified by callers.
+    return (
+        1,
+        tuple(pyver_rank),
+        tuple(platform_rank),
+        abi_rank,
+        tiebreaker,
+        build_rank,
+    )
 
 def json_response(obj, status_code=200):
     """ Like `flask.jsonify()`, but supports setting a custom status code """